@@ -46,6 +46,7 @@ def includeme(config):
     config.include('snovault.jsonld_context')
     config.include('snovault.schema_views')
     config.include('snovault.crud_views')
+    config.include('snovault.batch_views')
     config.include('snovault.indexing_views')
     config.include('snovault.resource_views')
     config.include('snovault.settings')
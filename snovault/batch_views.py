@@ -0,0 +1,227 @@
+import contextlib
+import json
+import transaction
+
+from uuid import UUID
+
+from pyramid.httpexceptions import HTTPBadRequest, HTTPException
+from pyramid.settings import asbool
+from pyramid.traversal import find_resource
+from pyramid.view import view_config
+from sqlalchemy.exc import IntegrityError
+from structlog import get_logger
+
+from .crud_views import create_item, update_item
+from .interfaces import COLLECTIONS
+from .invalidation import add_batch_to_indexing_queue
+from .resources import Collection, Item
+from .schema_utils import make_schema_validator, validate
+from .schema_validation import parse_skip_links
+from .util import NDJSON, debug_log, register_path_content_type
+
+
+log = get_logger(__name__)
+
+BATCH_ROUTE = 'batch'
+BATCH_PATH = '/batch'
+
+register_path_content_type(path=BATCH_PATH, content_type=NDJSON)
+
+
+def includeme(config):
+    config.add_route(BATCH_ROUTE, BATCH_PATH)
+    config.scan(__name__)
+
+
+class BatchRowError(Exception):
+    """ Raised while processing a single batch row; reported in that row's result """
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def parse_batch_rows(body):
+    """ Parses an NDJSON request body into a list of row dicts, skipping blank lines """
+    rows = []
+    for line_number, line in enumerate(body.decode('utf-8').splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise HTTPBadRequest(f'Line {line_number} of the batch is not valid JSON: {e}')
+        if not isinstance(row, dict):
+            raise HTTPBadRequest(f'Line {line_number} of the batch is not a JSON object')
+        rows.append(row)
+    return rows
+
+
+@contextlib.contextmanager
+def row_request(request, context, method):
+    """
+    Makes `request` look like the individual POST/PATCH that a batch row stands
+    for while the row is processed, so schema validators that consult the request
+    method (requestMethod) or context (permission) behave as they would on the
+    equivalent single-item request
+    """
+    saved_context, saved_method = request.context, request.method
+    request.context, request.method = context, method
+    try:
+        yield
+    finally:
+        request.context, request.method = saved_context, saved_method
+
+
+class BatchWriter(object):
+    """
+    Validates and writes the rows of a batch request within the request's
+    transaction. Schema validators are built once per item type and shared by
+    all rows of that type, and every row runs in its own savepoint so one bad
+    row does not take the others down with it (unless the batch is atomic).
+    """
+
+    def __init__(self, request, check_only=False):
+        self.request = request
+        self.check_only = check_only
+        self.validators = {}
+
+    def validator_for(self, type_info):
+        validator = self.validators.get(type_info.name)
+        if validator is None:
+            validator = self.validators[type_info.name] = make_schema_validator(type_info.schema)
+        return validator
+
+    def validate(self, type_info, data, current=None):
+        validated, errors = validate(type_info.schema, data, current, validator=self.validator_for(type_info))
+        if errors:
+            raise BatchRowError([
+                {'name': 'Schema: ' + '.'.join(str(p) for p in error.path), 'description': error.message}
+                for error in errors
+            ])
+        return validated
+
+    def create(self, row):
+        collection = self.request.registry[COLLECTIONS].get(row.get('type'))
+        if not isinstance(collection, Collection):
+            raise BatchRowError([{'name': 'type', 'description': f'Unknown item type: {row.get("type")!r}'}])
+        if not self.request.has_permission('add', collection):
+            raise BatchRowError([{'name': 'permission', 'description': f'add permission required on {collection}'}])
+        with row_request(self.request, collection, 'POST'):
+            validated = self.validate(collection.type_info, row['body'])
+            if self.check_only:
+                return None
+            return create_item(collection.type_info, self.request, validated)
+
+    def patched_properties(self, current, row):
+        """ Properties of an item once the PATCH row is applied to its current ones """
+        data = current.copy()
+        data.pop('schema_version', None)
+        data.update(row['body'])
+        return data
+
+    def patch(self, row):
+        try:
+            item = find_resource(self.request.root, str(row.get('id', '')).replace(':', '%3A'))
+        except KeyError:
+            item = None
+        if not isinstance(item, Item):
+            raise BatchRowError([{'name': 'id', 'description': f'Item not found: {row.get("id")!r}'}])
+        if not self.request.has_permission('edit', item):
+            raise BatchRowError([{'name': 'permission', 'description': f'edit permission required on {row["id"]}'}])
+        with row_request(self.request, item, 'PATCH'):
+            current = item.upgrade_properties().copy()
+            data = self.patched_properties(current, row)
+            if 'uuid' in data and UUID(data['uuid']) != item.uuid:
+                raise BatchRowError([{'name': 'uuid', 'description': 'uuid may not be changed'}])
+            current['uuid'] = str(item.uuid)
+            validated = self.validate(item.type_info, data, current)
+            if self.check_only:
+                return item
+            update_item(item, self.request, validated, body=row['body'])
+            return item
+
+    def write(self, row):
+        method = str(row.get('method', '')).upper()
+        if not isinstance(row.get('body'), dict):
+            raise BatchRowError([{'name': 'body', 'description': 'Each row needs an object body'}])
+        if method == 'POST':
+            return self.create(row)
+        elif method == 'PATCH':
+            return self.patch(row)
+        raise BatchRowError([{'name': 'method', 'description': f'Unsupported method: {row.get("method")!r}'}])
+
+    def process(self, index, row):
+        """ Writes a single row, returning its result dict """
+        result = {'row': index, 'method': str(row.get('method', '')).upper()}
+        savepoint = transaction.savepoint()
+        # what the row queued for indexing is dropped along with its writes if it fails
+        indexing_batch_size = len(self.request._indexing_batch)
+        try:
+            item = self.write(row)
+        except BatchRowError as e:
+            savepoint.rollback()
+            del self.request._indexing_batch[indexing_batch_size:]
+            result.update(status='error', errors=e.errors)
+        except HTTPException as e:
+            savepoint.rollback()
+            del self.request._indexing_batch[indexing_batch_size:]
+            result.update(status='error', errors=[{'name': type(e).__name__, 'description': e.detail or e.explanation}])
+        except IntegrityError as e:
+            savepoint.rollback()
+            del self.request._indexing_batch[indexing_batch_size:]
+            log.error(event='batch_row_conflict', row=index, error=str(e.orig))
+            result.update(status='error', errors=[{'name': 'IntegrityError',
+                                                   'description': 'Conflicts with existing uuids or unique keys'}])
+        else:
+            result['status'] = 'success'
+            if item is not None:
+                result.update({'uuid': str(item.uuid), '@id': self.request.resource_path(item)})
+        return result
+
+
+@view_config(route_name=BATCH_ROUTE, request_method='POST')
+@debug_log
+def batch_write(context, request):
+    """
+    Creates and patches many items in a single request and transaction.
+
+    The body is NDJSON, one row per line:
+        {"method": "POST", "type": "<item type or collection name>", "body": {...}}
+        {"method": "PATCH", "id": "<uuid or @id>", "body": {...}}
+
+    Each row is validated like the equivalent single-item POST/PATCH (schema and
+    permissions), reusing one schema validator per item type. Rows that fail are
+    rolled back individually and reported; the rest are committed together. With
+    `atomic=true` any failure rolls back the whole batch instead. `check_only=true`
+    validates every row without writing.
+
+    All written items are queued for indexing together after commit, rather than
+    one SQS call per item. The response is NDJSON with one result per row, in
+    order. It is only sent once the transaction has committed, so results are
+    not streamed as rows finish: all of them are held in memory until then.
+    """
+    parse_skip_links(request)
+    atomic = asbool(request.params.get('atomic', False))
+    check_only = asbool(request.params.get('check_only', False))
+    rows = parse_batch_rows(request.body)
+
+    request._indexing_batch = []
+    writer = BatchWriter(request, check_only=check_only)
+    results = [writer.process(index, row) for index, row in enumerate(rows)]
+    failed = sum(1 for result in results if result['status'] != 'success')
+    log.info(event='batch_write', rows=len(rows), failed=failed, atomic=atomic)
+
+    if atomic and failed:
+        transaction.doom()
+        for result in results:
+            if result['status'] == 'success':
+                result['status'] = 'rolled back'
+        request.response.status = 422
+    elif request._indexing_batch:
+        transaction.get().addAfterCommitHook(add_batch_to_indexing_queue, args=(request, request._indexing_batch))
+
+    response = request.response
+    response.content_type = NDJSON
+    response.app_iter = ((json.dumps(result) + '\n').encode('utf-8') for result in results)
+    return response
@@ -1,3 +1,6 @@
+import heapq
+import itertools
+
 from pyramid.threadlocal import manager
 from sqlalchemy.util import LRUCache
 import transaction.interfaces
@@ -20,11 +23,13 @@ class ManagerLRUCache(object):
             return None
         threadlocals = manager.stack[0]
         if self.name not in threadlocals:
-            registry = threadlocals['registry']
-            capacity = int(registry.settings.get(self.name + '.capacity', self.default_capacity))
-            threadlocals[self.name] = LRUCache(capacity, self.threshold)
+            threadlocals[self.name] = self._new_cache(threadlocals['registry'])
         return threadlocals[self.name]
 
+    def _new_cache(self, registry):
+        capacity = int(registry.settings.get(self.name + '.capacity', self.default_capacity))
+        return LRUCache(capacity, self.threshold)
+
     def get(self, key, default=None):
         cache = self.cache
         if cache is None:
@@ -64,3 +69,144 @@ class ManagerLRUCache(object):
 
     def newTransaction(self, transaction):
         pass
+
+
+def estimate_size(value):
+    """ Rough size in bytes of a JSON-like value (dicts, lists, sets, tuples, strings, numbers) as
+        serialized, without serializing it
+    """
+    size = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            size += len(value) + 2
+        elif isinstance(value, dict):
+            size += 2
+            for key, item in value.items():
+                size += (len(key) if isinstance(key, str) else 8) + 4
+                stack.append(item)
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            size += 2 + len(value)
+            stack.extend(value)
+        else:
+            size += 8
+    return size
+
+
+class GreedyDualSizeCache(object):
+    """
+    Cache bounded by the estimated size in bytes of its values (and optionally by a number of
+    entries), evicting by GreedyDual-Size: an entry is worth its cost (e.g. how long its value took
+    to compute) per byte, on top of the worth of the last evicted entry when it was last used. So
+    entries that are cheap to recompute for their size go first, while ones unused for a while
+    age out however costly they were.
+    """
+    # outdated heap records kept before the heap is rebuilt, per entry
+    HEAP_SLACK = 2
+
+    def __init__(self, max_bytes, capacity=None):
+        self.max_bytes = max_bytes
+        self.capacity = capacity
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._inflation = 0.0
+        self._entries = {}  # key -> [value, size, cost, priority, serial]
+        self._heap = []  # (priority, serial, key), outdated once the entry has another serial
+        self._serial = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        self._prioritize(key, entry)
+        return entry[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry[1]
+
+    def put(self, key, value, cost=0, size=None):
+        """ Caches value, which took cost to compute and has size bytes (estimated if not given).
+            Values larger than the whole cache are not cached. Returns the number of entries evicted.
+        """
+        if key in self._entries:
+            del self[key]
+        size = max(estimate_size(value) if size is None else size, 1)
+        if size > self.max_bytes:
+            return 0
+        evicted = 0
+        while self._entries and (self.size + size > self.max_bytes
+                                 or (self.capacity and len(self._entries) >= self.capacity)):
+            self._evict()
+            evicted += 1
+        entry = self._entries[key] = [value, size, cost, None, None]
+        self.size += size
+        self._prioritize(key, entry)
+        return evicted
+
+    def _prioritize(self, key, entry):
+        entry[3] = self._inflation + entry[2] / entry[1]
+        entry[4] = next(self._serial)
+        heapq.heappush(self._heap, (entry[3], entry[4], key))
+        if len(self._heap) > self.HEAP_SLACK * len(self._entries) + 64:
+            self._heap = [(entry[3], entry[4], key) for key, entry in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def _evict(self):
+        while True:
+            priority, serial, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry[4] == serial:
+                break
+        del self[key]
+        self._inflation = priority
+        self.evictions += 1
+
+
+class ManagerGreedyDualCache(ManagerLRUCache):
+    """ Per-transaction GreedyDualSizeCache, see ManagerLRUCache. Override max_bytes and capacity
+        (entries, unbounded by default) in settings.
+    """
+    def __init__(self, name, default_max_bytes=64 * 1024 * 1024, default_capacity=None):
+        super().__init__(name, default_capacity)
+        self.default_max_bytes = default_max_bytes
+
+    def _new_cache(self, registry):
+        max_bytes = int(registry.settings.get(self.name + '.max_bytes', self.default_max_bytes))
+        capacity = registry.settings.get(self.name + '.capacity', self.default_capacity)
+        return GreedyDualSizeCache(max_bytes, int(capacity) if capacity else None)
+
+    @property
+    def size(self):
+        cache = self.cache
+        return 0 if cache is None else cache.size
+
+    def put(self, key, value, cost=0, size=None):
+        """ Caches value, which took cost (e.g. seconds) to compute and has size bytes (estimated if not
+            given). Returns the number of entries evicted.
+        """
+        cache = self.cache
+        if cache is None:
+            return 0
+        return cache.put(key, value, cost, size)
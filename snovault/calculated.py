@@ -1,17 +1,23 @@
 from __future__ import absolute_import
+import collections
+import time
 import venusian
 from pyramid.decorator import reify
 from pyramid.traversal import find_root
+from pyramid.view import view_config
 from types import MethodType
 from .interfaces import (
     CALCULATED_PROPERTIES,
     CONNECTION,
 )
+from .util import debug_log, get_root_request
 
 
 def includeme(config):
     config.registry[CALCULATED_PROPERTIES] = CalculatedProperties()
     config.add_directive('add_calculated_property', add_calculated_property)
+    config.add_route('calculated_property_stats', '/calculated-property-stats')
+    config.scan(__name__)
 
 
 class ItemNamespace(object):
@@ -76,8 +82,10 @@ class ItemNamespace(object):
             return result
 
         start = 1 if isinstance(fn, MethodType) else 0
-        # Not using inspect.getargspec as it is slow
-        args = fn.__code__.co_varnames[start:fn.__code__.co_argcount]
+        key = (fn.__code__, start)
+        args = _ARG_NAMES.get(key)
+        if args is None:
+            args = _ARG_NAMES[key] = _arg_names(fn.__code__, start)
         kw = {}
         for name in args:
             try:
@@ -89,26 +97,73 @@ class ItemNamespace(object):
         return result
 
 
+# (code object, first argument) -> names of the arguments calculated property functions take
+_ARG_NAMES = {}
+
+
+def _arg_names(code, start):
+    # Not using inspect.getargspec as it is slow
+    return code.co_varnames[start:code.co_argcount]
+
+
 class CalculatedProperties(object):
     def __init__(self):
         self.category_cls_props = {}
+        # (category, class) -> (properties, `define` properties), computed once per class
+        self._tables = {}
+        # per (type name, property name) of this process: times computed, time spent computing
+        # (including what the property embeds) and times skipped as not required
+        self.computed = collections.Counter()
+        self.time = collections.Counter()
+        self.skipped = collections.Counter()
 
     def register_prop(self, fn, name, context, condition=None, schema=None,
                       attr=None, define=False, category='object'):
         prop = CalculatedProperty(fn, name, attr, condition, schema, define)
         cls_props = self.category_cls_props.setdefault(category, {})
         cls_props.setdefault(context, {})[name] = prop
+        self._tables.clear()
 
-    def props_for(self, context, category='object'):
-        if isinstance(context, type):
-            cls = context
-        else:
-            cls = type(context)
+    def _collect_props(self, cls, category):
         props = {}
         cls_props = self.category_cls_props.get(category, {})
         for base in reversed(cls.mro()):
             props.update(cls_props.get(base, {}))
-        return props
+        return props, {name: prop for name, prop in props.items() if prop.define}
+
+    def table_for(self, context, category='object'):
+        """ The properties of (the class of) context in category and those of them that are `define`d.
+            Computed once per class; these are shared, so must not be changed.
+        """
+        cls = context if isinstance(context, type) else type(context)
+        table = self._tables.get((category, cls))
+        if table is None:
+            table = self._tables[category, cls] = self._collect_props(cls, category)
+        return table
+
+    def props_for(self, context, category='object'):
+        return self.table_for(context, category)[0]
+
+    def compute(self, prop, namespace, type_name):
+        """ Value of prop in namespace, counting what it cost """
+        started = time.perf_counter()
+        try:
+            return prop(namespace)
+        finally:
+            key = (type_name, prop.name)
+            self.computed[key] += 1
+            self.time[key] += time.perf_counter() - started
+
+    def stats(self, limit=50):
+        """ Costs of the `limit` calculated properties that took longest to compute in all """
+        keys = sorted(self.computed.keys() | self.skipped.keys(), key=lambda key: self.time[key], reverse=True)
+        return [{
+            'type': type_name,
+            'name': name,
+            'computed': self.computed[type_name, name],
+            'skipped': self.skipped[type_name, name],
+            'time': round(self.time[type_name, name], 6),
+        } for type_name, name in keys[:limit]]
 
 
 class CalculatedProperty(object):
@@ -182,17 +237,43 @@ def calculated_property(**settings):
     return decorate
 
 
-def calculate_properties(context, request, ns=None, category='object'):
+def calculate_properties(context, request, ns=None, category='object', fields=None):
+    """ Computes the calculated properties of context in category, leaving out those that are None.
+        If fields (a collection of field names) is given, only calculated properties among them are
+        computed; properties they depend on (`define`) are still computed when used.
+    """
     calculated_properties = request.registry[CALCULATED_PROPERTIES]
-    props = calculated_properties.props_for(context, category)
-    defined = {name: prop for name, prop in props.items() if prop.define}
+    props, defined = calculated_properties.table_for(context, category)
+    type_name = context.__name__ if isinstance(context, type) else type(context).__name__
+    if fields is not None:
+        for name in props.keys() - fields:
+            calculated_properties.skipped[type_name, name] += 1
+        props = {name: prop for name, prop in props.items() if name in fields}
     if isinstance(context, type):
         context = None
     namespace = ItemNamespace(context, request, defined, ns)
-    return {
+    started = time.perf_counter()
+    result = {
         name: value
         for name, value in (
-            (name, prop(namespace))
+            (name, calculated_properties.compute(prop, namespace, type_name))
             for name, prop in props.items()
         ) if value is not None
     }
+    root_request = get_root_request()
+    stats = getattr(root_request, '_stats', None)
+    if stats is not None:
+        stats['calculated_count'] = stats.get('calculated_count', 0) + len(props)
+        stats['calculated_time'] = stats.get('calculated_time', 0) + int((time.perf_counter() - started) * 1e6)
+    return result
+
+
+@view_config(route_name='calculated_property_stats', request_method='GET', permission='index')
+@debug_log
+def calculated_property_stats(context, request):
+    """ Calculated properties of this process that took longest to compute (limit=<n>, default 50) """
+    try:
+        limit = int(request.params.get('limit', 50))
+    except ValueError:
+        limit = 50
+    return {'@graph': request.registry[CALCULATED_PROPERTIES].stats(limit)}
@@ -0,0 +1,93 @@
+"""
+Incrementally moves non-current propsheet rows (old revisions) out of the `propsheets`
+table and into `propsheets_archive`. Current versions of items are never moved, and the
+revision history view reads across both tables, so this can be run against a live DB.
+
+Each batch is committed separately, so the command can be interrupted and re-run safely.
+"""
+
+import argparse
+import logging
+import structlog
+import transaction
+
+from dcicutils.env_utils import is_stg_or_prd_env
+from pyramid.paster import get_app
+from .. import configure_dbsession
+from ..interfaces import STORAGE
+
+
+logger = structlog.getLogger(__name__)
+EPILOG = __doc__
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def archive_revisions(app, before_sid=None, batch_size=DEFAULT_BATCH_SIZE, max_batches=None, allow_prod=True):
+    """
+    Archives non-current propsheet rows with a sid lower than `before_sid` in batches,
+    committing after each one.
+
+    :param app: app to access settings from, either a testapp (testapp.app.registry) or regular app(.registry)
+    :param before_sid: only revisions older than this sid are archived; defaults to the current max sid
+    :param batch_size: number of rows moved per transaction
+    :param max_batches: stop after this many batches (None means run until nothing is left)
+    :param allow_prod: bool whether to allow run on staging/prod envs
+    :return: total number of rows archived, or None if the command refused to run
+    """
+    if not hasattr(app, 'registry'):
+        app = app.app
+    env = app.registry.settings.get('env.name')
+    if env and is_stg_or_prd_env(env) and not allow_prod:
+        logger.error('archive-revisions: refusing to run on %s without --allow-prod' % env)
+        return None
+
+    storage = app.registry[STORAGE]
+    if before_sid is None:
+        before_sid = storage.write.get_max_sid()
+    total = batches = 0
+    while max_batches is None or batches < max_batches:
+        try:
+            moved = storage.archive_revisions(before_sid, batch_size=batch_size)
+            transaction.commit()
+        except Exception as e:
+            logger.error('archive-revisions: failed after archiving %s rows: %s' % (total, e))
+            transaction.abort()
+            raise
+        if not moved:
+            break
+        total += moved
+        batches += 1
+        logger.info('archive-revisions: archived %s rows (%s total)' % (moved, total))
+    return total
+
+
+def main():
+    """ Entry point for this command """
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(  # noqa - PyCharm wrongly thinks the formatter_class is specified wrong here.
+        description='Move old item revisions into the propsheets archive table',
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('config_uri', help='path to configfile')
+    parser.add_argument('--app-name', help='Pyramid app name in configfile')
+    parser.add_argument('--before-sid', type=int, default=None,
+                        help='Only archive revisions older than this sid (default: current max sid)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of rows moved per transaction')
+    parser.add_argument('--max-batches', type=int, default=None,
+                        help='Stop after this many batches (default: run to completion)')
+    parser.add_argument('--allow-prod', action='store_true', default=False,
+                        help='Allow running this command on an env that is staging or prod')
+    args = parser.parse_args()
+
+    app = get_app(args.config_uri, args.app_name)
+    configure_dbsession(app)
+    archive_revisions(app, before_sid=args.before_sid, batch_size=args.batch_size,
+                      max_batches=args.max_batches, allow_prod=args.allow_prod)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 from pyramid.decorator import reify
 from uuid import UUID
-from .cache import ManagerLRUCache
+from .cache import ManagerGreedyDualCache, ManagerLRUCache
 from .interfaces import (
     CONNECTION,
     STORAGE,
@@ -34,8 +34,11 @@ class Connection(object):
         self.registry = registry
         self.item_cache = ManagerLRUCache('snovault.connection.item_cache', 1000)
         self.unique_key_cache = ManagerLRUCache('snovault.connection.key_cache', 1000)
-        embed_cache_capacity = int(registry.settings.get('embed_cache.capacity', 2000))
-        self.embed_cache = ManagerLRUCache('snovault.connection.embed_cache', embed_cache_capacity)
+        # bounded by the estimated size of embedded results, and by a number of them only if configured
+        embed_cache_max_bytes = int(registry.settings.get('embed_cache.max_bytes', 64 * 1024 * 1024))
+        embed_cache_capacity = registry.settings.get('embed_cache.capacity')
+        self.embed_cache = ManagerGreedyDualCache('snovault.connection.embed_cache', embed_cache_max_bytes,
+                                                  int(embed_cache_capacity) if embed_cache_capacity else None)
 
     @reify
     def storage(self):
@@ -65,30 +68,22 @@ class Connection(object):
         model.used_for(item)
         return item
 
-    def get_by_uuid(self, uuid, default=None, datastore=None):
-        """
-        Gets model from storage and returns Item. Uses item cache.
-        Get the item by uuid (will not work for other name keys)
-        """
+    @staticmethod
+    def _normalize_uuid(uuid):
+        """ String form of a uuid (or @id ending in one), None if it is not one """
         if isinstance(uuid, str):  # formerly basestring
             # some times we get @id type things here
             uuid = uuid.strip("/").split("/")[-1]
             try:
                 uuid = UUID(uuid)
             except ValueError:
-                return default
+                return None
         elif not isinstance(uuid, UUID):
             raise TypeError(uuid)
+        return str(uuid)
 
-        uuid = str(uuid)
-        cached = self.item_cache.get(uuid)
-        if cached is not None:
-            return cached
-
-        model = self.storage.get_by_uuid(uuid, datastore=datastore)
-        if model is None:
-            return default
-
+    def _item_for(self, model):
+        """ Builds the Item of a storage model and caches it """
         try:
             Item = self.types.by_item_type[model.item_type].factory
         except KeyError:
@@ -97,9 +92,65 @@ class Connection(object):
         # build Item from storage model
         item = Item(self.registry, model)
         model.used_for(item)
-        self.item_cache[uuid] = item
+        self.item_cache[str(model.uuid)] = item
         return item
 
+    def _cache_name_key(self, item):
+        """
+        Caches the unique key value that names item in its resource path (see Item.__name__),
+        so traversing that path (Collection.get) finds item without looking the key up
+        """
+        unique_key = item.collection.unique_key
+        name = item.__name__
+        if unique_key is None or name == item.uuid:
+            return
+        if name in item.unique_keys(item.properties).get(unique_key, ()):
+            self.unique_key_cache[(unique_key, name)] = item.uuid
+
+    def get_by_uuid(self, uuid, default=None, datastore=None):
+        """
+        Gets model from storage and returns Item. Uses item cache.
+        Get the item by uuid (will not work for other name keys)
+        """
+        uuid = self._normalize_uuid(uuid)
+        if uuid is None:
+            return default
+
+        cached = self.item_cache.get(uuid)
+        if cached is not None:
+            return cached
+
+        model = self.storage.get_by_uuid(uuid, datastore=datastore)
+        if model is None:
+            return default
+        return self._item_for(model)
+
+    def get_by_uuids(self, uuids, datastore=None):
+        """
+        Gets the Items of many uuids, as get_by_uuid does, but loads those not in the
+        item cache from storage all at once (see PickStorage.get_by_uuids), so they
+        can then be looked up one by one without a round trip each. The unique keys
+        naming those items in their resource paths are cached too.
+        Returns the Items found, in the order of uuids.
+        """
+        uuids = [uuid for uuid in map(self._normalize_uuid, uuids) if uuid is not None]
+        items = {}
+        missing = []
+        for uuid in uuids:
+            cached = self.item_cache.get(uuid)
+            if cached is not None:
+                items[uuid] = cached
+            elif uuid not in items:
+                items[uuid] = None
+                missing.append(uuid)
+        if len(missing) == 1:
+            items[missing[0]] = self.get_by_uuid(missing[0], datastore=datastore)
+        elif missing:
+            for model in self.storage.get_by_uuids(missing, datastore=datastore):
+                item = items[str(model.uuid)] = self._item_for(model)
+                self._cache_name_key(item)
+        return [items[uuid] for uuid in uuids if items[uuid] is not None]
+
     def get_by_unique_key(self, unique_key, name, default=None, datastore=None, item_type=None):
         """
         Gets model from storage and returns Item.
@@ -119,20 +170,10 @@ class Connection(object):
 
         uuid = model.uuid
         self.unique_key_cache[pkey] = uuid
-        cached = self.item_cache.get(uuid)
+        cached = self.item_cache.get(str(uuid))
         if cached is not None:
             return cached
-
-        try:
-            Item = self.types.by_item_type[model.item_type].factory
-        except KeyError:
-            raise UnknownItemTypeError(model.item_type)
-
-        # build Item from storage model
-        item = Item(self.registry, model)
-        model.used_for(item)
-        self.item_cache[uuid] = item
-        return item
+        return self._item_for(model)
 
     def get_rev_links(self, model, rel, *types):
         item_types = [self.types[t].item_type for t in types]
@@ -3,10 +3,10 @@ from uuid import (
     UUID,
     uuid4,
 )
-from copy import deepcopy
 import transaction
 from pyramid.exceptions import HTTPForbidden
-from pyramid.httpexceptions import HTTPNotFound
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from pyramid.response import Response
 from pyramid.settings import asbool
 from pyramid.view import view_config
 from structlog import get_logger
@@ -25,7 +25,7 @@ from .resources import (
     Item,
 )
 from .schema_validation import parse_skip_links
-from .util import debug_log
+from .util import NDJSON, debug_log, json_patch
 from .validation import ValidationFailure
 from .validators import (
     no_validate_item_content_patch,
@@ -42,6 +42,9 @@ log = get_logger(__name__)
 
 def includeme(config):
     config.include('.calculated')
+    # when a list, writes made during the request are collected here and queued for
+    # indexing together after commit, instead of one after-commit hook per item
+    config.add_request_method(lambda request: None, '_indexing_batch', reify=True)
     config.scan(__name__)
 
 
@@ -56,11 +59,14 @@ def extract_and_populate_deleted_fields(request, body: dict):
             body[deleted_field] = ''
 
 
-def build_diff_from_request(context, request):
-    """ Unpacks request.body as JSON and computes a diff """
+def build_diff_from_request(context, request, body=None):
+    """ Unpacks request.body (or the given body) as JSON and computes a diff """
     try:
         item_type = context.type_info.name
-        body = json.loads(request.body)
+        if body is None:
+            body = json.loads(request.body)
+        else:
+            body = dict(body)
         extract_and_populate_deleted_fields(request, body)
         dm = DiffManager(label=item_type)
     except json.decoder.JSONDecodeError:
@@ -100,20 +106,21 @@ def create_item(type_info, request, properties, sheets=None):
     if telemetry_id:
         to_queue['telemetry_id'] = telemetry_id
     log.info(event='add_to_indexing_queue', **to_queue)
-    txn.addAfterCommitHook(add_to_indexing_queue, args=(request, to_queue, 'add',))
+    queue_for_indexing(request, to_queue, 'add', txn)
     registry.notify(Created(item, request))
 
     return item
 
 
-def update_item(context, request, properties, sheets=None):
+def update_item(context, request, properties, sheets=None, body=None):
     '''
     Updates retrieved-from-database `context` (Item class instance) with
     `properties` (dict) in database, sends 'BeforeModified' & 'AfterModified'
     notifications, which can be subscribed to using the
     @subscriber(BeforeModified) or @subscriber(AfterModified) decorators
 
-    Queues the updated item for indexing using a hook on the current transaction
+    Queues the updated item for indexing using a hook on the current transaction.
+    The indexing diff is computed from `body` if given, otherwise from request.body
     '''
     txn = transaction.get()
     registry = request.registry
@@ -121,17 +128,30 @@ def update_item(context, request, properties, sheets=None):
     registry.notify(BeforeModified(context, request))
     context.update(item_properties, sheets)
     # set up hook for queueing indexing
-    diff = build_diff_from_request(context, request)
+    diff = build_diff_from_request(context, request, body)
     to_queue = {'uuid': str(context.uuid), 'sid': context.sid}
     if diff is not None:
         to_queue['diff'] = diff
     telemetry_id = request.params.get('telemetry_id', None)
     if telemetry_id:
         to_queue['telemetry_id'] = telemetry_id
-    txn.addAfterCommitHook(add_to_indexing_queue, args=(request, to_queue, 'edit',))
+    queue_for_indexing(request, to_queue, 'edit', txn)
     registry.notify(AfterModified(context, request))
 
 
+def queue_for_indexing(request, to_queue, edit_or_add, txn=None):
+    '''
+    Queues `to_queue` for indexing once the transaction commits. If the request
+    is collecting writes in request._indexing_batch (see batch_views.py), the
+    item is added there instead, to be queued together with the rest of the batch
+    '''
+    if request._indexing_batch is not None:
+        request._indexing_batch.append((to_queue, edit_or_add))
+        return
+    txn = txn or transaction.get()
+    txn.addAfterCommitHook(add_to_indexing_queue, args=(request, to_queue, edit_or_add,))
+
+
 def delete_item(context, request):
     """
     Sets the status of an item to deleted and triggers indexing
@@ -382,12 +402,33 @@ def validation_errors_property(context, request):
     return request.embed(path, '@@validation-errors')['validation_errors']
 
 
-def get_item_revision_history(request, uuid, resolve_emails=False):
+# page size used when streaming revision history as NDJSON
+REVISION_HISTORY_PAGE_SIZE = 100
+
+
+def _resolve_revision_emails(request, revisions, user_cache):
+    """ Replaces last_modified.modified_by of the given revisions (in place) with
+        the email of the user, caching user lookups in user_cache.
+    """
+    for revision in revisions:
+        last_modified = revision.get('last_modified', {})
+        modified_by = last_modified.get('modified_by', None)
+        if modified_by:
+            user = user_cache.get(modified_by)
+            if not user:
+                user = request.embed(modified_by, frame='raw')
+                user_cache[modified_by] = user
+            revision['last_modified']['modified_by'] = user['email']
+
+
+def get_item_revision_history(request, uuid, resolve_emails=False, after_sid=None, limit=None):
     """ Computes the revision history of the given item from the DB.
         The more edits an item has undergone, the more expensive this
-        operation is.
+        operation is, so callers with long histories should page through
+        it with `after_sid` and `limit`.
     """
-    revisions = deepcopy(request.registry[STORAGE].revision_history(uuid=uuid))
+    # storage already returns copies of the revision properties
+    revisions = request.registry[STORAGE].revision_history(uuid=uuid, after_sid=after_sid, limit=limit)
     # Resolve last_modified
     # NOTE: last_modified is a server_default present in our applications that
     # use snovault. This code is intended to resolve the user email of the last_modified
@@ -398,19 +439,75 @@ def get_item_revision_history(request, uuid, resolve_emails=False):
     # rely on the user email. It will now only pull this when requested via API
     # and an extra parameter is passed.
     if resolve_emails:
-        user_cache = {}
-        for revision in revisions:
-            last_modified = revision.get('last_modified', {})
-            modified_by = last_modified.get('modified_by', None)
-            if modified_by:
-                user = user_cache.get(modified_by)
-                if not user:
-                    user = request.embed(modified_by, frame='raw')
-                    user_cache[modified_by] = user
-                revision['last_modified']['modified_by'] = user['email']
+        _resolve_revision_emails(request, revisions, {})
     return revisions
 
 
+def iter_item_revision_history(request, uuid, resolve_emails=False, after_sid=None, limit=None,
+                               page_size=None):
+    """ Generator over (at most `limit` of) the revision history of the given item, reading it
+        from the DB one keyset page at a time so memory use is bounded by page_size
+        (default REVISION_HISTORY_PAGE_SIZE).
+    """
+    page_size = page_size or REVISION_HISTORY_PAGE_SIZE
+    user_cache = {}
+    while limit is None or limit > 0:
+        page_limit = page_size if limit is None else min(page_size, limit)
+        revisions = request.registry[STORAGE].revision_history(uuid=uuid, after_sid=after_sid, limit=page_limit)
+        if resolve_emails:
+            _resolve_revision_emails(request, revisions, user_cache)
+        yield from revisions
+        if len(revisions) < page_limit:
+            return
+        if limit is not None:
+            limit -= len(revisions)
+        after_sid = revisions[-1]['sid']
+
+
+def diff_revisions(revisions):
+    """ Generator that yields the first of the given revisions in full and every
+        following one as {'sid': <sid>, 'patch': <JSON patch against the previous revision>}.
+    """
+    previous = None
+    for revision in revisions:
+        if previous is None:
+            yield revision
+        else:
+            yield {
+                'sid': revision['sid'],
+                'patch': [op for op in json_patch(previous, revision) if op['path'] != '/sid']
+            }
+        previous = revision
+
+
+def _stream_revision_history(request, uuid, resolve_emails, after_sid, limit, diff):
+    """ app_iter for the NDJSON form of @@revision-history. The view's transaction
+        is over by the time the response body is consumed, so pages are read
+        under a transaction of their own.
+    """
+    with transaction.manager:
+        revisions = iter_item_revision_history(request, uuid, resolve_emails=resolve_emails, after_sid=after_sid,
+                                               limit=limit)
+        if diff:
+            revisions = diff_revisions(revisions)
+        for revision in revisions:
+            yield (json.dumps(revision) + '\n').encode('utf-8')
+
+
+def _int_param(request, name):
+    """ Parses an optional non-negative integer query parameter """
+    value = request.params.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise HTTPBadRequest(f'{name} must be an integer, got {value!r}')
+    if value < 0:
+        raise HTTPBadRequest(f'{name} must not be negative, got {value!r}')
+    return value
+
+
 @view_config(context=Item, permission='edit', request_method='GET',
              name='revision-history')
 @debug_log
@@ -418,6 +515,15 @@ def item_view_revision_history(context, request):
     """ View config for viewing an item's revision history.
         For now, to view revision history the caller must have EDIT permissions.
 
+        Query parameters:
+            after_sid: only return revisions newer than this sid
+            limit: return at most this many revisions; `next_after_sid` is set
+                   in the response when there may be more
+            diff: if true, revisions after the first one (of the page) are
+                  returned as JSON patches against their predecessor
+            format: 'ndjson' streams one revision per line instead (at most `limit` of them,
+                    without `next_after_sid`)
+
         Types that opt out of revision-history tracking (track_revisions = False)
         do not retain prior propsheet rows, so there is no honest history to
         return. Rather than silently returning only the current version (which
@@ -430,8 +536,20 @@ def item_view_revision_history(context, request):
         )
     uuid = str(context.uuid)
     resolve_emails = asbool(request.GET.get('resolve_emails', False))
-    revisions = get_item_revision_history(request, uuid, resolve_emails=resolve_emails)
-    return {
+    after_sid = _int_param(request, 'after_sid')
+    limit = _int_param(request, 'limit')
+    diff = asbool(request.GET.get('diff', False))
+    if request.GET.get('format') == 'ndjson':
+        return Response(
+            content_type=NDJSON,
+            app_iter=_stream_revision_history(request, uuid, resolve_emails, after_sid, limit, diff)
+        )
+    revisions = get_item_revision_history(request, uuid, resolve_emails=resolve_emails,
+                                          after_sid=after_sid, limit=limit)
+    result = {
         'uuid': uuid,
-        'revisions': revisions
+        'revisions': list(diff_revisions(revisions)) if diff else revisions
     }
+    if limit and len(revisions) == limit:
+        result['next_after_sid'] = revisions[-1]['sid']
+    return result
@@ -1,11 +1,14 @@
 import re
+from copy import deepcopy
 from uuid import UUID
 
 from dcicutils.misc_utils import ignored
 from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden
 from pyramid.security import Authenticated
+from pyramid.settings import asbool
 from pyramid.traversal import find_resource
 from pyramid.view import view_config
+from .interfaces import CONNECTION
 from .util import debug_log
 
 ATID_PATTERN = re.compile("/[a-zA-Z-]+/[a-zA-Z0-9-_:]+/")
@@ -26,6 +29,8 @@ KEYS_TO_IGNORE = [
 ]
 FORBIDDEN_MSG = {"error": "no view permissions"}
 DATABASE_ITEM_KEY = "@type"  # Key specific to JSON objects that are CGAP items
+MAX_IDS = 5
+MAX_BATCH_IDS = 100
 
 
 def includeme(config):
@@ -38,7 +43,7 @@ class CustomEmbed:
     Class to handle custom embedding for /embed API.
     """
 
-    def __init__(self, request, item, embed_props):
+    def __init__(self, request, item, embed_props, objects=None, nested_fields=None):
         self.request = request
         self.ignored_embeds = embed_props.get("ignored_embeds", [])
         self.desired_embeds = embed_props.get("desired_embeds", [])
@@ -46,9 +51,10 @@ class CustomEmbed:
         self.requested_fields = embed_props.get("requested_fields", [])
 
         self.cache = {}
+        self.objects = objects
         self.invalid_ids = []
         if self.requested_fields:
-            self.nested_fields = self.fields_to_nested_dict()
+            self.nested_fields = nested_fields or self.fields_to_nested_dict()
             item = self.user_embed(item, initial_item=True)
             self.result = self.field_embed(item, self.nested_fields, initial_item=True)
         else:
@@ -103,7 +109,7 @@ class CustomEmbed:
         if not item_id.startswith("/"):
             item_id = "/" + item_id
         try:
-            item = self.request.embed(item_id, "@@object", as_user=True)
+            item = self.get_object(item_id)
         except HTTPForbidden:
             if not initial_item:
                 item = FORBIDDEN_MSG
@@ -113,6 +119,33 @@ class CustomEmbed:
             item = self.add_actions(item)
         return item
 
+    def get_object(self, item_id):
+        """
+        Get the object view of the given item as the user, raising
+        HTTPForbidden or KeyError as the request's embed method does.
+
+        If given `objects` (shared by the embeds of a batch, see
+        CustomEmbedBatch), views are kept there by @id, so each is
+        rendered once per batch. Copies are returned, as embedding
+        changes them.
+
+        :param item_id: string uuid or @id
+        :return: dict item in object view
+        """
+        if self.objects is None:
+            return self.request.embed(item_id, "@@object", as_user=True)
+        if item_id not in self.objects:
+            try:
+                self.objects[item_id] = self.request.embed(item_id, "@@object", as_user=True)
+            except HTTPForbidden:
+                self.objects[item_id] = HTTPForbidden
+            except KeyError:
+                self.objects[item_id] = KeyError
+        item = self.objects[item_id]
+        if item is HTTPForbidden or item is KeyError:
+            raise item(item_id)
+        return deepcopy(item)
+
     def minimal_embed(self, item_id):
         """
         Embed minimal item info. Helpful for preventing recursions for
@@ -334,6 +367,28 @@ class CustomEmbed:
         return item
 
 
+class CustomEmbedBatch:
+    """
+    Custom embeds of many ids for the /embed API in batch mode, keyed
+    by id. Items given by uuid are loaded all at once, the requested
+    fields are parsed once, and object views are rendered once for
+    all ids. Each id is otherwise embedded as CustomEmbed does, with
+    the same permission checks.
+    """
+
+    def __init__(self, request, ids, embed_props):
+        self.results = {}
+        self.invalid_ids = []
+        request.registry[CONNECTION].get_by_uuids(ids)
+        objects = {}
+        nested_fields = None
+        for item_id in ids:
+            item_embed = CustomEmbed(request, item_id, embed_props, objects=objects, nested_fields=nested_fields)
+            nested_fields = getattr(item_embed, "nested_fields", None)
+            self.results[item_id] = item_embed.result
+            self.invalid_ids += item_embed.invalid_ids
+
+
 @view_config(
     route_name="embed", request_method="POST", effective_principals=Authenticated
 )
@@ -344,9 +399,13 @@ def embed(context, request):
     parameters provided, attempt to return object with embedding done
     per default parameters.
 
+    In batch mode (batch=true), up to MAX_BATCH_IDS ids are embedded
+    together (see CustomEmbedBatch) and results are keyed by id.
+
     :param context: pyramid request context
     :param request: pyramid request object
-    :return results: list of dicts of custom-embedded views of items
+    :return results: list of dicts of custom-embedded views of items, or
+        dict of them by id in batch mode
     """
     ids = []
     ignored_embeds = []
@@ -355,6 +414,7 @@ def embed(context, request):
     results = []
     invalid_ids = []
     embed_depth = 4  # Arbritary standard depth to search.
+    batch = False
     ignored(context)
     if request.GET:
         ids += request.GET.dict_of_lists().get("id", [])
@@ -362,17 +422,20 @@ def embed(context, request):
         ignored_embeds += request.GET.dict_of_lists().get("ignored", [])
         desired_embeds += request.GET.dict_of_lists().get("desired", [])
         requested_fields += request.GET.dict_of_lists().get("field", [])
+        batch = asbool(request.GET.get("batch", batch))
     elif request.json:
         ids += request.json.get("ids", [])
         ignored_embeds = request.json.get("ignored", [])
         desired_embeds = request.json.get("desired", [])
         embed_depth = request.json.get("depth", embed_depth)
         requested_fields = request.json.get("fields", [])
+        batch = asbool(request.json.get("batch", batch))
     ids = list(set(ids))
-    if len(ids) > 5:
+    max_ids = MAX_BATCH_IDS if batch else MAX_IDS
+    if len(ids) > max_ids:
         raise HTTPBadRequest(
             "Too many items were given for embedding."
-            " Please limit to less than 5 items."
+            " Please limit to less than %s items." % max_ids
         )
     if not ids:
         raise HTTPBadRequest("No item identifier was provided.")
@@ -382,6 +445,15 @@ def embed(context, request):
         "embed_depth": embed_depth,
         "requested_fields": requested_fields,
     }
+    if batch:
+        item_embeds = CustomEmbedBatch(request, ids, embed_props)
+        invalid_ids += item_embeds.invalid_ids
+        invalid_ids += [item for item in item_embeds.results.values() if isinstance(item, str)]
+        if invalid_ids:
+            raise HTTPBadRequest(
+                "The following IDs were invalid: %s" % ", ".join(invalid_ids)
+            )
+        return item_embeds.results
     for item_id in ids:
         item_embed = CustomEmbed(request, item_id, embed_props)
         results.append(item_embed.result)
@@ -7,7 +7,8 @@ from elasticsearch.serializer import SerializationError
 from pyramid.settings import asbool
 from ..json_renderer import json_renderer
 from ..util import get_root_request
-from .interfaces import APP_FACTORY, ELASTIC_SEARCH
+from .index_generations import IndexGenerations
+from .interfaces import APP_FACTORY, ELASTIC_SEARCH, INDEX_GENERATIONS
 
 
 exported(
@@ -44,6 +45,8 @@ def includeme(config):
     config.registry[ELASTIC_SEARCH] = create_es_client(address,
                                                        use_aws_auth=use_aws_auth,
                                                        **es_options)
+    # bumped on every index write, see index_generations.py
+    config.registry[INDEX_GENERATIONS] = IndexGenerations(config.registry)
 
     config.include('.cached_views')
     config.include('.esstorage')
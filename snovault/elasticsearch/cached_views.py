@@ -53,14 +53,17 @@ def cached_view_embedded(context, request):  # This name duplicates the previous
     if (context.properties_datastore == 'elasticsearch'
             and ('embedded' not in source or request._indexing_view is True)):
         embedded = item_view_embedded(context, request)
+        principals_index = None
     else:
         embedded = source['embedded']
+        # stored by the indexer, missing from documents indexed before it was
+        principals_index = source.get('embedded_principals')
 
     # permission checking on embedded objects
     allowed = set(embedded['principals_allowed']['view'])
     if allowed.isdisjoint(request.effective_principals):
         raise HTTPForbidden()
-    return filter_embedded(embedded, request.effective_principals)
+    return filter_embedded(embedded, request.effective_principals, principals_index)
 
 
 @view_config(context=ICachedItem, permission='view', request_method='GET',
@@ -51,6 +51,7 @@ from .calculated_property_signature import (
     calculated_properties_signature,
 )
 from ..schema_utils import load_schema
+from .index_generations import bump_index_generation
 from .interfaces import ELASTIC_SEARCH, INDEXER_QUEUE
 from ..settings import Settings
 
@@ -468,6 +469,10 @@ def es_mapping(mapping, agg_items_mapping):
                 'ignore_above': KW_IGNORE_ABOVE
             },
             'embedded': mapping,
+            'embedded_principals': {
+                'type': 'object',
+                'enabled': False
+            },
             'object': {
                 'type': 'object',
                 'enabled': False
@@ -907,6 +912,8 @@ def build_index(app, es, index_name, in_type, mapping, uuids_to_index, dry_run,
         log.info(f'MAPPING: new index created for {in_type}', collection=in_type)
     else:
         log.error(f'MAPPING: new index failed for {in_type}', collection=in_type)
+    # the old index is gone either way, so searches on it must not be served from cache
+    bump_index_generation(app.registry, index_name)
 
     # check to debug create-mapping issues and ensure correct mappings
     confirm_mapping(es, index_name, in_type, this_index_record)
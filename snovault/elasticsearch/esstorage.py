@@ -10,6 +10,7 @@ from elasticsearch.helpers import scan
 from uuid import UUID
 from zope.interface import alsoProvides
 from .create_mapping import SEARCH_MAX
+from .index_generations import bump_index_generation
 from .indexer_utils import get_namespaced_index, namespace_index_from_health, find_uuids_for_indexing
 from .interfaces import (
     ELASTIC_SEARCH,
@@ -340,6 +341,7 @@ class ElasticSearchStorage(object):
         index_name = get_namespaced_index(config=self.registry, index=item_type)
         if not self._delete_from_es(es=self.es, rid=rid, index_name=index_name, item_type=item_type):
             return False
+        bump_index_generation(self.registry, index_name)
 
         # queue related items for reindexing if deletion was successful
         self.registry[INDEXER].find_and_queue_secondary_items({rid}, set(), sid=max_sid)
@@ -0,0 +1,100 @@
+import structlog
+import threading
+import time
+
+from ..redis.interfaces import REDIS
+from .interfaces import INDEX_GENERATIONS
+
+
+log = structlog.getLogger(__name__)
+
+
+class IndexGenerations(object):
+    """
+    Generation counters for Elasticsearch indices. A generation is bumped (see `bump`)
+    every time documents of an index are written or deleted, so anything derived from
+    a search on an index (e.g. the search response cache) can be keyed by the
+    generations it was computed at and is never served once the index has changed.
+
+    A single '*' generation is bumped along with every index, for searches on all indices.
+
+    Counters are kept in Redis when the app is configured with `redis.server`, so that
+    writes from indexer processes are seen by every web process. Without Redis they are
+    process-local, which only holds up when indexing happens in the same process (as in
+    tests and local deployments).
+
+    Since writes only become visible to searches once the index refreshes, the time of
+    the last bump is kept too; see `SearchResponseCache.refresh_window`.
+    """
+    ALL = '*'
+    KEY_PREFIX = 'index-generation'
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.namespace = registry.settings.get('indexer.namespace') or ''
+        self._local = {}  # index -> (generation, last bump time)
+        self._lock = threading.Lock()
+
+    @property
+    def redis(self):
+        """ Raw Redis client, or None if generations are process-local """
+        redis = self.registry.get(REDIS)
+        return redis.redis if redis is not None else None
+
+    def _keys(self, index):
+        key = '%s:%s:%s' % (self.namespace, self.KEY_PREFIX, index)
+        return key, key + ':time'
+
+    @classmethod
+    def indices(cls, index_expression):
+        """ Names of the counters that cover an index expression as passed to es.search """
+        if '*' in index_expression:
+            return [cls.ALL]
+        return sorted(set(index_expression.split(',')))
+
+    def bump(self, *indices):
+        """ Marks the given (namespaced) indices as changed. Errors are logged, not raised. """
+        now = time.time()
+        names = set(indices) | {self.ALL}
+        redis = self.redis
+        if redis is None:
+            with self._lock:
+                for name in names:
+                    self._local[name] = (self._local.get(name, (0, 0))[0] + 1, now)
+            return
+        try:
+            pipeline = redis.pipeline(transaction=False)
+            for name in names:
+                generation_key, time_key = self._keys(name)
+                pipeline.incr(generation_key)
+                pipeline.set(time_key, now)
+            pipeline.execute()
+        except Exception as e:
+            log.error('Could not bump index generations for %s: %r' % (sorted(names), e))
+
+    def get(self, index_expression):
+        """
+        Returns (generations, last change time) for the indices of the given expression,
+        or None if they cannot be read.
+        """
+        names = self.indices(index_expression)
+        redis = self.redis
+        if redis is None:
+            with self._lock:
+                values = [self._local.get(name, (0, 0)) for name in names]
+            return tuple(generation for generation, _ in values), max(changed for _, changed in values)
+        try:
+            values = redis.mget([key for name in names for key in self._keys(name)])
+        except Exception as e:
+            log.error('Could not read index generations for %s: %r' % (names, e))
+            return None
+        generations = tuple(int(value or 0) for value in values[0::2])
+        return generations, max(float(value or 0) for value in values[1::2])
+
+
+def bump_index_generation(registry, *indices):
+    """ Bumps the generations of the given indices, if generations are tracked in this app """
+    generations = registry.get(INDEX_GENERATIONS)
+    if generations is not None:
+        generations.bump(*indices)
+
@@ -19,6 +19,7 @@ from ..interfaces import (
     DBSESSION,
     STORAGE
 )
+from .index_generations import bump_index_generation
 from .indexer_utils import get_namespaced_index, find_uuids_for_indexing, filter_invalidation_scope
 from .interfaces import (
     ELASTIC_SEARCH,
@@ -506,6 +507,7 @@ class Indexer(object):
                 break
             else:
                 # success! Do not return an error so item is removed from queue
+                bump_index_generation(self.registry, namespaced_index)
                 duration = timer() - start
                 log.info('Time to index', duration=duration, cat=cat)
                 return
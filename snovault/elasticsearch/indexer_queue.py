@@ -14,10 +14,12 @@ import boto3
 import structlog
 from dcicutils.env_utils import blue_green_mirror_env
 from dcicutils.misc_utils import ignored, RateManager, LockoutManager
+from pyramid.settings import asbool
 from pyramid.view import view_config
 
 from .indexer_utils import get_uuids_for_types
-from .interfaces import INDEXER_QUEUE, INDEXER_QUEUE_MIRROR
+from .interfaces import INDEXER_QUEUE, INDEXER_QUEUE_MIRROR, INDEXER_QUEUE_SENDER
+from .queue_sender import BackgroundQueueSender
 from ..util import debug_log
 
 log = structlog.getLogger(__name__)
@@ -41,6 +43,16 @@ def includeme(config):
         config.registry[INDEXER_QUEUE_MIRROR] = mirror_queue
     else:
         config.registry[INDEXER_QUEUE_MIRROR] = None
+    # opt-in: hand post-commit queue messages to a background thread instead of sending them inline
+    settings = config.registry.settings
+    if asbool(settings.get('indexer.async_queueing', False)):
+        config.registry[INDEXER_QUEUE_SENDER] = BackgroundQueueSender(
+            [config.registry[INDEXER_QUEUE], config.registry[INDEXER_QUEUE_MIRROR]],
+            spool_dir=settings.get('indexer.queue_spool_dir'),
+            flush_interval=float(settings.get('indexer.queue_flush_interval', 0.005)),
+        )
+    else:
+        config.registry[INDEXER_QUEUE_SENDER] = None
     config.scan(__name__)
 
 
@@ -529,7 +541,7 @@ class QueueManager(object):
         """
         return self.queue_targets.get(name.lower(), self.queue_url)
 
-    def send_messages(self, items, target_queue='primary', retries=0):
+    def send_messages(self, items, target_queue='primary', retries=0, max_retries=4):
         """
         Send any number of 'items' as messages to sqs.
         items is a list of dictionaries with the following format:
@@ -546,14 +558,15 @@ class QueueManager(object):
         will be found for these uuids.
 
         Since sending messages is something we want to be fail-proof, retry
-        failed messages automatically up to 4 times.
-        Returns information on messages that failed to queue despite the retries
+        failed messages automatically up to max_retries times.
+        Returns information on messages that failed to queue despite the retries.
+        With max_retries=0, the 'Id' of each failure is the index of its message in items.
         """
         queue_url = self.choose_queue_url(target_queue)
         failed = []
-        for msg_batch in self.chunk_messages(items, self.send_batch_size):
+        for offset, msg_batch in enumerate(self.chunk_messages(items, self.send_batch_size)):
             entries = []
-            for i, msg in enumerate(msg_batch):
+            for i, msg in enumerate(msg_batch, offset * self.send_batch_size):
                 # quick workaround to communicate with old style messages
                 # Id only needs to be unique within this single batch request
                 if isinstance(msg, dict):
@@ -572,7 +585,7 @@ class QueueManager(object):
             )
             failed_messages = response.get('Failed', [])
 
-            if failed_messages and retries < 4:
+            if failed_messages and retries < max_retries:
                 to_retry = []
                 for fail_message in failed_messages:
                     fail_id = fail_message.get('Id')
@@ -582,7 +595,8 @@ class QueueManager(object):
                         continue  # cannot retry this message without an Id
                     to_retry.extend([json.loads(ent['MessageBody']) for ent in entries if ent['Id'] == fail_id])
                 if to_retry:
-                    failed_messages = self.send_messages(to_retry, target_queue, retries=retries+1)
+                    failed_messages = self.send_messages(to_retry, target_queue, retries=retries+1,
+                                                         max_retries=max_retries)
             failed.extend(failed_messages)
         return failed
 
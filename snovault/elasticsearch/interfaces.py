@@ -3,9 +3,11 @@ from zope.interface import Interface
 # Registry tool id
 APP_FACTORY = 'app_factory'
 ELASTIC_SEARCH = 'elasticsearch'
+INDEX_GENERATIONS = 'index_generations'
 INDEXER = 'indexer'
 INDEXER_QUEUE = 'indexer_queue'
 INDEXER_QUEUE_MIRROR = 'indexer_queue_mirror'
+INDEXER_QUEUE_SENDER = 'indexer_queue_sender'
 INVALIDATION_SCOPE_ENABLED = 'invalidation_scope.enabled'
 
 
@@ -0,0 +1,289 @@
+import atexit
+import collections
+import fcntl
+import heapq
+import itertools
+import json
+import os
+import structlog
+import threading
+import time
+import uuid
+
+
+log = structlog.getLogger(__name__)
+
+
+class BackgroundQueueSender(object):
+    """
+    Sends indexer queue messages from a background thread, so that the after-commit
+    hooks of write requests (see invalidation.py) only have to hand their messages
+    over instead of waiting on an SQS round trip.
+
+    Messages are buffered and sent in batches of up to `batch_size` (SQS allows at
+    most 10 per call) as soon as a batch is full or `flush_interval` seconds have
+    passed. Only the messages that failed (all of them, if sending raised) are retried,
+    after the rest of the buffer, waiting `retry_interval` seconds and twice as long
+    each further time, up to `max_retry_interval`. Messages SQS rejects as malformed
+    (SenderFault) or that failed `max_attempts` times are logged and appended to the
+    dead-letter file of `spool_dir` instead.
+
+    If `spool_dir` is given, every message is also appended to a spool file of the
+    process before it is buffered. The spool is named after the pid and a random token
+    and locked while the process runs. It is truncated whenever the buffer has been
+    fully sent, and rewritten with just the unsent messages once it mostly holds sent
+    ones. When a process starts sending, it takes over the spool files no running
+    process holds the lock of (e.g. after a crash) and re-sends their messages.
+    Sending a message twice is harmless, since indexing is idempotent.
+
+    The sender drains its buffer at interpreter exit, waiting at most
+    `shutdown_timeout` seconds; anything still unsent stays in the spool.
+    """
+    SPOOL_PREFIX = 'spool-'
+    SPOOL_SUFFIX = '.ndjson'
+    DEAD_LETTER_FILENAME = 'dead-letter.ndjson'
+
+    def __init__(self, queues, spool_dir=None, batch_size=10, flush_interval=0.005,
+                 retry_interval=1.0, max_retry_interval=60.0, max_attempts=10, shutdown_timeout=10.0):
+        self.queues = [queue for queue in queues if queue is not None]
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_attempts = max_attempts
+        self.shutdown_timeout = shutdown_timeout
+        self._pending = collections.deque()  # (message, failed attempts)
+        self._retries = []  # heap of (due time, sequence number, message, failed attempts)
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._spool = None
+        self._spool_path = None
+        self._spool_lines = 0
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok=True)
+        atexit.register(self.stop)
+
+    @property
+    def spool_path(self):
+        """ The spool file of this process, once it has spooled anything """
+        return self._spool_path
+
+    @property
+    def dead_letter_path(self):
+        return os.path.join(self.spool_dir, self.DEAD_LETTER_FILENAME) if self.spool_dir else None
+
+    def enqueue(self, items):
+        """ Buffers the given messages for sending, starting the sender thread if needed """
+        with self._condition:
+            self._ensure_started()
+            self._write_spool(items)
+            self._pending.extend((item, 0) for item in items)
+            self._condition.notify()
+
+    def pending(self):
+        """ Number of messages not yet sent """
+        with self._condition:
+            return len(self._pending) + len(self._retries) + self._in_flight
+
+    def flush(self, timeout=None):
+        """ Waits until every buffered message has been sent, returning False on timeout """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending or self._retries or self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.notify_all()
+                self._condition.wait(remaining if remaining is not None else self.flush_interval)
+        return True
+
+    def stop(self, timeout=None):
+        """ Drains the buffer (up to `timeout`, default shutdown_timeout) and stops the sender thread """
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        left = self.pending()
+        if left:
+            log.error('INDEXING: %s queue messages unsent at shutdown%s'
+                      % (left, ' (kept in spool %s)' % self.spool_path if self.spool_dir else ''))
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            if self._pid is not None:
+                # a forked worker inherits the buffer and spool of its parent, which still sends them itself
+                self._forget_parent()
+            self._pid = os.getpid()
+            if self.spool_dir:
+                self._recover_spools()
+        elif self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='indexer-queue-sender', daemon=True)
+        self._thread.start()
+
+    def _forget_parent(self):
+        self._pending.clear()
+        self._retries = []
+        self._in_flight = 0
+        if self._spool is not None:
+            self._spool.close()  # the parent keeps its own descriptor, and so its lock
+        self._spool, self._spool_path, self._spool_lines = None, None, 0
+
+    def _take_due_retries(self):
+        now = time.time()
+        while self._retries and (self._stopping or self._retries[0][0] <= now):
+            _, _, item, attempts = heapq.heappop(self._retries)
+            self._pending.append((item, attempts))
+
+    def _retry_wait(self):
+        """ Seconds until the next retry is due, or None if there are none """
+        return max(0, self._retries[0][0] - time.time()) if self._retries else None
+
+    def _next_batch(self):
+        """ Waits for a full batch, the flush interval, a due retry or shutdown; returns the batch (maybe empty) """
+        with self._condition:
+            self._take_due_retries()
+            if not self._pending and not self._stopping:
+                self._condition.wait(self._retry_wait())
+                self._take_due_retries()
+            if 0 < len(self._pending) < self.batch_size and not self._stopping:
+                self._condition.wait(self.flush_interval)
+                self._take_due_retries()
+            batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            self._in_flight = len(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            failed = self._send([item for item, _ in batch]) if batch else {}
+            with self._condition:
+                self._in_flight = 0
+                for index, failure in failed.items():
+                    self._retry(*batch[index], failure)
+                if not self._pending and not self._retries:
+                    self._truncate_spool()
+                    if self._stopping:
+                        self._condition.notify_all()
+                        return
+                else:
+                    self._compact_spool()
+                self._condition.notify_all()
+                if failed and self._stopping:
+                    return
+
+    def _send(self, items):
+        """ Sends items to every queue, returning {index in items: SQS failure, or None if sending raised} """
+        failed = {}
+        for queue in self.queues:
+            try:
+                failures = queue.send_messages(items, target_queue='primary', max_retries=0)
+            except Exception as e:
+                log.error('INDEXING: error sending %s queue messages, will retry: %r' % (len(items), e))
+                failed.update((index, failed.get(index)) for index in range(len(items)))
+                continue
+            for failure in failures:
+                try:
+                    index = int(failure['Id'])
+                except (KeyError, ValueError):
+                    log.error('INDEXING: failed to queue an unknown message: %s' % failure)
+                    continue
+                if failed.get(index) is None or failure.get('SenderFault'):
+                    failed[index] = failure
+        return failed
+
+    def _retry(self, item, attempts, failure):
+        """ Schedules the retry of a message that failed to send, or gives up on it """
+        attempts += 1
+        if (failure or {}).get('SenderFault') or attempts >= self.max_attempts:
+            self._dead_letter(item, attempts, failure)
+            return
+        if failure is not None:
+            log.warning('INDEXING: failed to queue message %s, will retry: %s' % (item, failure))
+        delay = min(self.retry_interval * 2 ** (attempts - 1), self.max_retry_interval)
+        heapq.heappush(self._retries, (time.time() + delay, next(self._sequence), item, attempts))
+
+    def _dead_letter(self, item, attempts, failure):
+        log.error('INDEXING: giving up on queue message %s after %s attempts: %s%s'
+                  % (item, attempts, failure,
+                     ' (kept in %s)' % self.dead_letter_path if self.spool_dir else ''))
+        if self.spool_dir:
+            with open(self.dead_letter_path, 'a') as dead_letters:
+                dead_letters.write(json.dumps({'message': item, 'attempts': attempts, 'failure': failure}) + '\n')
+
+    def _open_spool(self):
+        """ Creates and locks a new spool file, giving it the name spool recovery looks for only once locked """
+        name = '%s%s-%s%s' % (self.SPOOL_PREFIX, os.getpid(), uuid.uuid4().hex, self.SPOOL_SUFFIX)
+        spool = open(os.path.join(self.spool_dir, '.' + name), 'a')
+        fcntl.flock(spool, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(spool.name, os.path.join(self.spool_dir, name))
+        self._spool, self._spool_path, self._spool_lines = spool, os.path.join(self.spool_dir, name), 0
+
+    def _write_spool(self, items):
+        if not self.spool_dir:
+            return
+        if self._spool is None:
+            self._open_spool()
+        self._spool.write(''.join(json.dumps(item) + '\n' for item in items))
+        self._spool.flush()
+        self._spool_lines += len(items)
+
+    def _truncate_spool(self):
+        if self._spool is not None:
+            self._spool.seek(0)
+            self._spool.truncate()
+            self._spool_lines = 0
+
+    def _compact_spool(self):
+        """ Moves the unsent messages to a new spool once the current one mostly holds sent ones """
+        unsent = [item for item, _ in self._pending] + [item for _, _, item, _ in self._retries]
+        if self._spool is None or self._spool_lines <= 2 * len(unsent) + self.batch_size:
+            return
+        spool, spool_path = self._spool, self._spool_path
+        self._open_spool()
+        self._write_spool(unsent)
+        os.remove(spool_path)  # unsent messages are spooled twice until here, which is harmless
+        spool.close()
+
+    def _recover_spools(self):
+        """ Takes over the messages of spool files whose process is no longer running """
+        recovered = []
+        for filename in sorted(os.listdir(self.spool_dir)):
+            if not filename.startswith(self.SPOOL_PREFIX) or not filename.endswith(self.SPOOL_SUFFIX):
+                continue
+            path = os.path.join(self.spool_dir, filename)
+            try:
+                spool = open(path)
+            except FileNotFoundError:
+                continue
+            with spool:
+                try:
+                    # held by the process writing the spool as long as it runs, and by whoever takes it over
+                    fcntl.flock(spool, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                if not _same_file(spool, path):
+                    continue  # taken over (and removed) by another process meanwhile
+                items = [json.loads(line) for line in spool if line.strip()]
+                self._write_spool(items)
+                self._pending.extend((item, 0) for item in items)
+                recovered.extend(items)
+                os.remove(path)
+        if recovered:
+            log.warning('INDEXING: re-sending %s queue messages recovered from spool' % len(recovered))
+
+
+def _same_file(file, path):
+    try:
+        return os.fstat(file.fileno()).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
@@ -1,20 +1,34 @@
 import logging
+import time
 from copy import deepcopy
 from posixpath import join
 from pyramid.httpexceptions import HTTPNotFound, HTTPServerError
+from pyramid.interfaces import IRequestExtensions
+from pyramid.request import apply_request_extensions
 import pyramid.request
+from pyramid.threadlocal import RequestContext
+from pyramid.traversal import traverse
+from pyramid.view import render_view_to_response
+from .cache import estimate_size
 from .crud_views import collection_add as sno_collection_add
-from .interfaces import COLLECTIONS, CONNECTION
+from .interfaces import COLLECTIONS, CONNECTION, ROOT
 from .pyramid_compat import (
     native_,
     unquote_bytes_to_wsgi,
 )
-from .resources import Collection
+from .resources import Collection, Item
 from .schema_utils import validate_request
+from .util import REQUIRED_FIELDS_VIEW, get_root_request
 from dcicutils.misc_utils import check_true
 
 log = logging.getLogger(__name__)
 
+# parts of embed_cache entries that are their own, the others are shared by the whole request
+EMBED_CACHE_SIZED_PARTS = ('result', '_linked_uuids', '_rev_linked_by_item')
+
+# views of items that embeds render directly instead of through the router, see _invoke_view
+DIRECT_VIEWS = ('object', 'embedded')
+
 
 def includeme(config):
     config.scan(__name__)
@@ -120,14 +134,27 @@ def embed(request, *elements, **kw):
     if as_user is not None and not request._indexing_view:
         cached = _embed(request, path, as_user)
     else:
-        cached = embed_cache.get(path, None)
+        # the full @@object of an item serves any of its renders limited to some calculated properties
+        cache_key, required_fields = object_render_key(path)
+        cached = embed_cache.get(cache_key, None)
+        if cached is None and required_fields is not None:
+            cache_key, path, cached = _cached_object_subset(embed_cache, cache_key, path, required_fields)
         if cached is None:
             # handle common cases of as_user, otherwise use what's given
             subreq_user = 'EMBED' if as_user is None else as_user
+            started = time.perf_counter()
             cached = _embed(request, path, as_user=subreq_user)
+            if required_fields is not None and cache_key != path:
+                cached['required_fields'] = required_fields
+            evicted = 0
             # Do not cache revision history, quickly pollutes memory
             if not (request._indexing_view and '@@revision-history' in path):
-                embed_cache[path] = cached
+                # what it took to render is what the entry is worth keeping for
+                evicted = embed_cache.put(cache_key, cached, cost=time.perf_counter() - started,
+                                          size=estimate_size([cached[part] for part in EMBED_CACHE_SIZED_PARTS]))
+            add_embed_cache_stats(embed_cache, misses=1, evictions=evicted)
+        else:
+            add_embed_cache_stats(embed_cache, hits=1)
 
     # NOTE: if result was retrieved from ES, the following cached attrs will be
     # empty: _aggregated_items, _linked_uuids, _rev_linked_by_item
@@ -154,6 +181,50 @@ def embed(request, *elements, **kw):
     return result
 
 
+def object_render_key(path):
+    """
+    For the path of an @@object render limited to some calculated properties (see
+    EmbeddedPlan.object_view), returns the path of the full @@object of the item and the
+    set of fields required. Returns (path, None) for any other path.
+    """
+    item_path, view, fields = path.partition(REQUIRED_FIELDS_VIEW)
+    if not view or '&' in fields:
+        return path, None
+    return item_path + '@@object', frozenset(fields.split(','))
+
+
+def _cached_object_subset(embed_cache, object_path, path, required_fields):
+    """
+    Looks up the @@object render of an item limited to required_fields (at path), the
+    full @@object of the item (at object_path) not being cached. The embed_cache keeps
+    one such render per item, under object_path + '?required_fields'. If it lacks some
+    of the required fields, the full @@object is to be rendered instead, so an item
+    embedded for different sets of fields is rendered at most twice.
+
+    Returns:
+        the key to cache a new render under, the path to render and the cached render, if any
+    """
+    subset_key = object_path + '?required_fields'
+    cached = embed_cache.get(subset_key, None)
+    if cached is None:
+        return subset_key, path, None
+    if required_fields <= cached['required_fields']:
+        return subset_key, path, cached
+    del embed_cache[subset_key]
+    return object_path, object_path, None
+
+
+def add_embed_cache_stats(embed_cache, hits=0, misses=0, evictions=0):
+    """ Adds to the embed cache hits, misses and evictions of the request, reported by the stats tween """
+    stats = getattr(get_root_request(), '_stats', None)
+    if stats is None:
+        return
+    stats['embed_cache_hits'] = stats.get('embed_cache_hits', 0) + hits
+    stats['embed_cache_misses'] = stats.get('embed_cache_misses', 0) + misses
+    stats['embed_cache_evictions'] = stats.get('embed_cache_evictions', 0) + evictions
+    stats['embed_cache_bytes'] = embed_cache.size
+
+
 def _embed(request, path, as_user='EMBED'):
     """
     Helper function used in embed() that creates the subrequest and actually
@@ -192,7 +263,7 @@ def _embed(request, path, as_user='EMBED'):
         subreq.remote_user = as_user
     # _linked_uuids are populated in item_view_object of resource_views.py
     try:
-        result = request.invoke_subrequest(subreq)
+        result = _invoke_view(request, subreq)
     except HTTPNotFound:
         if '@@index-data' in path:
             # the resource to index is missing; likely purged
@@ -206,6 +277,45 @@ def _embed(request, path, as_user='EMBED'):
             '_sid_cache': subreq._sid_cache}
 
 
+def _invoke_view(request, subreq):
+    """
+    Invokes subreq as request.invoke_subrequest would, but if it is for one of the DIRECT_VIEWS
+    of an item (e.g. @@object), traverses to the item and calls its view with subreq directly.
+    This skips what the router does on top (request and traversal events, route matching,
+    response callbacks), which costs more than rendering the @@object of small items.
+    The view is the registered, secured one, so permissions are checked as usual.
+
+    Args:
+        request: Request embedding
+        subreq: subrequest made by make_subrequest, with the attributes propagated by _embed
+
+    Returns:
+        result of the view
+    """
+    if subreq.path_info.rpartition('/@@')[2] not in DIRECT_VIEWS:
+        return request.invoke_subrequest(subreq)
+    registry = request.registry
+    tdict = traverse(registry[ROOT], subreq.path_info)
+    if tdict['view_name'] not in DIRECT_VIEWS or tdict['subpath'] or not isinstance(tdict['context'], Item):
+        return request.invoke_subrequest(subreq)
+    subreq.registry = registry
+    subreq.invoke_subrequest = request.invoke_subrequest
+    extensions = registry.queryUtility(IRequestExtensions)
+    if extensions is not None and all(hasattr(type(subreq), name) for name in extensions.descriptors):
+        # subreq is of the (extended) class of request, so it only lacks the request methods,
+        # rather than a class of its own with the request properties too
+        for name, fn in extensions.methods.items():
+            setattr(subreq, name, fn.__get__(subreq, type(subreq)))
+    else:
+        apply_request_extensions(subreq, extensions=extensions)
+    subreq.__dict__.update(tdict)
+    with RequestContext(subreq):
+        result = render_view_to_response(tdict['context'], subreq, name=tdict['view_name'])
+    if result is None:  # no such view for the item, so have the router respond
+        return request.invoke_subrequest(subreq)
+    return result
+
+
 def subrequest_object(request, object_id):
     subreq = make_subrequest(request, "/" + object_id)
     subreq.headers['Accept'] = 'application/json'
@@ -11,7 +11,7 @@ from .elasticsearch.indexer_utils import find_uuids_for_indexing
 from .embed import make_subrequest
 from .interfaces import CONNECTION, STORAGE
 from .resources import Item
-from .util import debug_log
+from .util import debug_log, embedded_principals_index
 from .validation import ValidationFailure
 
 
@@ -193,6 +193,10 @@ def item_index_data(context, request):
     # this is built since the embedded view is built on "item_with_links", see resources.py
     linked_uuids_embedded = request._linked_uuids.copy()
 
+    # lets filter_embedded prune only what a user may not view when serving embedded_view
+    with indexing_timer(indexing_stats, 'embedded_principals'):
+        embedded_principals = embedded_principals_index(embedded_view)
+
     # find uuids traversed that rev link to this item
     with indexing_timer(indexing_stats, 'rev_links'):
         rev_linked_to_me = get_rev_linked_items(request, uuid)
@@ -226,6 +230,7 @@ def item_index_data(context, request):
     document = {
         'aggregated_items': aggregated_items,
         'embedded': embedded_view,
+        'embedded_principals': embedded_principals,
         'indexing_stats': indexing_stats,
         'item_type': context.type_info.item_type,
         'linked_uuids_embedded': join_linked_uuids_sids(request, linked_uuids_embedded),
@@ -4,8 +4,12 @@ CALCULATED_PROPERTIES = 'calculated_properties'
 COLLECTIONS = 'collections'
 CONNECTION = 'connection'
 DBSESSION = 'dbsession'
+FACET_AGGREGATION_CACHE = 'facet_aggregation_cache'
 STORAGE = 'storage'
 ROOT = 'root'
+SEARCH_ADMISSION = 'search_admission'
+SEARCH_JOBS = 'search_jobs'
+SEARCH_RESPONSE_CACHE = 'search_response_cache'
 TYPES = 'types'
 UPGRADER = 'upgrader'
 
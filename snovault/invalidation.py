@@ -1,4 +1,4 @@
-from .elasticsearch.interfaces import INDEXER_QUEUE, INDEXER_QUEUE_MIRROR, ELASTIC_SEARCH
+from .elasticsearch.interfaces import INDEXER_QUEUE, INDEXER_QUEUE_MIRROR, INDEXER_QUEUE_SENDER, ELASTIC_SEARCH
 import structlog
 import datetime
 
@@ -23,22 +23,7 @@ def add_to_indexing_queue(success, request, item, edit_or_add):
     # only queue if the transaction is successful and we do no explicitly skip indexing (loadxl phase 1)
     if success and not request.params.get('skip_indexing'):
         try:
-            item['strict'] = False
-            item['method'] = 'POST' if edit_or_add == 'add' else 'PATCH'
-            item['timestamp'] = datetime.datetime.utcnow().isoformat()
-            indexer_queue = request.registry.get(INDEXER_QUEUE)
-            indexer_queue_mirror = request.registry.get(INDEXER_QUEUE_MIRROR)
-            if indexer_queue:
-                # send to primary queue
-                indexer_queue.send_messages([item], target_queue='primary')
-                if indexer_queue_mirror:
-                    indexer_queue_mirror.send_messages([item], target_queue='primary')
-            else:
-                # if the indexer queue is not configured but ES is, log an error
-                es = request.registry.get(ELASTIC_SEARCH)
-                if es:
-                    raise Exception(f'Indexer queue not configured!'
-                                    f' Attempted to queue {item} for method {edit_or_add}.')
+            _send_to_indexing_queue(request, [_indexing_message(item, edit_or_add)])
         except Exception as e:
             error_msg = repr(e)
     else:
@@ -48,3 +33,57 @@ def add_to_indexing_queue(success, request, item, edit_or_add):
             error_msg = f'DB transaction not successful! {item} not queued for method {edit_or_add}.'
     if error_msg:
         log.error(f'___Error queueing {item} for indexing. Error: {error_msg}')
+
+
+def add_batch_to_indexing_queue(success, request, items):
+    """
+    Batch version of add_to_indexing_queue, for requests that write many items
+    in one transaction (see batch_views.py). Also called from addAfterCommitHook.
+    items is a list of (item, edit_or_add) tuples as passed to add_to_indexing_queue.
+    All items are sent together, so SQS is called once per 10 items rather than
+    once per item.
+    """
+    error_msg = None
+    if success and not request.params.get('skip_indexing'):
+        try:
+            _send_to_indexing_queue(request, [_indexing_message(item, edit_or_add) for item, edit_or_add in items])
+        except Exception as e:
+            error_msg = repr(e)
+    else:
+        if request.params.get('skip_indexing'):
+            log.info(f'skip_indexing param passed - {len(items)} batched items not queued')
+        else:
+            error_msg = f'DB transaction not successful! {len(items)} batched items not queued.'
+    if error_msg:
+        log.error(f'___Error queueing {len(items)} batched items for indexing. Error: {error_msg}')
+
+
+def _indexing_message(item, edit_or_add):
+    """ Fills in the queue message fields common to all edits of an item """
+    item['strict'] = False
+    item['method'] = 'POST' if edit_or_add == 'add' else 'PATCH'
+    item['timestamp'] = datetime.datetime.utcnow().isoformat()
+    return item
+
+
+def _send_to_indexing_queue(request, items):
+    """
+    Sends the given messages to the primary indexer queue (and its mirror, if configured).
+    With indexer.async_queueing on, they are handed to the background sender instead.
+    """
+    indexer_queue = request.registry.get(INDEXER_QUEUE)
+    indexer_queue_mirror = request.registry.get(INDEXER_QUEUE_MIRROR)
+    sender = request.registry.get(INDEXER_QUEUE_SENDER)
+    if indexer_queue and sender:
+        sender.enqueue(items)
+    elif indexer_queue:
+        # send to primary queue
+        indexer_queue.send_messages(items, target_queue='primary')
+        if indexer_queue_mirror:
+            indexer_queue_mirror.send_messages(items, target_queue='primary')
+    else:
+        # if the indexer queue is not configured but ES is, log an error
+        es = request.registry.get(ELASTIC_SEARCH)
+        if es:
+            raise Exception(f'Indexer queue not configured!'
+                            f' Attempted to queue {items}.')
@@ -18,6 +18,7 @@ import uuid
 from pyramid.paster import get_app
 from pyramid.response import Response
 from pyramid.router import Router
+from pyramid.settings import asbool
 from pyramid.view import view_config
 from dcicutils.data_readers import RowReader
 from dcicutils.misc_utils import ignored, environ_bool, to_camel_case, VirtualApp
@@ -404,43 +405,22 @@ def normalize_deleted_properties(data: dict) -> Tuple[dict, List[str]]:
     return data, deleted_property_names
 
 
-def load_all_gen(testapp, inserts, docsdir, overwrite=True, itype=None, from_json=False,
-                 patch_only=False, post_only=False, skip_types=None, validate_only=False,
-                 skip_links=False, continue_on_exception: bool = False, verbose=False,
-                 noset_last_modified=False, progress=None):
+def read_inserts(inserts, itype=None, from_json=False, skip_types=None):
     """
-    Generator function that yields bytes information about each item POSTed/PATCHed.
-    Is the base functionality of load_all function.
-
-    convert data to store format dictionary (same format expected from from_json=True),
-    assume main function is to load reasonable number of inserts from a folder
+    Collects the items to load into the store format {item_type: [items]}.
 
     Args:
-        testapp
         inserts : either a folder, file, or a dictionary in the store format
-        docsdir : attachment folder
-        overwrite (bool)   : if the database contains the item already, skip or patch
         itype (list or str): limit selection to certain type/types
         from_json (bool)   : if set to true, inserts should be dict instead of folder name
-        patch_only (bool)  : if set to true will only do second round patch - no posts
-        post_only (bool)   : if set to true posts full item no second round or lookup -
-                             use with care - will not work if linkTos to items not in db yet
         skip_types (list)  : if set to a list of item files the process will ignore these files
-        validate_only (bool): if set to true no POST/PATCH persists anything; every request is
-                             made with check_only=true so only the validators run
-        skip_links (bool)  : if set to true, defer link (linkTo) integrity checking to the caller;
-                             only legal together with validate_only, as the server rejects
-                             skip_links=true on any request that is not check_only=true
-    Yields:
-        Bytes with information on POSTed/PATCHed items
 
     Returns:
-        None if successful, otherwise a bytes error message
+        dict store, without types that have no items
+
+    Raises:
+        ValueError if inserts is neither a file nor a directory
     """
-    if docsdir is None:
-        docsdir = []
-    progress = progress if callable(progress) else None
-    # Collect Items
     store = {}
     if from_json:  # we are directly loading json
         store = inserts
@@ -457,11 +437,7 @@ def load_all_gen(testapp, inserts, docsdir, overwrite=True, itype=None, from_jso
             # otherwise guess from the filename
             use_itype = True if (itype and isinstance(itype, str)) else False
         else:  # cannot get the file
-            err_msg = 'Failure loading inserts from %s. Could not find matching file or directory.' % inserts
-            print(err_msg)
-            yield str.encode(f'ERROR: {err_msg}\n')
-            return
-            # raise StopIteration
+            raise ValueError('Failure loading inserts from %s. Could not find matching file or directory.' % inserts)
         # load from the directory/file
         for a_file in files:
             if use_itype:
@@ -478,7 +454,63 @@ def load_all_gen(testapp, inserts, docsdir, overwrite=True, itype=None, from_jso
         else:
             store = {itype: store.get(itype, [])}
     # clear empty values
-    store = {k: v for k, v in store.items() if v is not None}
+    return {k: v for k, v in store.items() if v is not None}
+
+
+def order_item_types(store):
+    """ Returns the item types of the store in load order, see loadxl_order """
+    all_types = list(store.keys())
+    for ref_item in reversed(loadxl_order()):
+        if ref_item in all_types:
+            all_types.insert(0, all_types.pop(all_types.index(ref_item)))
+    return all_types
+
+
+def load_all_gen(testapp, inserts, docsdir, overwrite=True, itype=None, from_json=False,
+                 patch_only=False, post_only=False, skip_types=None, validate_only=False,
+                 skip_links=False, continue_on_exception: bool = False, verbose=False,
+                 noset_last_modified=False, progress=None):
+    """
+    Generator function that yields bytes information about each item POSTed/PATCHed.
+    Is the base functionality of load_all function.
+
+    convert data to store format dictionary (same format expected from from_json=True),
+    assume main function is to load reasonable number of inserts from a folder
+
+    Args:
+        testapp
+        inserts : either a folder, file, or a dictionary in the store format
+        docsdir : attachment folder
+        overwrite (bool)   : if the database contains the item already, skip or patch
+        itype (list or str): limit selection to certain type/types
+        from_json (bool)   : if set to true, inserts should be dict instead of folder name
+        patch_only (bool)  : if set to true will only do second round patch - no posts
+        post_only (bool)   : if set to true posts full item no second round or lookup -
+                             use with care - will not work if linkTos to items not in db yet
+        skip_types (list)  : if set to a list of item files the process will ignore these files
+        validate_only (bool): if set to true no POST/PATCH persists anything; every request is
+                             made with check_only=true so only the validators run
+        skip_links (bool)  : if set to true, defer link (linkTo) integrity checking to the caller;
+                             only legal together with validate_only, as the server rejects
+                             skip_links=true on any request that is not check_only=true
+    Yields:
+        Bytes with information on POSTed/PATCHed items
+
+    Returns:
+        None if successful, otherwise a bytes error message
+    """
+    if docsdir is None:
+        docsdir = []
+    progress = progress if callable(progress) else None
+    # Collect Items
+    try:
+        store = read_inserts(inserts, itype=itype, from_json=from_json, skip_types=skip_types)
+    except ValueError as e:
+        err_msg = str(e)
+        print(err_msg)
+        yield str.encode(f'ERROR: {err_msg}\n')
+        return
+        # raise StopIteration
     if not store:
         if LOADXL_ALLOW_NONE:
             return
@@ -493,10 +525,7 @@ def load_all_gen(testapp, inserts, docsdir, overwrite=True, itype=None, from_jso
         return
         # raise StopIteration
     # order Items
-    all_types = list(store.keys())
-    for ref_item in reversed(loadxl_order()):
-        if ref_item in all_types:
-            all_types.insert(0, all_types.pop(all_types.index(ref_item)))
+    all_types = order_item_types(store)
     # collect schemas
     profiles = testapp.get('/profiles/?frame=raw').json
 
@@ -694,7 +723,7 @@ def load_all_gen(testapp, inserts, docsdir, overwrite=True, itype=None, from_jso
     for a_type in all_types:
         identifying_properties, _ = get_schema_info(a_type)
         patched = 0
-        if not second_round_items[a_type]:
+        if not second_round_items.get(a_type):  # post_only has no second round
             logger.info('{}{}: no items to patch'.format(a_type, rnd))
             continue
         for an_item in second_round_items[a_type]:
@@ -779,19 +808,28 @@ def get_json_file_content(filename):
 
 
 def load_data(app, indir='inserts', docsdir=None, overwrite=False,
-              use_master_inserts=True, skip_types=None):
+              use_master_inserts=True, skip_types=None, direct=None):
     """
     This function will take the inserts folder as input, and place them to the given environment.
     args:
         app:
         indir (inserts): inserts folder, should be relative to tests/data/
         docsdir (None): folder with attachment documents, relative to tests/data
+        direct (None): load with loadxl_direct.load_all_direct instead of through the app;
+                       defaults to the loadxl.direct setting
     """
     testapp = create_testapp(app)
+    if direct is None:
+        direct = asbool(testapp.app.registry.settings.get('loadxl.direct', False))
+    if direct:
+        from .loadxl_direct import load_all_direct  # imported here as loadxl_direct builds on this module
+        loader = load_all_direct
+    else:
+        loader = load_all
     # load master-inserts by default
     if indir != 'master-inserts' and use_master_inserts:
         master_inserts = app_project().project_filename('tests/data/master-inserts/')
-        master_res = load_all(testapp, master_inserts, [], skip_types=skip_types)
+        master_res = loader(testapp, master_inserts, [], skip_types=skip_types)
         if master_res:  # None if successful
             print(LOAD_ERROR_MESSAGE)
             logger.error('load_data: failed to load from %s' % master_inserts, error=master_res)
@@ -809,7 +847,7 @@ def load_data(app, indir='inserts', docsdir=None, overwrite=False,
         if not docsdir.endswith('/'):
             docsdir += '/'
         docsdir = [app_project().project_filename(os.path.join('tests/data/', docsdir))]
-    res = load_all(testapp, inserts, docsdir, overwrite=overwrite)
+    res = loader(testapp, inserts, docsdir, overwrite=overwrite)
     if res:  # None if successful
         print(LOAD_ERROR_MESSAGE)
         logger.error('load_data: failed to load from %s' % docsdir, error=res)
@@ -0,0 +1,322 @@
+"""
+Direct bulk loader for inserts, an in-process alternative to the HTTP based `loadxl.load_all`.
+
+`load_all_gen` sends every item through the app twice (a minimal POST, then a PATCH), so
+each item pays for routing, validation, subrequests and its own transaction. This loader
+instead loads everything in a single transaction:
+
+1. identifiers (uuids and unique keys) of all items are collected in memory first, so links
+   between items of the same load resolve without them being in the database yet
+2. every item is validated once, with one compiled schema validator per type
+3. resources, propsheets, current_propsheets, keys and links are written with Postgres COPY
+4. the loaded uuids are queued for indexing (in SQS batches) once the transaction commits
+
+Items that already exist are skipped, or with `overwrite` patched through the regular ORM
+path. So are new items of types that customize `create`/`update` or are not stored in
+Postgres, since writing those rows directly would bypass that code. Items written with COPY
+do not send `Created` notifications.
+"""
+
+import csv
+import io
+import structlog
+import transaction
+import uuid
+
+from pyramid.httpexceptions import HTTPException
+from pyramid.scripting import prepare
+from sqlalchemy import text, tuple_
+from zope.sqlalchemy import mark_changed
+
+from .batch_views import BatchRowError, BatchWriter, row_request
+from .interfaces import COLLECTIONS, DBSESSION
+from .invalidation import add_batch_to_indexing_queue
+from .json_renderer import json_renderer
+from .loadxl import (
+    LOADXL_USER_UUID, create_testapp, format_for_attachment, normalize_deleted_properties,
+    order_item_types, read_inserts,
+)
+from .resources import Item
+from .server_defaults_misc import add_last_modified
+from .storage import CurrentPropertySheet, Key, Link, PropertySheet, Resource
+
+
+log = structlog.getLogger(__name__)
+
+
+class DirectLoadError(Exception):
+    """ Raised with the errors of all failing items; nothing is written when it is """
+
+    def __init__(self, errors):
+        super().__init__('\n'.join(errors))
+        self.errors = errors
+
+
+class PendingIdentifiers(object):
+    """
+    uuids and unique keys of the items being loaded, used by schema validation
+    (schema_validation.normalize_links) to resolve links to items that are not
+    written yet, the same way a collection lookup would resolve them once they are
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.uuids = {}
+        self.keys = {}
+
+    def add(self, rid, type_info, unique_keys):
+        self.uuids[rid] = [type_info.name] + type_info.base_types
+        for name, values in unique_keys.items():
+            for value in values:
+                self.keys[(name, value)] = rid
+
+    def resolve(self, linkTo, link):
+        """ Returns the uuid of the pending item that `link` refers to, or None """
+        try:
+            rid = str(uuid.UUID(link))
+        except (TypeError, ValueError):
+            rid = None
+        if rid in self.uuids:
+            return rid
+        # links to several types are resolved from the root, which only knows uuids
+        collection = self.registry[COLLECTIONS].get(linkTo) if isinstance(linkTo, str) else None
+        if collection is None or collection.unique_key is None:
+            return None
+        return self.keys.get((collection.unique_key, link))
+
+    def type_names(self, rid):
+        """ Names of the type and base types of the pending item with the given uuid """
+        return self.uuids[rid]
+
+
+def supports_direct_write(collection):
+    """ True if items of this collection can be written with COPY instead of the ORM """
+    factory = collection.type_info.factory
+    return (collection.properties_datastore == 'database'
+            and factory.create.__func__ is Item.create.__func__
+            and factory.update is Item.update
+            and factory._update is Item._update)
+
+
+def copy_rows(session, table, columns, rows):
+    """ Writes rows into the given table with COPY, within the session's transaction """
+    if not rows:
+        return
+    buffer = io.StringIO()
+    # quote everything, as unquoted empty strings (e.g. the '' propsheet name) are NULL to COPY
+    csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(rows)
+    buffer.seek(0)
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (table, ', '.join(columns)), buffer)
+    finally:
+        cursor.close()
+    # raw SQL is invisible to zope.sqlalchemy, which would otherwise roll the session back on commit
+    mark_changed(session)
+
+
+class DirectLoader(BatchWriter):
+    """
+    Loads a store ({item_type: [items]}) within the request's transaction. Reuses
+    BatchWriter for per-type validators, permission checks and the ORM writes.
+    """
+
+    def __init__(self, request, overwrite=False, docsdir=None, set_last_modified=True):
+        super().__init__(request)
+        self.overwrite = overwrite
+        self.docsdir = docsdir or []
+        self.set_last_modified = set_last_modified
+        self.session = request.registry[DBSESSION]()
+        self.pending = request._pending_identifiers = PendingIdentifiers(request.registry)
+        self.to_copy = []  # (collection, item) for new items written with COPY
+        self.to_write = []  # (collection, batch row) for items written through the ORM
+        self.skipped = 0
+        self.errors = []
+
+    def prepare_item(self, item):
+        item, deleted = normalize_deleted_properties(dict(item))
+        item = format_for_attachment(item, self.docsdir)
+        if self.set_last_modified:
+            add_last_modified(item, userid=LOADXL_USER_UUID)
+        return item, deleted
+
+    def plan(self, store):
+        """ Sorts items into new (COPY or ORM), existing (patched or skipped) and registers identifiers """
+        collections = self.request.registry[COLLECTIONS]
+        candidates = []
+        for item_type in order_item_types(store):
+            collection = collections.get(item_type)
+            if collection is None:
+                self.errors.append(f'ERROR: /{item_type} Unknown item type')
+                continue
+            helper = collection.type_info.factory(self.request.registry, None)
+            for raw_item in store[item_type]:
+                item, deleted = self.prepare_item(raw_item)
+                candidates.append((collection, item, deleted, helper.unique_keys(item)))
+        self.check_duplicates(candidates)
+
+        # find the items that already exist with one query per table
+        uuids = {item['uuid'] for _, item, _, _ in candidates if item.get('uuid')}
+        existing = {str(rid) for rid, in self.session.query(Resource.rid).filter(Resource.rid.in_(uuids))} \
+            if uuids else set()
+        pairs = {(name, value) for *_, keys in candidates for name, values in keys.items() for value in values}
+        existing_keys = {(key.name, key.value): str(key.rid) for key in self.session.query(Key).filter(
+            tuple_(Key.name, Key.value).in_(pairs))} if pairs else {}
+
+        for collection, item, deleted, keys in candidates:
+            existing_rid = item['uuid'] if item.get('uuid') in existing else next(
+                (existing_keys[(name, value)] for name, values in keys.items() for value in values
+                 if (name, value) in existing_keys), None)
+            if existing_rid is not None:
+                if self.overwrite:
+                    item.pop('uuid', None)
+                    self.to_write.append((collection, {'method': 'PATCH', 'id': existing_rid, 'body': item,
+                                                       'delete_fields': deleted}))
+                else:
+                    self.skipped += 1
+                continue
+            item['uuid'] = rid = item.get('uuid') or str(uuid.uuid4())
+            self.pending.add(rid, collection.type_info, keys)
+            if supports_direct_write(collection):
+                self.to_copy.append((collection, item))
+            else:
+                self.to_write.append((collection, {'method': 'POST', 'type': collection.type_info.item_type,
+                                                   'body': item}))
+
+    def check_duplicates(self, candidates):
+        """ Reports items that share a uuid or unique key with an earlier item of the load, which
+            would otherwise only fail when COPYed, with an IntegrityError
+        """
+        seen = {}  # identifier -> description of the first item with it
+        for collection, item, _, keys in candidates:
+            item_type = collection.type_info.item_type
+            identifiers = [('uuid', str(item['uuid']).lower())] if item.get('uuid') else []
+            identifiers += [(name, value) for name, values in keys.items() for value in sorted(set(values))]
+            duplicates = []
+            for name, value in identifiers:
+                if (name, value) in seen:
+                    duplicates.append({'name': 'duplicate',
+                                       'description': f'{name} {value!r} is also used by {seen[(name, value)]}'})
+                else:
+                    seen[(name, value)] = f'/{item_type}/{item.get("uuid")}'
+            if duplicates:
+                self.error(collection, item.get('uuid'), BatchRowError(duplicates))
+
+    def patched_properties(self, current, row):
+        # properties the inserts mark as deleted (see normalize_deleted_properties) are removed
+        data = super().patched_properties(current, row)
+        for field in row.get('delete_fields', ()):
+            data.pop(field, None)
+        return data
+
+    def error(self, collection, item_id, e):
+        errors = e.errors if isinstance(e, BatchRowError) else [
+            {'name': type(e).__name__, 'description': getattr(e, 'detail', None) or str(e)}
+        ]
+        for error in errors:
+            self.errors.append(f'ERROR: /{collection.type_info.item_type}/{item_id} '
+                               f'{error["name"]}: {error["description"]}')
+
+    def validate_new(self, collection, item):
+        """ Validates a new item like Item.create would, returning its rows for COPY """
+        type_info = collection.type_info
+        if not self.request.has_permission('add', collection):
+            raise BatchRowError([{'name': 'permission', 'description': f'add permission required on {collection}'}])
+        with row_request(self.request, collection, 'POST'):
+            properties = self.validate(type_info, item)
+        rid = properties.pop('uuid')
+        helper = type_info.factory(self.request.registry, None)
+        helper.validate_path_characters(helper.name_key, properties.get(helper.name_key, ''))
+        unique_keys = helper.unique_keys(properties)
+        for name, values in unique_keys.items():
+            if len(set(values)) != len(values):
+                raise BatchRowError([{'name': 'keys', 'description': 'Duplicate keys for %r: %r' % (name, values)}])
+            for value in values:
+                helper.validate_path_characters(name, value)
+        return rid, properties, unique_keys, helper.links(properties)
+
+    def load(self, store):
+        """ Writes everything, raising DirectLoadError (before writing anything when possible) on failure """
+        self.plan(store)
+        validated = []
+        for collection, item in self.to_copy:
+            try:
+                validated.append((collection, self.validate_new(collection, item)))
+            except (BatchRowError, HTTPException, ValueError) as e:
+                self.error(collection, item['uuid'], e)
+        if self.errors:
+            raise DirectLoadError(self.errors)
+
+        # resources, propsheets and keys first, so ORM written items (and links) can refer to them
+        self.session.flush()
+        sids = self.session.execute(
+            text("SELECT nextval(pg_get_serial_sequence('propsheets', 'sid')) FROM generate_series(1, :n)"),
+            {'n': len(validated)}
+        ).scalars().all() if validated else []
+        rows = [(collection.type_info.item_type, sid) + row for (collection, row), sid in zip(validated, sids)]
+        copy_rows(self.session, Resource.__tablename__, ['rid', 'item_type'],
+                  [(rid, item_type) for item_type, sid, rid, *_ in rows])
+        copy_rows(self.session, PropertySheet.__tablename__, ['sid', 'rid', 'name', 'properties'],
+                  [(sid, rid, '', json_renderer.dumps(properties)) for _, sid, rid, properties, *_ in rows])
+        copy_rows(self.session, CurrentPropertySheet.__tablename__, ['rid', 'name', 'sid'],
+                  [(rid, '', sid) for _, sid, rid, *_ in rows])
+        copy_rows(self.session, Key.__tablename__, ['name', 'value', 'rid'],
+                  [(name, value, rid) for _, _, rid, _, unique_keys, _ in rows
+                   for name, values in unique_keys.items() for value in values])
+
+        for collection, row in self.to_write:
+            try:
+                self.write(row)
+            except (BatchRowError, HTTPException, ValueError) as e:
+                self.error(collection, row.get('id') or row['body']['uuid'], e)
+        if self.errors:
+            raise DirectLoadError(self.errors)
+
+        self.session.flush()
+        copy_rows(self.session, Link.__tablename__, ['source', 'rel', 'target'],
+                  {(rid, rel, str(uuid.UUID(target))) for _, _, rid, _, _, links in rows
+                   for rel, targets in links.items() for target in targets})
+        self.request._indexing_batch.extend(({'uuid': rid, 'sid': sid}, 'add') for _, sid, rid, *_ in rows)
+        return {'copied': len(rows), 'written': len(self.to_write), 'skipped': self.skipped}
+
+
+def load_all_direct(app, inserts, docsdir=None, overwrite=True, itype=None, from_json=False,
+                    skip_types=None, noset_last_modified=False):
+    """
+    Loads inserts in a single transaction, writing new items with COPY (see module docstring).
+    Takes the same inserts, docsdir, overwrite, itype, from_json and skip_types arguments
+    as load_all, so the two can be swapped.
+
+    :param app: app (Router), TestApp or config uri
+    :param noset_last_modified: do not set last_modified on loaded items
+    :return: None if successful, otherwise an Exception with one "ERROR: ..." line per failing item;
+             nothing is written on failure
+    """
+    app = create_testapp(app).app
+    try:
+        store = read_inserts(inserts, itype=itype, from_json=from_json, skip_types=skip_types)
+    except ValueError as e:
+        return Exception(f'ERROR: {e}')
+    if not store:
+        return None
+
+    request = app.request_factory.blank('/_load_direct', environ={'REMOTE_USER': 'TEST'})
+    env = prepare(request=request, registry=app.registry)
+    request.root = env['root']
+    request.datastore = 'database'
+    request.invoke_subrequest = app.invoke_subrequest
+    request._stats = {}
+    request._indexing_batch = []
+    try:
+        with transaction.manager as txn:
+            loader = DirectLoader(request, overwrite=overwrite, docsdir=docsdir,
+                                  set_last_modified=not noset_last_modified)
+            counts = loader.load(store)
+            txn.addAfterCommitHook(add_batch_to_indexing_queue, args=(request, request._indexing_batch))
+    except DirectLoadError as e:
+        log.error('load_all_direct: nothing loaded, %s items failed' % len(e.errors))
+        return Exception('\n'.join(e.errors))
+    finally:
+        env['closer']()
+    log.info('load_all_direct: %(copied)s items copied, %(written)s written, %(skipped)s skipped' % counts)
+    return None
@@ -111,6 +111,29 @@ class LocalRolesAuthorizationPolicy(object):
         self.wrapped_policy = wrapped_policy
 
     def permits(self, context, principals, permission):
+        """ Checks are cached for items whose ACL is, see Item.acl_key """
+        acl_key = context.acl_key() if hasattr(context, 'acl_key') else None
+        if acl_key is None:
+            return self._permits(context, principals, permission)
+        acl_cache = context.type_info.acl_cache
+        cache_key = ('permits', acl_key, frozenset(principals), permission)
+        result = acl_cache.get(cache_key)
+        if result is None:
+            result = self._permits(context, principals, permission)
+            # kept without the item (when it, rather than its collection or root, decided), for any item
+            # with the same ACL
+            acl_cache[cache_key] = (self._permits_result(result, None) if getattr(result, 'context', None) is context
+                                    else result)
+        elif getattr(result, 'context', False) is None:
+            result = self._permits_result(result, context)
+        return result
+
+    @staticmethod
+    def _permits_result(result, context):
+        """ The ACLAllowed/ACLDenied result as decided about context """
+        return type(result)(result.ace, result.acl, result.permission, result.principals, context)
+
+    def _permits(self, context, principals, permission):
         principals = local_principals(context, principals)
         result = self.wrapped_policy.permits(context, principals, permission)
         if DEBUG_PERMISSIONS:
@@ -23,7 +23,6 @@ from .resources import (
 )
 from .util import (
     expand_path,
-    build_embedded_model,
     expand_embedded_model,
     process_aggregated_items,
     check_es_and_cache_linked_sids,
@@ -146,7 +145,8 @@ def item_view_object(context, request):
     1. Fetch stored properties, possibly upgrading.
     2. Link canonicalization (overwriting uuids with links)
        - adds uuid to request._linked_uuids if request._indexing_view
-    3. Calculated properties
+    3. Calculated properties, only those listed in the `required_fields` parameter (comma
+       separated field names) if it is given, as when embedding linked items
 
     On a DB request, will use the Elasticsearch result for the view if the ES
     result passes `validate_es_content` (has valid sids and rev_links)
@@ -168,7 +168,15 @@ def item_view_object(context, request):
             return es_res['object']
 
     properties = context.item_with_links(request)
-    calculated = calculate_properties(context, request, properties)
+    required_fields = request.params.get('required_fields')
+    if required_fields is not None:
+        required_fields = set(required_fields.split(','))
+        if request._indexing_view is True:
+            # indexing finds the items rev linking to the indexed item through the rev links
+            # looked up while embedding (see get_rev_linked_items), so look them all up still
+            for name in context.rev.keys() - required_fields:
+                context.get_filtered_rev_links(request, name)
+    calculated = calculate_properties(context, request, properties, fields=required_fields)
     merge_calculated_into_properties(properties, calculated)
     return properties
 
@@ -206,7 +214,8 @@ def item_view_embedded(context, request):
                 request._aggregated_items = {agg: {'items': val} for agg, val in
                                              es_res['aggregated_items'].items()}
                 request._aggregate_for['uuid'] = None
-            return filter_embedded(es_res['embedded'], request.effective_principals)
+            return filter_embedded(es_res['embedded'], request.effective_principals,
+                                   es_res.get('embedded_principals'))
 
     # set up _aggregated_items if we want to aggregate this target
     will_aggregate = getattr(request, '_aggregate_for').get('uuid') == str(context.uuid)
@@ -217,8 +226,7 @@ def item_view_embedded(context, request):
 
     item_path = request.resource_path(context)
     properties = request.embed(item_path, '@@object', as_user=True)
-    embedded_model = build_embedded_model(context.embedded)
-    embedded = expand_embedded_model(request, properties, embedded_model,
+    embedded = expand_embedded_model(request, properties, context.embedded_plan,
                                      parent_path=parent_path)
     if will_aggregate:
         process_aggregated_items(request)
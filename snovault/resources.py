@@ -1,4 +1,5 @@
 # See http://docs.pylonsproject.org/projects/pyramid/en/latest/narr/resources.html
+import json
 import logging
 from collections.abc import Mapping
 from copy import deepcopy
@@ -36,7 +37,7 @@ from .util import (
     simple_path_ids,
     uuid_to_path
 )
-from .util import add_default_embeds, IndexSettings
+from .util import EmbeddedPlan, IndexSettings
 
 logger = logging.getLogger(__name__)
 
@@ -384,6 +385,11 @@ class Item(Resource):
     AbstractCollection = AbstractCollection
     Collection = Collection
     STATUS_ACL = {}  # note that this should ALWAYS be overridden by downstream application
+    # Properties besides status that __acl__ and __ac_local_roles__ depend on (e.g. lab or award).
+    # Items of a type that agree on these share their ACL, so their principals_allowed and
+    # permission checks are computed once for all of them. Classes that override __acl__ or
+    # __ac_local_roles__ must declare them again, or their ACLs are not cached.
+    acl_fields = ()
     ALLOWED_PATH_CHARACTERS = ["_", "-", ":", ",", ".", " ", "@"]
 
     def __init__(self, registry, model):
@@ -396,10 +402,35 @@ class Item(Resource):
            lookup then the access is set to admin only
         """
         # Don't finalize to avoid validation here.
-        properties = self.upgrade_properties().copy()
-        status = properties.get('status')
+        status = self.acl_properties().get('status')
         return self.STATUS_ACL.get(status, ONLY_ADMIN_VIEW_ACL)
 
+    def acl_properties(self):
+        """
+        The (upgraded) properties for computing the ACL from. Unlike upgrade_properties,
+        these are not a copy when no upgrade is needed, so they must not be modified.
+        """
+        properties = self.properties
+        target_version = self.type_info.schema_version
+        if target_version is not None and properties.get('schema_version', '1') != target_version:
+            return self.upgrade_properties()
+        return properties
+
+    def acl_key(self):
+        """
+        Key of the inputs of the ACL of this item, its status and acl_fields, under which
+        its ACL-derived results are cached (see TypeInfo.acl_cache). None if the ACL of
+        its type is not cached.
+        """
+        acl_fields = self.type_info.acl_fields
+        if acl_fields is None:
+            return None
+        try:
+            properties = self.acl_properties()
+        except KeyError:  # not there yet
+            return None
+        return json.dumps([properties.get(field) for field in ('status',) + acl_fields], sort_keys=True)
+
     def __repr__(self):
         return '<%s at %s>' % (type(self).__name__, resource_path(self))
 
@@ -614,7 +645,11 @@ class Item(Resource):
         # so that upgrade on GET can work.
         properties = self.__json__(request)
         # use schema_links rather than DB links so upgrades work on ES GETs
-        for path in self.type_info.schema_links:
+        schema_links = self.type_info.schema_links
+        # load the linked items all at once rather than one by one in uuid_to_path
+        self.registry[CONNECTION].get_by_uuids(
+            [uuid for path in schema_links for uuid in simple_path_ids(properties, path)])
+        for path in schema_links:
             uuid_to_path(request, properties, path)
 
         # if indexing, add the uuid of this object to request._linked_uuids
@@ -701,18 +736,17 @@ class Item(Resource):
     def embedded(self):
         """
         Use the embedded_list defined for the individual types to create the
-        embedded attribute through expansion using add_default_embeds
+        embedded attribute through expansion using add_default_embeds.
+        Computed once per type, see TypeInfo.embedded
         """
-        total_schema = self.schema.get('properties', {}).copy()
-        calc_props_schema = {}
-        types = self.registry[TYPES]
-        if self.registry['calculated_properties']:
-            for calc_props_key, calc_props_val in self.registry['calculated_properties'].props_for(self).items():
-                if calc_props_val.schema:
-                    calc_props_schema[calc_props_key] = calc_props_val.schema
-        total_schema.update(calc_props_schema)
-        this_type = self.type_info.item_type
-        return add_default_embeds(this_type, types, self.embedded_list, total_schema)
+        return list(self.type_info.embedded)
+
+    @reify
+    def embedded_plan(self):
+        """ The compiled EmbeddedPlan of `embedded`, shared by all items of the type unless it is overridden """
+        if type(self).embedded is Item.embedded:
+            return self.type_info.embedded_plan
+        return EmbeddedPlan.compile(self.embedded)
 
     @calculated_property(name='@type', schema={
         "title": "Type",
@@ -742,6 +776,16 @@ class Item(Resource):
         }
     })
     def principals_allowed(self):
+        acl_key = self.acl_key()
+        if acl_key is None:
+            return self._principals_allowed()
+        cache_key = ('principals_allowed', acl_key)
+        allowed = self.type_info.acl_cache.get(cache_key)
+        if allowed is None:
+            allowed = self.type_info.acl_cache[cache_key] = self._principals_allowed()
+        return {permission: list(principals) for permission, principals in allowed.items()}
+
+    def _principals_allowed(self):
         allowed = {}
         # these are the relevant Item permissions
         for permission in ('view', 'edit'):
@@ -12,6 +12,7 @@ from dcicutils.misc_utils import ignored
 from dcicutils.bundle_utils import SchemaManager
 from snovault.schema_validation import (
     SerializingSchemaValidator,
+    get_pending_identifiers,
     is_check_only_request,
     parse_skip_links,
 )
@@ -288,6 +289,8 @@ def linkTo(validator, linkTo, instance, schema):
 
     request = get_current_request()
     collections = request.registry[COLLECTIONS]
+    pending = get_pending_identifiers(request)
+    pending_uuid = pending.resolve(linkTo, instance) if pending is not None else None
     if validator.is_type(linkTo, "string"):
         base = collections.get(linkTo, request.root)
         linkTo = [linkTo] if linkTo else []
@@ -296,20 +299,25 @@ def linkTo(validator, linkTo, instance, schema):
     else:
         raise Exception("Bad schema")  # raise some sort of schema error
 
-    try:
-        item = find_resource(base, instance.replace(':', '%3A'))
-    except KeyError:
-        if not is_check_only_request():
-            error = "%r not found" % instance
-            yield ValidationError(error)
-        return
+    if pending_uuid is not None:
+        # links to items being bulk loaded but not written yet (see loadxl_direct)
+        item_uuid, item_types = UUID(pending_uuid), pending.type_names(pending_uuid)
+    else:
+        try:
+            item = find_resource(base, instance.replace(':', '%3A'))
+        except KeyError:
+            if not is_check_only_request():
+                error = "%r not found" % instance
+                yield ValidationError(error)
+            return
 
-    if not isinstance(item, Item):
-        error = "%r is not a linkable resource" % instance
-        yield ValidationError(error)
-        return
+        if not isinstance(item, Item):
+            error = "%r is not a linkable resource" % instance
+            yield ValidationError(error)
+            return
+        item_uuid, item_types = item.uuid, [item.type_info.name] + item.base_types
 
-    if linkTo and not set([item.type_info.name] + item.base_types).intersection(set(linkTo)):
+    if linkTo and not set(item_types).intersection(set(linkTo)):
         reprs = (repr(it) for it in linkTo)
         error = "%r is not of type %s" % (instance, ", ".join(reprs))
         yield ValidationError(error)
@@ -320,7 +328,7 @@ def linkTo(validator, linkTo, instance, schema):
         if not validator.is_type(linkEnum, "array"):
             raise Exception("Bad schema")
 
-        if not any(UUID(enum_uuid) == item.uuid for enum_uuid in linkEnum):
+        if not any(UUID(enum_uuid) == item_uuid for enum_uuid in linkEnum):
             reprs = ', '.join(repr(it) for it in linkTo)
             error = "%r is not one of %s" % (instance, reprs)
             yield ValidationError(error)
@@ -337,7 +345,7 @@ def linkTo(validator, linkTo, instance, schema):
             user = request.root[userid]
             submits_for = user.upgrade_properties().get('submits_for')
             if (submits_for is not None and
-                    not any(UUID(uuid) == item.uuid for uuid in submits_for) and
+                    not any(UUID(uuid) == item_uuid for uuid in submits_for) and
                     not request.has_permission('submit_for_any')):
                 error = "%r is not in user submits_for" % instance
                 yield ValidationError(error)
@@ -468,7 +476,18 @@ def extract_schema_default(schema, path):
 format_checker = FormatChecker()
 
 
-def validate(schema, data, current=None, validate_current=False):
+def make_schema_validator(schema):
+    """
+    Builds the SchemaValidator used by `validate` for the given schema. Building
+    one is not free, so callers validating many items of the same type may build
+    it once and pass it to `validate`. SchemaValidator is not thread safe (see
+    load_schema), so never share one beyond a single request.
+    """
+    resolver = NoRemoteResolver.from_schema(schema)
+    return SchemaValidator(schema, resolver=resolver, format_checker=format_checker)
+
+
+def validate(schema, data, current=None, validate_current=False, validator=None):
     """
     Validate the given data using a schema. Optionally provide current data
     to allow IgnoreUnchanged validation errors. If validate_current is set,
@@ -481,12 +500,13 @@ def validate(schema, data, current=None, validate_current=False):
         data (dict): new item contents
         current (dict): existing item contents
         validate_current (bool): whether to validate against current
+        validator (SchemaValidator): validator for schema from make_schema_validator,
+                                     built on the fly if not provided
 
     Returns:
         dict validated contents, list of errors
     """
-    resolver = NoRemoteResolver.from_schema(schema)
-    sv = SchemaValidator(schema, resolver=resolver, format_checker=format_checker)
+    sv = validator or make_schema_validator(schema)
     validated, errors = sv.serialize(data)
     # validate against current contents if validate_current is set
     if current and validate_current:
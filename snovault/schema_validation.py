@@ -66,9 +66,18 @@ def get_resource_base(validator, linkTo):
     return resource_base
 
 
+def get_pending_identifiers(request=None):
+    """ Returns the identifiers of items that are being bulk loaded into the current request's
+        transaction but are not written yet, or None. See loadxl_direct.PendingIdentifiers.
+    """
+    request = request if request is not None else get_current_request()
+    return getattr(request, '_pending_identifiers', None)
+
+
 def normalize_links(validator, links, linkTo):
     skip_links = parse_skip_links()
     resource_base = get_resource_base(validator, linkTo)
+    pending = get_pending_identifiers()
     normalized_links = []
     errors = []
     for link in links:
@@ -83,6 +92,9 @@ def normalize_links(validator, links, linkTo):
                         break
                 else:
                     raise KeyError
+            if pending is not None and (pending_uuid := pending.resolve(linkTo, link)):
+                normalized_links.append(pending_uuid)
+                continue
             normalized_links.append(
                 str(find_resource(resource_base, link.replace(':', '%3A')).uuid)
             )
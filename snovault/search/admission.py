@@ -0,0 +1,214 @@
+"""
+Admission control for heavy search requests, see SearchAdmission.
+"""
+
+import collections
+import structlog
+import threading
+import time
+
+from pyramid.httpexceptions import HTTPTooManyRequests
+from pyramid.settings import asbool
+from pyramid.view import view_config
+
+from ..interfaces import SEARCH_ADMISSION
+from ..util import debug_log
+
+
+log = structlog.getLogger(__name__)
+
+
+def includeme(config):
+    """ Registers SearchAdmission (or None) under SEARCH_ADMISSION, and its tween. Settings:
+            * search.admission - turns admission control on (default off)
+            * search.admission.heavy_cost - estimated cost from which a request is heavy (default 10)
+            * search.admission.max_heavy - heavy requests served at once per process (default 4)
+            * search.admission.max_heavy_per_principal - heavy requests served at once per user and
+              process (default 2)
+            * search.admission.queue_timeout - seconds a heavy request waits for a slot before it is
+              turned away (default 5)
+            * search.admission.retry_after - Retry-After (seconds) of turned away requests (default 30)
+    """
+    config.add_route('search_admission_stats', '/search-admission-stats')
+    settings = config.registry.settings
+    if asbool(settings.get('search.admission', False)):
+        config.registry[SEARCH_ADMISSION] = SearchAdmission(
+            heavy_cost=int(settings.get('search.admission.heavy_cost', 10)),
+            max_heavy=int(settings.get('search.admission.max_heavy', 4)),
+            max_heavy_per_principal=int(settings.get('search.admission.max_heavy_per_principal', 2)),
+            queue_timeout=float(settings.get('search.admission.queue_timeout', 5)),
+            retry_after=int(settings.get('search.admission.retry_after', 30)),
+        )
+    else:
+        config.registry[SEARCH_ADMISSION] = None
+    config.add_tween('snovault.search.admission.admission_tween_factory', under='snovault.stats.stats_tween_factory')
+    config.scan(__name__)
+
+
+class SearchAdmission(object):
+    """
+    Caps the heavy search requests (limit=all, exports, compound searches, searches on many types
+    or facets, see `estimate_cost`) a process serves at once, in all (`max_heavy`) and per user
+    (`max_heavy_per_principal`), so a handful of them cannot starve all other traffic.
+
+    A heavy request over either cap is queued for up to `queue_timeout` seconds; if no slot frees
+    up by then it is answered with 429 and a Retry-After of `retry_after` seconds. A slot is held
+    until the response body has been sent, as limit=all results are streamed.
+    Other requests are never held up.
+    """
+    SEARCH_PATHS = ['/search', '/search/', '/search/@@export', '/compound_search']
+    EXPORT_FORMATS = ['ndjson', 'tsv']
+    # what requests cost, in units of a regular search page
+    ALL_RESULTS_COST = 10
+    EXPORT_COST = 10
+    COMPOUND_SEARCH_COST = 2
+    ALL_TYPES_COST = 3
+    RESULTS_PER_COST = 100
+
+    def __init__(self, heavy_cost=10, max_heavy=4, max_heavy_per_principal=2, queue_timeout=5, retry_after=30):
+        self.heavy_cost = heavy_cost
+        self.max_heavy = max_heavy
+        self.max_heavy_per_principal = max_heavy_per_principal
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._active = collections.Counter()  # principal -> heavy requests being served
+        self._condition = threading.Condition()
+        self._stats = collections.Counter()
+
+    @classmethod
+    def estimate_cost(cls, request):
+        """ Estimated cost of a request from its path and parameters alone (0 for anything but searches) """
+        params = request.params
+        limit = params.get('limit')
+        if request.path not in cls.SEARCH_PATHS and limit != 'all':
+            return 0
+        cost = 1
+        if limit == 'all':
+            cost += cls.ALL_RESULTS_COST
+        elif limit is not None and limit.isdigit():
+            cost += int(limit) // cls.RESULTS_PER_COST
+        if request.path.endswith('@@export') or params.get('format') in cls.EXPORT_FORMATS:
+            cost += cls.EXPORT_COST
+        if request.path == '/compound_search':
+            cost += cls.COMPOUND_SEARCH_COST
+            try:
+                if request.json_body.get('limit') == 'all':
+                    cost += cls.ALL_RESULTS_COST
+            except Exception:
+                pass
+        types = [doc_type for doc_type in params.getall('type') if doc_type != '*']
+        cost += cls.ALL_TYPES_COST if not types or 'Item' in types else len(types) - 1
+        cost += len(params.getall('additional_facet'))
+        return cost
+
+    @staticmethod
+    def principal_for(request):
+        """
+        Who a request is for: its authenticated user, or else its client address. The unauthenticated
+        userid is not used, as a client could name any user in it and so use up the slots of others.
+        """
+        try:
+            userid = request.authenticated_userid
+        except Exception:
+            userid = None
+        return userid or 'anonymous:%s' % request.remote_addr
+
+    def _admissible(self, principal):
+        return (sum(self._active.values()) < self.max_heavy
+                and self._active[principal] < self.max_heavy_per_principal)
+
+    def acquire(self, principal):
+        """ Takes a heavy request slot for principal, waiting up to queue_timeout. Returns whether it got one. """
+        with self._condition:
+            if self._admissible(principal):
+                self._stats['admitted'] += 1
+            else:
+                self._stats['queued'] += 1
+                started = time.time()
+                if not self._condition.wait_for(lambda: self._admissible(principal), self.queue_timeout):
+                    self._stats['rejected'] += 1
+                    return False
+                self._stats['admitted_after_queueing'] += 1
+                self._stats['queue_time'] += time.time() - started
+            self._active[principal] += 1
+            return True
+
+    def release(self, principal):
+        with self._condition:
+            self._active[principal] -= 1
+            if self._active[principal] <= 0:
+                del self._active[principal]
+            self._condition.notify_all()
+
+    def too_many_requests(self):
+        response = HTTPTooManyRequests('Too many large searches are running, try again later')
+        response.headers['Retry-After'] = str(self.retry_after)
+        return response
+
+    def stats(self):
+        stats = {name: self._stats[name]
+                 for name in ['admitted', 'queued', 'admitted_after_queueing', 'rejected']}
+        stats['queue_time'] = round(self._stats['queue_time'], 3)
+        with self._condition:
+            stats['active'] = sum(self._active.values())
+            stats['active_principals'] = len(self._active)
+        stats.update(heavy_cost=self.heavy_cost, max_heavy=self.max_heavy,
+                     max_heavy_per_principal=self.max_heavy_per_principal)
+        return stats
+
+
+class ReleasingAppIter(object):
+    """ Response body iterator that calls `release` once it is closed """
+
+    def __init__(self, app_iter, release):
+        self.app_iter = app_iter
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            release, self.release = self.release, None
+            if release is not None:
+                release()
+
+
+def admission_tween_factory(handler, registry):
+    admission = registry.get(SEARCH_ADMISSION)
+    if admission is None:
+        return handler
+
+    def admission_tween(request):
+        if admission.estimate_cost(request) < admission.heavy_cost:
+            return handler(request)
+        principal = admission.principal_for(request)
+        started = time.time()
+        if not admission.acquire(principal):
+            log.warning('Turned away heavy search request %s of %s' % (request.path_qs, principal))
+            return admission.too_many_requests()
+        if getattr(request, '_stats', None) is not None:
+            request._stats['admission_time'] = int((time.time() - started) * 1e6)
+        try:
+            response = handler(request)
+        except Exception:
+            admission.release(principal)
+            raise
+        if isinstance(response.app_iter, (list, tuple)):
+            admission.release(principal)
+        else:  # streamed, so still being worked on
+            response.app_iter = ReleasingAppIter(response.app_iter, lambda: admission.release(principal))
+        return response
+
+    return admission_tween
+
+
+@view_config(route_name='search_admission_stats', request_method='GET', permission='index')
+@debug_log
+def search_admission_stats(context, request):
+    """ Admitted, queued and rejected heavy search requests of this process """
+    admission = request.registry.get(SEARCH_ADMISSION)
+    return {'enabled': admission is not None, **(admission.stats() if admission is not None else {})}
@@ -171,6 +171,44 @@ class CompoundSearchBuilder:
         for hit in es_results['hits'].get('hits', []):
             yield hit['_source']['embedded']
 
+    @classmethod
+    def build_filter_block_queries(cls, context, request, filter_blocks, flags, type_flag,
+                                   global_flags=None, from_=0, to=10):
+        """ Compiles the bool query of each filter block in-process, naming each after its block.
+            Gives the same queries as /build_query would for the block's query string, without a
+            subrequest per block or building sort, facets and aggregations that are thrown away.
+
+        :param context: context of the compound search
+        :param request: current request; its principals apply to every block
+        :param filter_blocks: filter blocks to compile
+        :param flags: named flags, applied to the blocks that list them in flags_applied
+        :param type_flag: type query substring, added to blocks that do not specify a type
+        :param global_flags: query string applied to every block
+        :return: list of bool queries, one per block
+        """
+        principals = request.effective_principals
+        sub_queries = []
+        for block_index, block in enumerate(filter_blocks):
+            block_query = block[cls.QUERY]
+            flags_applied = block[cls.FLAGS_APPLIED]
+            query = block_query
+            if global_flags:
+                query = cls.combine_query_strings(global_flags, block_query)
+            for applied_flag in flags_applied:
+                for flag in flags:
+                    if flag[cls.NAME] == applied_flag:
+                        query = cls.combine_query_strings(query, flag[cls.QUERY])
+                        break
+            query = cls._add_type_to_flag_if_needed(query, type_flag)
+            # only carries the block's params, it is never invoked
+            subreq = cls.build_subreq_from_single_query(request, query, route=cls.BUILD_QUERY_URL,
+                                                        from_=from_, to=to)
+            sub_query = SearchBuilder.build_filter_query(context, subreq, principals=principals)
+            # See https://www.elastic.co/guide/en/elasticsearch/reference/7.17/query-dsl-bool-query.html#named-queries
+            sub_query["bool"]["_name"] = str(block.get("name", block_index))  # note in ES7 numbers here must be cast to string
+            sub_queries.append(sub_query)
+        return sub_queries
+
     @staticmethod
     def execute_filter_set(context, request, filter_set, from_=0, to=10,
                            global_flags=None, return_generator=False, intersect=False):
@@ -237,27 +275,8 @@ class CompoundSearchBuilder:
         # Build the compound_query
         # Iterate through filter_blocks, adding global_flags if specified and adding flags if specified
         else:
-            sub_queries = []
-            for block_index, block in enumerate(filter_blocks):
-                block_query = block[cls.QUERY]
-                flags_applied = block[cls.FLAGS_APPLIED]
-                query = block_query
-                if global_flags:
-                    query = cls.combine_query_strings(global_flags, block_query)
-                for applied_flag in flags_applied:
-                    for flag in flags:
-                        if flag[cls.NAME] == applied_flag:
-                            query = cls.combine_query_strings(query, flag[cls.QUERY])
-                            break
-                query = cls._add_type_to_flag_if_needed(query, type_flag)
-                subreq = cls.build_subreq_from_single_query(request, query, route=cls.BUILD_QUERY_URL,
-                                                            from_=from_, to=to)
-                sub_query = request.invoke_subrequest(subreq).json[cls.QUERY]
-                # See https://www.elastic.co/guide/en/elasticsearch/reference/7.17/query-dsl-bool-query.html#named-queries
-                sub_query["bool"]["_name"] = str(block.get("name", block_index))  # note in ES7 numbers here must be cast to string
-                sub_queries.append(sub_query)
-
-
+            sub_queries = cls.build_filter_block_queries(context, request, filter_blocks, flags, type_flag,
+                                                         global_flags=global_flags, from_=from_, to=to)
             compound_query = LuceneBuilder.compound_search(sub_queries, intersect=intersect)
             compound_subreq = cls.build_subreq_from_single_query(request, ('?type=' + search_type))
 
@@ -292,7 +311,8 @@ class CompoundSearchBuilder:
                     index=search_builder_instance.es_index,
                     from_=from_,
                     size=to,
-                    session_id=search_builder_instance.search_session_id
+                    session_id=search_builder_instance.search_session_id,
+                    request=request
                 )
                 return cls.format_result_for_endpoint_response(request, es_results, filter_set, result_sort, search_builder_instance)
 
@@ -355,7 +375,8 @@ class CompoundSearchBuilder:
 @debug_log
 def build_query(context, request):
     """ Runs the query construction step of the search, returning the lucene query as the response.
-        Used as a helper for compound_search, making 1 sub-request per filter_block.
+        compound_search compiles the 'query' clause of its filter blocks in-process instead,
+        see CompoundSearchBuilder.build_filter_block_queries.
     """
     builder = SearchBuilder(context, request)
     builder._build_query()
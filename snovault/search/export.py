@@ -0,0 +1,134 @@
+"""
+Streaming export of search results as NDJSON or TSV, see SearchExport.
+"""
+
+import csv
+import io
+import itertools
+import json
+import structlog
+
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.view import view_config
+
+from ..resources import AbstractCollection
+from ..util import NDJSON, debug_log, simple_path_ids
+from .lucene_builder import LuceneBuilder
+from .search import SearchBuilder
+from .search_utils import execute_search_after
+
+
+log = structlog.getLogger(__name__)
+
+TSV = 'text/tab-separated-values'
+
+
+def includeme(config):
+    config.add_route('search_export', '/search/@@export')
+    config.scan(__name__)
+
+
+class SearchExport(object):
+    """
+    Exports all results of a search, one row per result, without ever holding more than one
+    page of them: pages are fetched with search_after on a point in time as the response body
+    is consumed. No facets, aggregations or totals are computed.
+
+    Takes the same filter, `q`, `sort` and `frame` params as /search/ (`limit` and `from` are ignored).
+    `field=` selects the fields of each row, as for /search/. Formats are:
+        * ndjson - one JSON object (the requested frame, or just the fields) per line
+        * tsv - a header line, then one line per result with a column per field; values of
+          fields that traverse lists are joined with ', '. Without `field=`, the columns are
+          @id and the table columns of the searched types.
+    """
+    FORMATS = {'ndjson': NDJSON, 'tsv': TSV}
+    PAGE_SIZE = 500
+    TSV_VALUE_SEPARATOR = ', '
+
+    def __init__(self, context, request, export_format, search_type=None):
+        if export_format not in self.FORMATS:
+            raise HTTPBadRequest('Unsupported export format %r, use one of %s'
+                                 % (export_format, ', '.join(sorted(self.FORMATS))))
+        self.request = request
+        self.export_format = export_format
+        self.builder = SearchBuilder(context, request, search_type)
+        self.builder.build_query()
+        self.builder.set_sort_order()
+        self.query, _, _ = LuceneBuilder.build_filters(request, self.builder.query, {'filters': []},
+                                                       self.builder.principals, self.builder.doc_types,
+                                                       self.builder.item_type_es_mapping)
+        self.fields = request.normalized_params.getall('field')
+        if export_format == 'tsv':
+            if not self.fields:
+                self.fields = ['@id'] + list(SearchBuilder.build_initial_columns(self.builder.schemas))
+                self.query['_source'] = ['embedded.' + field for field in self.fields]
+            self.builder.search_frame = 'embedded'
+
+    def rows(self):
+        """ Generator over the rows (frames) of all results; the first page is searched right away """
+        LuceneBuilder.verify_search_has_permissions(self.request, self.query)
+        pages = execute_search_after(es=self.builder.es, query=self.query, index=self.builder.es_index,
+                                     size=self.PAGE_SIZE, request=self.request)
+        first_page = next(pages)
+        hits = itertools.chain(first_page['hits']['hits'],
+                               (hit for page in pages for hit in page['hits']['hits']))
+        return self.builder._format_results(hits)
+
+    def format_value(self, value):
+        return json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+
+    def tsv_row(self, row):
+        return [self.TSV_VALUE_SEPARATOR.join(self.format_value(value) for value in simple_path_ids(row, field))
+                for field in self.fields]
+
+    def iter_chunks(self, rows):
+        """ Serializes rows, yielding the bytes of up to PAGE_SIZE of them at a time """
+        buffer = io.StringIO()
+        if self.export_format == 'tsv':
+            writer = csv.writer(buffer, delimiter='\t', lineterminator='\n')
+            writer.writerow(self.fields)
+        try:
+            for n, row in enumerate(rows, 1):
+                if self.export_format == 'tsv':
+                    writer.writerow(self.tsv_row(row))
+                else:
+                    buffer.write(json.dumps(row) + '\n')
+                if n % self.PAGE_SIZE == 0:
+                    yield buffer.getvalue().encode('utf-8')
+                    buffer.seek(0)
+                    buffer.truncate()
+        except Exception as e:
+            # the status was sent with the first chunk, so all that can be done is to cut the body short
+            log.error('Search export for %s failed: %r' % (self.request.url, e))
+            raise
+        yield buffer.getvalue().encode('utf-8')
+
+    def response(self):
+        response = self.request.response
+        response.content_type = self.FORMATS[self.export_format]
+        response.content_disposition = 'attachment; filename="search_results.%s"' % self.export_format
+        response.app_iter = self.iter_chunks(self.rows())
+        return response
+
+
+def export_search(context, request, search_type=None):
+    """ Returns a Response streaming the results of the search as NDJSON or TSV (see SearchExport) """
+    export_format = request.params.get('format', 'ndjson').lower()
+    return SearchExport(context, request, export_format, search_type=search_type).response()
+
+
+@view_config(route_name='search_export', request_method='GET', permission='search')
+@view_config(route_name='search', request_method='GET', permission='search', request_param='format=ndjson')
+@view_config(route_name='search', request_method='GET', permission='search', request_param='format=tsv')
+@debug_log
+def search_export(context, request):
+    """ Streams all results of a search as NDJSON (default) or, with format=tsv, TSV """
+    return export_search(context, request)
+
+
+@view_config(context=AbstractCollection, permission='list', request_method='GET', request_param='format=ndjson')
+@view_config(context=AbstractCollection, permission='list', request_method='GET', request_param='format=tsv')
+@debug_log
+def collection_export(context, request):
+    """ Streams all items of a collection, like collection_view but as NDJSON or TSV """
+    return export_search(context, request, search_type=context.type_info.name)
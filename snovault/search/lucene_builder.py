@@ -13,7 +13,8 @@ from .search_utils import (
     COMMON_EXCLUDED_URI_PARAMS, QUERY, FILTER, MUST, MUST_NOT, BOOL, MATCH, SHOULD,
     EXISTS, FIELD, NESTED, PATH, TERMS, RANGE, AGGS,  # REVERSE_NESTED,
     STATS,
-    schema_for_field, get_query_field, search_log, MAX_FACET_COUNTS,
+    schema_for_field, get_query_field, search_log, MAX_FACET_COUNTS, canonical_principals,
+    build_principals_filter, principals_on_filter,
 )
 
 
@@ -411,13 +412,9 @@ class LuceneBuilder:
     def initialize_field_filters(cls, request, principals, doc_types):
         """ Helper function for build_filters
             Initializes field filters with filters that exist on all searches, does some basic updates
+            (the principals filter is not a field filter, see build_principals_filter)
         """
         field_filters = {
-            'principals_allowed.view': {
-                'must_terms': principals,
-                'must_not_terms': [],
-                'add_no_value': None
-            },
             'embedded.@type.raw': {
                 'must_terms': doc_types,
                 'must_not_terms': [],
@@ -442,7 +439,7 @@ class LuceneBuilder:
         if 'OntologyTerm' not in doc_types:
             field_filters['embedded.@type.raw']['must_not_terms'].append('OntologyTerm')
 
-        # base filters only includes principals, doc_type and excludes some status and item types
+        # base filters only includes doc_type and excludes some status and item types
         # it is essentially useful for the group by facet terms aggregation
         base_field_filters = cls.create_field_filters(deepcopy(field_filters))
         return field_filters, base_field_filters
@@ -605,8 +602,9 @@ class LuceneBuilder:
         must_filters, must_not_filters, \
         must_filters_nested, must_not_filters_nested = cls.build_sub_queries(field_filters, es_mapping)
 
-        # initialize filter hierarchy
-        final_filters = {BOOL: {MUST: [f for _, f in must_filters], MUST_NOT: [f for _, f in must_not_filters]}}
+        # initialize filter hierarchy, permissions first
+        final_filters = {BOOL: {MUST: [build_principals_filter(principals)] + [f for _, f in must_filters],
+                                MUST_NOT: [f for _, f in must_not_filters]}}
 
         # Build nested queries
         final_nested_query = cls.handle_nested_filters_v2(must_filters_nested, must_not_filters_nested, es_mapping)
@@ -764,6 +762,8 @@ class LuceneBuilder:
             :param active_filter: which "sub part" of the facet filters we are examining
             :param filter_type: one of MUST or MUST_NOT
         """
+        if principals_on_filter(active_filter) is not None:
+            return  # permissions always apply
         if BOOL in active_filter and SHOULD in active_filter[BOOL]:
             cls._check_and_remove_bool_should(facet_filters, active_filter, query_field, filter_type)
         elif TERMS in active_filter:
@@ -792,7 +792,7 @@ class LuceneBuilder:
         """
         if not search_filters or BOOL not in search_filters:  # a sane default if this happens -Will 11/17/20
             log.error('Encountered an unexpected query format: %s' % search_filters)
-            return {BOOL: {MUST: [{TERMS: {'principals_allowed.view': ['system.Everyone']}}]}}
+            return {BOOL: {MUST: [build_principals_filter(['system.Everyone'])]}}
 
         facet_filters = deepcopy(search_filters[BOOL])
 
@@ -1183,17 +1183,17 @@ class LuceneBuilder:
                 if 'bool' in boolean_clause and 'must' in boolean_clause['bool']:  # principals_allowed.view is on 'must'
                     possible_permission_block = boolean_clause['bool']['must']
                     for entry in possible_permission_block:
-                        if 'terms' in entry:
-                            if 'principals_allowed.view' in entry['terms']:
-                                effective_principals_on_query = entry['terms']['principals_allowed.view']
-                                if effective_principals_on_query != request.effective_principals:
-                                    raise QueryConstructionException(
-                                        query_type='principals',
-                                        func='verify_search_has_permissions',
-                                        msg='principals_allowed was modified - see application logs')
-                                else:
-                                    found = True
-                                    break
+                        effective_principals_on_query = principals_on_filter(entry)  # see build_principals_filter
+                        if effective_principals_on_query is not None:
+                            if (canonical_principals(effective_principals_on_query)
+                                    != canonical_principals(request.effective_principals)):
+                                raise QueryConstructionException(
+                                    query_type='principals',
+                                    func='verify_search_has_permissions',
+                                    msg='principals_allowed was modified - see application logs')
+                            else:
+                                found = True
+                                break
         except QueryConstructionException:
             search_log(log_handler=log, msg='Detected URL query param manipulation, principals_allowed.view was'
                                             ' modified from %s to %s' % (request.effective_principals,
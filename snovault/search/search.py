@@ -15,9 +15,12 @@ from snovault import (
     AbstractCollection,
     TYPES,
     COLLECTIONS,
+    FACET_AGGREGATION_CACHE,
+    SEARCH_RESPONSE_CACHE,
     STORAGE
 )
 from snovault.elasticsearch import ELASTIC_SEARCH
+from snovault.json_renderer import json_renderer
 from snovault.util import (
     debug_log,
 )
@@ -26,9 +29,9 @@ from snovault.typeinfo import AbstractTypeInfo
 from ..util import is_admin_request
 from .lucene_builder import LuceneBuilder
 from .search_utils import (
-    find_nested_path, schema_for_field, get_es_index, get_es_mapping, is_date_field, is_numerical_field,
+    find_nested_path, schema_for_field, get_es_index, get_es_mapping, is_date_field, is_numerical_field, IndexMapping,
     is_array_of_numerical_field,
-    execute_search, make_search_subreq, build_sort_dicts,
+    execute_search, execute_search_after, make_search_subreq, build_sort_dicts, schema_memo,
     NESTED, COMMON_EXCLUDED_URI_PARAMS, MAX_FACET_COUNTS,
 )
 
@@ -38,6 +41,10 @@ log = structlog.getLogger(__name__)
 
 def includeme(config):
     config.add_route('search', '/search{slash:/?}')
+    config.include('.search_cache')
+    config.include('.export')
+    config.include('.search_jobs')
+    config.include('.admission')
     config.scan(__name__)
 
 
@@ -65,6 +72,7 @@ class SearchBuilder:
     DEBUG = 'debug'  # search debug parameter
     CARDINALITY_RANGE = '-3.4028E38-*'
     PAGINATION_SIZE = 10  # for ECS, 10 is much better than 25, and may even do better when lowered
+    STREAM_CHUNK_SIZE = 65536  # characters of limit=all responses per chunk, see stream_response
     MISSING = object()
     SEARCH_INFO_HEADER_TYPES = [
         'Workflow'  # TODO: add types here as needed
@@ -103,20 +111,23 @@ class SearchBuilder:
         """
         if len(self.doc_types) == 1:  # extract mapping from storage if we're searching on a single doc type
             item_type_snake_case = ''.join(['_' + c.lower() if c.isupper() else c for c in self.doc_types[0]]).lstrip('_')
-            mappings = self.request.registry[STORAGE].read.mappings.get()
+            cached_mappings = self.request.registry[STORAGE].read.mappings
+            mappings = cached_mappings.get()
             if get_namespaced_index(self.request, item_type_snake_case) == self.es_index and self.es_index in mappings:
-                return mappings[self.es_index]['mappings']['properties']
+                return IndexMapping(mappings[self.es_index]['mappings']['properties'],
+                                    (self.es_index, 'cached', cached_mappings.generation))
             else:  # new item was added after last cache update, get directly via API
                 return get_es_mapping(self.es, self.es_index)
         return {}
 
     def _bootstrap_query(self, search_type=None, return_generator=False, forced_type='Search',
-                         custom_aggregations=None):
+                         custom_aggregations=None, principals=None):
         """ Helper method that will bootstrap metadata necessary for building a search query. """
         self.return_generator = return_generator  # whether or not this search should return a generator
         self.custom_aggregations = custom_aggregations  # any custom aggregations on this search
         self.forced_type = forced_type  # (mostly deprecated) search type
-        self.principals = self.request.effective_principals  # permissions to apply to this search
+        # permissions to apply to this search
+        self.principals = self.request.effective_principals if principals is None else principals
 
         # Initialized via outside function call
         # schemas for doc_types
@@ -139,6 +150,23 @@ class SearchBuilder:
         # Only needed if searching on a single item type
         self.item_type_es_mapping = self._get_es_mapping_if_necessary()
 
+    @classmethod
+    def build_filter_query(cls, context, request, principals=None):
+        """ Builds only the 'query' clause of the search for the given request: the text query and
+            filters, without sort, facets or aggregations (which never touch that clause).
+
+        :param context: context from request
+        :param request: request carrying the search params; need not be invoked
+        :param principals: principals to filter on, defaults to request.effective_principals
+        :return: the bool query, as found under query['query'] of the full search
+        """
+        builder = cls(context, request, skip_bootstrap=True)
+        builder._bootstrap_query(principals=principals)
+        builder.build_query()
+        query, _, _ = LuceneBuilder.build_filters(request, builder.query, {'filters': []}, builder.principals,
+                                                  builder.doc_types, builder.item_type_es_mapping)
+        return query['query']
+
     @property
     def forced_type_token(self):
         """ Do any processing needed to be applied to self.forced_type """
@@ -592,6 +620,25 @@ class SearchBuilder:
                         }
                     ))
 
+    def get_schema_facets(self):
+        """ Returns the enabled facets of the schema of the (single) searched type, as a list of
+            (field, facet) with facet copied for this search, and the set of its disabled facet fields.
+            Memoized per schema (see search_utils.schema_memo).
+        """
+        memo = schema_memo(self.request.registry[TYPES], self.doc_types)
+        schema_facets = memo.get('facets')
+        if schema_facets is None:
+            current_type_schema = self.request.registry[TYPES][self.doc_types[0]].schema
+            facets, disabled_facet_fields = [], set()
+            for schema_facet in current_type_schema.get('facets', {}).items():
+                if schema_facet[1].get('disabled', False) or schema_facet[1].get(self.DEFAULT_HIDDEN, False):
+                    disabled_facet_fields.add(schema_facet[0])
+                    continue  # Skip disabled facets.
+                facets.append(schema_facet)
+            schema_facets = memo['facets'] = (facets, frozenset(disabled_facet_fields))
+        facets, disabled_facet_fields = schema_facets
+        return [(field, dict(facet)) for field, facet in facets], set(disabled_facet_fields)
+
     # URL query param: when truthy, suppress every default facet computation
     # and only run aggregations for fields explicitly listed in `additional_facet`.
     # Use it for endpoints that want snovault's correct filter construction
@@ -660,13 +707,8 @@ class SearchBuilder:
         # Add facets from schema if one Item type is defined.
         # Also, conditionally add extra appendable facets if relevant for type from schema.
         if len(self.doc_types) == 1 and self.doc_types[0] != 'Item':
-            if 'facets' in current_type_schema:
-                schema_facets = OrderedDict(current_type_schema['facets'])
-                for schema_facet in schema_facets.items():
-                    if schema_facet[1].get('disabled', False) or schema_facet[1].get(self.DEFAULT_HIDDEN, False):
-                        disabled_facet_fields.add(schema_facet[0])
-                        continue  # Skip disabled facets.
-                    facets.append(schema_facet)
+            schema_facets, disabled_facet_fields = self.get_schema_facets()
+            facets.extend(schema_facets)
 
         # Add facets for any non-schema ?field=value filters requested in the search (unless already set, via used_facet_fields)
         used_facet_fields = set()
@@ -1191,53 +1233,33 @@ class SearchBuilder:
                 yield frame_result
             return
 
-    def get_all_subsequent_results(self, extra_requests_needed_count, size_increment):
+    def get_all_subsequent_results(self, pages):
         """
-        Calls `execute_search` in paginated manner iteratively until all results have been yielded.
+        Yields the hits of the remaining pages of a search started by `execute_search_for_all_results`.
         """
-        from_ = 0
-        # Facet aggregations run in a `global` (whole-index) context, so they cost the same on
-        # every page regardless of `from_`/`size` - but format_facets only ever reads them from
-        # the first page's response. Drop `aggs` (and total-hit tracking, also only needed on the
-        # first page) from subsequent-page queries so we don't re-pay that cost on every page.
-        subsequent_query = {k: v for k, v in self.query.items() if k != 'aggs'}
-        subsequent_query['track_total_hits'] = False
-        while extra_requests_needed_count > 0:
-            # print(str(extra_requests_needed_count) + " requests left to get all results.")
-            from_ = from_ + size_increment
-            subsequent_search_result = execute_search(es=self.es, query=subsequent_query, index=self.es_index,
-                                                      from_=from_, size=size_increment,
-                                                      session_id=self.search_session_id)
-            extra_requests_needed_count -= 1
-            for hit in subsequent_search_result['hits'].get('hits', []):
+        for page in pages:
+            for hit in page['hits'].get('hits', []):
                 yield hit
 
     def execute_search_for_all_results(self, size_increment=100):
         """
-        Returns a generator that iterates over _all_ results for search.
-        Calls `execute_search` in paginated manner iteratively until all results have been yielded
-        via `get_all_subsequent_results`.
+        Returns the first page of results for search, its hits chained with a generator over
+        the hits of all further pages (see `get_all_subsequent_results`). Pages are fetched with
+        search_after on a point in time (see search_utils.execute_search_after) as they are
+        consumed, so the cost per page does not grow with its depth.
 
         :param size_increment: number of results to get per page, default 100
         :return: all es_results that matched the given query
         """
-        es_result = execute_search(es=self.es, query=self.query, index=self.es_index, from_=0, size=size_increment,
-                                   session_id=self.search_session_id)
-
-        total_results_expected = es_result['hits'].get('total', {}).get('value', 0)
-
-        # Decrease by 1 (first es_result already happened)
-        extra_requests_needed_count = math.ceil(total_results_expected / size_increment) - 1
-
-        if extra_requests_needed_count > 0:
-            # Returns a generator as value of es_result['hits']['hits']
-            # Will be returned directly if self.return_generator is true
-            # or converted to list if meant to be HTTP response.
-            # Theoretical but unnecessary future: Consider allowing to return HTTP Stream of results w. return_generator=true (?)
-            es_result['hits']['hits'] = itertools.chain(
-                es_result['hits']['hits'],
-                self.get_all_subsequent_results(extra_requests_needed_count, size_increment)
-            )
+        pages = execute_search_after(es=self.es, query=self.query, index=self.es_index, size=size_increment,
+                                     session_id=self.search_session_id, request=self.request)
+        es_result = next(pages)
+        # Returns a generator as value of es_result['hits']['hits'], which is returned directly
+        # if self.return_generator is true or else streamed to the response (see format_results)
+        es_result['hits']['hits'] = itertools.chain(
+            es_result['hits']['hits'],
+            self.get_all_subsequent_results(pages)
+        )
         return es_result
 
     def execute_search(self):
@@ -1246,9 +1268,24 @@ class SearchBuilder:
         if self.size == 'all':
             es_results = self.execute_search_for_all_results()
         else:  # from_, size are integers
-            es_results = execute_search(es=self.es, query=self.query, index=self.es_index,
-                                        from_=self.from_, size=self.size,
-                                        session_id=self.search_session_id)
+            es_results = self.execute_search_with_cached_aggregations()
+        return es_results
+
+    def execute_search_with_cached_aggregations(self):
+        """ Executes a paged search, taking its aggregations from the facet aggregation cache if there """
+        cache = self.request.registry.get(FACET_AGGREGATION_CACHE)
+        cache_key, storable = cache.key_for(self) if cache is not None else (None, False)
+        aggregations = cache.get(cache_key) if cache_key is not None else None
+        query = self.query
+        if aggregations is not None:  # only fetch the hits
+            query = {key: value for key, value in query.items() if key != 'aggs'}
+        es_results = execute_search(es=self.es, query=query, index=self.es_index,
+                                    from_=self.from_, size=self.size,
+                                    session_id=self.search_session_id, request=self.request)
+        if aggregations is not None:
+            es_results['aggregations'] = aggregations
+        elif cache_key is not None and 'aggregations' in es_results:
+            cache.set(cache_key, es_results['aggregations'], storable)
         return es_results
 
     def format_results(self, es_results):
@@ -1280,7 +1317,7 @@ class SearchBuilder:
         # that iterates over es_results['hits']['hits'] regardless of its structure.
         graph = self._format_results(es_results['hits']['hits'])
 
-        if self.return_generator:
+        if self.return_generator or self.streams_graph():
             # Preserve `graph` as generator.
             self.response['@graph'] = graph
         else:
@@ -1291,6 +1328,45 @@ class SearchBuilder:
         if self.search_session_id:  # Is 'None' if e.g. limit=all
             self.request.response.set_cookie('searchSessionID', self.search_session_id)
 
+    def streams_graph(self):
+        """ limit=all responses to top-level requests for this search are streamed (see stream_response) """
+        return (getattr(self, 'size', None) == 'all' and not self.return_generator and self.request.__parent__ is None
+                and getattr(self.request, 'context', None) is self.context)
+
+    def stream_response(self, response):
+        """
+        Returns a Response whose body is the JSON of the given search response, with its
+        '@graph' generator serialized as it is consumed, a chunk of about STREAM_CHUNK_SIZE
+        characters at a time, so limit=all results are never all held in memory.
+        """
+        graph = response.pop('@graph')
+        head = json_renderer.dumps(response)
+        search_response = self.request.response
+        search_response.content_type = 'application/json'
+        search_response.app_iter = self._iter_json_chunks(head[:-1] + (', ' if response else '') + '"@graph": [',
+                                                          graph)
+        return search_response
+
+    def _iter_json_chunks(self, head, graph):
+        chunk = [head]
+        chunk_size = len(head)
+        separator = ''
+        try:
+            for result in graph:
+                result = separator + json_renderer.dumps(result)
+                separator = ', '
+                chunk.append(result)
+                chunk_size += len(result)
+                if chunk_size >= self.STREAM_CHUNK_SIZE:
+                    yield ''.join(chunk).encode('utf-8')
+                    chunk, chunk_size = [], 0
+        except Exception as e:
+            # the status was sent with the first chunk, so all that can be done is to cut the body short
+            log.error('Search results stream for %s failed: %r' % (self.request.url, e))
+            raise
+        chunk.append(']}')
+        yield ''.join(chunk).encode('utf-8')
+
     def _sort_custom_facets(self):
         """ Applies custom sort to facets based on a dictionary provided on the type definition
 
@@ -1402,10 +1478,24 @@ class SearchBuilder:
 
         :returns: a search response (based on the __init__ parameters)
         """
+        cache = self.request.registry.get(SEARCH_RESPONSE_CACHE)
+        cache_key, storable = cache.key_for(self) if cache is not None else (None, False)
+        if cache_key is not None:
+            response = cache.get(self.request, cache_key)
+            if response is not None:
+                return response
         self._build_query()
         es_results = self.execute_search()
         self.format_results(es_results)
-        return self.get_response()
+        response = self.get_response()
+        if self.streams_graph() and not isinstance(response.get('@graph'), list):
+            return self.stream_response(response)
+        if cache_key is not None:
+            if storable:
+                cache.set(cache_key, response, self.request.response.status_code)
+            else:
+                cache.skip()
+        return response
 
 
 @view_config(route_name='search', request_method='GET', permission='search')
@@ -0,0 +1,326 @@
+"""
+Opt-in caches of /search/ responses, see SearchResponseCache, and of the facet aggregations
+of unfiltered searches, see FacetAggregationCache.
+"""
+
+import collections
+import hashlib
+import json
+import structlog
+import threading
+import time
+
+from pyramid.settings import asbool
+from pyramid.view import view_config
+
+from ..elasticsearch.interfaces import INDEX_GENERATIONS
+from ..interfaces import FACET_AGGREGATION_CACHE, SEARCH_RESPONSE_CACHE
+from ..json_renderer import json_renderer
+from ..redis.interfaces import REDIS
+from ..util import debug_log
+
+
+log = structlog.getLogger(__name__)
+
+
+def includeme(config):
+    """ Registers the response cache (or None) under SEARCH_RESPONSE_CACHE. Settings:
+            * search.response_cache - turns the cache on (default off)
+            * search.response_cache.capacity - max number of responses kept in process (default 256)
+            * search.response_cache.max_entry_bytes - larger responses are not cached (default 1MB)
+            * search.response_cache.refresh_window - seconds after an index write during which
+              responses are not cached, as the write may not be searchable yet (default 1, the ES
+              refresh interval)
+            * search.response_cache.shared - also keep responses in Redis (requires redis.server)
+            * search.response_cache.shared_ttl - seconds responses are kept in Redis (default 3600)
+            * search.response_cache.single_process - allows the cache without redis.server, only for
+              deployments that index and serve searches from this one process (default off)
+        Registers the facet aggregation cache (or None) under FACET_AGGREGATION_CACHE. Settings:
+            * search.facet_cache - turns the cache on (default off)
+            * search.facet_cache.capacity - max number of aggregation blocks kept in process (default 128)
+            * search.facet_cache.refresh_window - as search.response_cache.refresh_window (default 1)
+            * search.facet_cache.single_process - as search.response_cache.single_process (default off)
+    """
+    config.add_route('search_cache_stats', '/search-cache-stats')
+    settings = config.registry.settings
+    if asbool(settings.get('search.response_cache', False)) and sees_all_index_writes(settings, 'search.response_cache'):
+        config.registry[SEARCH_RESPONSE_CACHE] = SearchResponseCache(
+            config.registry,
+            capacity=int(settings.get('search.response_cache.capacity', 256)),
+            max_entry_bytes=int(settings.get('search.response_cache.max_entry_bytes', 1000000)),
+            refresh_window=float(settings.get('search.response_cache.refresh_window', 1.0)),
+            shared=asbool(settings.get('search.response_cache.shared', False)),
+            shared_ttl=int(settings.get('search.response_cache.shared_ttl', 3600)),
+        )
+    else:
+        config.registry[SEARCH_RESPONSE_CACHE] = None
+    if asbool(settings.get('search.facet_cache', False)) and sees_all_index_writes(settings, 'search.facet_cache'):
+        config.registry[FACET_AGGREGATION_CACHE] = FacetAggregationCache(
+            config.registry,
+            capacity=int(settings.get('search.facet_cache.capacity', 128)),
+            refresh_window=float(settings.get('search.facet_cache.refresh_window', 1.0)),
+        )
+    else:
+        config.registry[FACET_AGGREGATION_CACHE] = None
+    config.scan(__name__)
+
+
+def sees_all_index_writes(settings, name):
+    """ Whether the cache turned on by setting `name` would see index writes of every process. That takes
+        index generations kept in Redis, unless `<name>.single_process` says there are no other processes.
+    """
+    if settings.get('redis.server') is not None or asbool(settings.get(name + '.single_process', False)):
+        return True
+    log.error('%s is set but redis.server is not, so index writes of other processes would go unseen;'
+              ' not caching (set %s.single_process if this is the only process)' % (name, name))
+    return False
+
+
+class SearchResponseCache(object):
+    """
+    Caches complete search responses, keyed by:
+        * the normalized query (see SearchBuilder.normalize_query), search type and custom aggregations
+        * a hash of the effective principals of the request, as results and actions depend on them
+        * the generations of the searched indices (see elasticsearch/index_generations.py)
+
+    Since every index write bumps the generation of its index, an entry is never served
+    after the index changed; old entries are simply not looked up again and age out.
+    Responses computed within `refresh_window` seconds of the last write to a searched index
+    are not stored, as ES may not have made that write searchable yet.
+
+    Only top-level, paged searches are cached: no subrequests, generators, limit=all or debug.
+
+    Entries are kept in an in-process LRU of `capacity` responses and, if `shared`, in Redis
+    so that all processes share them.
+    """
+    KEY_PREFIX = 'search-cache'
+
+    def __init__(self, registry, capacity=256, max_entry_bytes=1000000, refresh_window=1.0,
+                 shared=False, shared_ttl=3600):
+        self.registry = registry
+        self.namespace = registry.settings.get('indexer.namespace') or ''
+        self.capacity = capacity
+        self.max_entry_bytes = max_entry_bytes
+        self.refresh_window = refresh_window
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+        if shared and registry.settings.get('redis.server') is None:
+            log.error('search.response_cache.shared is set but redis.server is not; only caching in process')
+
+    @property
+    def redis(self):
+        """ Raw Redis client for the shared tier, or None """
+        redis = self.registry.get(REDIS) if self.shared else None
+        return redis.redis if redis is not None else None
+
+    @staticmethod
+    def cacheable(search_builder):
+        request = search_builder.request
+        return (request.method == 'GET'
+                and request.__parent__ is None
+                and not search_builder.return_generator
+                and not search_builder.debug_is_active
+                and request.normalized_params.get('limit') not in ('all', ''))
+
+    def key_for(self, search_builder):
+        """
+        Returns (key, storable) for the given search, where key is None if the search is not
+        cacheable and storable is False if its response must not be stored (see refresh_window)
+        """
+        if not self.cacheable(search_builder):
+            return None, False
+        generations = self.registry[INDEX_GENERATIONS].get(search_builder.es_index)
+        if generations is None:
+            self._stats['errors'] += 1
+            return None, False
+        generations, last_changed = generations
+        request = search_builder.request
+        key = json.dumps([
+            search_builder.forced_type,
+            search_builder.doc_types,
+            search_builder.search_base,
+            search_builder.custom_aggregations,
+            hashlib.sha256(json.dumps(sorted(request.effective_principals)).encode('utf-8')).hexdigest(),
+            search_builder.es_index,
+            generations,
+        ], sort_keys=True, default=str)
+        key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return key, time.time() - last_changed >= self.refresh_window
+
+    def _shared_key(self, key):
+        return '%s:%s:%s' % (self.namespace, self.KEY_PREFIX, key)
+
+    def get(self, request, key):
+        """ Returns the cached response for key (setting the response status), or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            self._stats['hits'] += 1
+        else:
+            entry = self._get_shared(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['shared_hits'] += 1
+            self._put(key, entry)
+        status, response = json.loads(entry)
+        request.response.status_code = status
+        return response
+
+    def _get_shared(self, key):
+        redis = self.redis
+        if redis is None:
+            return None
+        try:
+            entry = redis.get(self._shared_key(key))
+        except Exception as e:
+            self._stats['errors'] += 1
+            log.error('Could not read search cache entry from Redis: %r' % e)
+            return None
+        return entry.decode('utf-8') if isinstance(entry, bytes) else entry
+
+    def set(self, key, response, status):
+        """ Stores a response (as returned by SearchBuilder.get_response) and its status code """
+        entry = json_renderer.dumps([status, response])
+        if len(entry) > self.max_entry_bytes:
+            self._stats['too_large'] += 1
+            return
+        self._stats['stores'] += 1
+        self._put(key, entry)
+        redis = self.redis
+        if redis is not None:
+            try:
+                redis.set(self._shared_key(key), entry, ex=self.shared_ttl)
+            except Exception as e:
+                self._stats['errors'] += 1
+                log.error('Could not write search cache entry to Redis: %r' % e)
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def skip(self):
+        """ Records a cacheable response that was not stored because its index changed too recently """
+        self._stats['too_fresh'] += 1
+
+    def clear(self):
+        """ Clears the in-process tier (the shared tier is only ever invalidated by generations) """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        stats = {name: self._stats[name]
+                 for name in ['hits', 'shared_hits', 'misses', 'stores', 'too_fresh', 'too_large', 'errors']}
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['shared_hits']) / lookups if lookups else None
+        with self._lock:
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = sum(len(entry) for entry in self._entries.values())
+        stats['capacity'] = self.capacity
+        stats['shared'] = self.redis is not None
+        return stats
+
+
+class FacetAggregationCache(object):
+    """
+    Caches the aggregations (facets) of unfiltered searches, e.g. collection landing pages such
+    as /search/?type=Item, which compute the same terms and stats aggregations for every visitor.
+    A search whose aggregations are cached is sent to ES without them, so its hits (and total)
+    are always fresh; the cached aggregations are put back in its results.
+
+    Entries are keyed by the query and aggregations sent to ES, which include the (canonical)
+    principals filter, so users with the same principals share them, and by the generations of
+    the searched indices, so indexer writes to an index invalidate its entries. As for
+    SearchResponseCache, aggregations computed within `refresh_window` seconds of the last write
+    to a searched index are not stored.
+
+    Only top-level searches whose parameters are all in `UNFILTERED_PARAMS` (or that are for
+    facets only, limit=0) are cached, keeping the cache to the few pages visited most.
+    """
+    # parameters that do not filter the results (type is the collection being landed on)
+    UNFILTERED_PARAMS = {'type', 'limit', 'from', 'sort', 'frame', 'format', 'currentAction', 'searchSessionID'}
+
+    def __init__(self, registry, capacity=128, refresh_window=1.0):
+        self.registry = registry
+        self.capacity = capacity
+        self.refresh_window = refresh_window
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    @classmethod
+    def cacheable(cls, search_builder):
+        request = search_builder.request
+        return ('aggs' in search_builder.query
+                and request.__parent__ is None
+                and not search_builder.debug_is_active
+                and (search_builder.size == 0 or set(request.normalized_params.keys()) <= cls.UNFILTERED_PARAMS))
+
+    def key_for(self, search_builder):
+        """ Returns (key, storable) for the aggregations of the given search, as SearchResponseCache.key_for """
+        if not self.cacheable(search_builder):
+            return None, False
+        generations = self.registry[INDEX_GENERATIONS].get(search_builder.es_index)
+        if generations is None:
+            self._stats['errors'] += 1
+            return None, False
+        generations, last_changed = generations
+        query = search_builder.query
+        key = json.dumps([query.get('query'), query['aggs'], search_builder.es_index, generations],
+                         sort_keys=True, default=str)
+        key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return key, time.time() - last_changed >= self.refresh_window
+
+    def get(self, key):
+        """ Returns a copy of the cached aggregations for key, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        self._stats['hits' if entry is not None else 'misses'] += 1
+        return json.loads(entry) if entry is not None else None
+
+    def set(self, key, aggregations, storable=True):
+        """ Stores the aggregations of ES results, unless they are not storable (see key_for) """
+        if not storable:
+            self._stats['too_fresh'] += 1
+            return
+        entry = json.dumps(aggregations)
+        self._stats['stores'] += 1
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        stats = {name: self._stats[name] for name in ['hits', 'misses', 'stores', 'too_fresh', 'errors']}
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else None
+        with self._lock:
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = sum(len(entry) for entry in self._entries.values())
+        stats['capacity'] = self.capacity
+        return stats
+
+
+@view_config(route_name='search_cache_stats', request_method='GET', permission='index')
+@debug_log
+def search_cache_stats(context, request):
+    """ Hit/miss counts of this process's search response cache (and of its facet aggregation cache) """
+    cache = request.registry.get(SEARCH_RESPONSE_CACHE)
+    facet_cache = request.registry.get(FACET_AGGREGATION_CACHE)
+    return {'enabled': cache is not None, **(cache.stats() if cache is not None else {}),
+            'facets': facet_cache.stats() if facet_cache is not None else {'enabled': False}}
@@ -0,0 +1,298 @@
+"""
+Asynchronous search jobs, see SearchJobs.
+"""
+
+import atexit
+import collections
+import json
+import os
+import structlog
+import tempfile
+import threading
+import time
+import transaction
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from pyramid.httpexceptions import (
+    HTTPBadRequest, HTTPException, HTTPForbidden, HTTPNotFound, HTTPServiceUnavailable, HTTPTooManyRequests,
+)
+from pyramid.response import FileResponse
+from pyramid.settings import asbool
+from pyramid.view import view_config
+from urllib.parse import urlsplit
+
+from ..interfaces import SEARCH_JOBS
+from ..util import debug_log
+
+
+log = structlog.getLogger(__name__)
+
+
+def includeme(config):
+    """ Registers SearchJobs (or None) under SEARCH_JOBS. Settings:
+            * search.jobs - turns search jobs on (default off)
+            * search.jobs.dir - directory results are spooled to (default <tmp>/snovault-search-jobs),
+              shared by the processes of a host so any of them can report on and serve a job
+            * search.jobs.workers - searches run at once per process (default 2)
+            * search.jobs.max_per_principal - unfinished jobs allowed per user and process (default 2)
+            * search.jobs.max_active - unfinished jobs allowed per process (default 16)
+            * search.jobs.ttl - seconds jobs and their results are kept (default 86400)
+    """
+    config.add_route('search_jobs', '/search-jobs')
+    config.add_route('search_job', '/search-jobs/{job_id}')
+    config.add_route('search_job_results', '/search-jobs/{job_id}/results')
+    settings = config.registry.settings
+    if asbool(settings.get('search.jobs', False)):
+        config.registry[SEARCH_JOBS] = SearchJobs(
+            settings.get('search.jobs.dir') or os.path.join(tempfile.gettempdir(), 'snovault-search-jobs'),
+            workers=int(settings.get('search.jobs.workers', 2)),
+            max_per_principal=int(settings.get('search.jobs.max_per_principal', 2)),
+            max_active=int(settings.get('search.jobs.max_active', 16)),
+            ttl=int(settings.get('search.jobs.ttl', 86400)),
+        )
+    else:
+        config.registry[SEARCH_JOBS] = None
+    config.scan(__name__)
+
+
+class SearchJobs(object):
+    """
+    Runs searches that may outlast load balancer timeouts in background threads, instead of
+    holding a web worker (and tempting clients to retry) for their whole duration.
+
+    A job is a /search/ (or /search/@@export) GET or a /compound_search POST, run as the user
+    who submitted it: the request is rebuilt from the submitting request's credentials and
+    invoked through the app, so the search views and SearchBuilder do the work as usual,
+    streaming limit=all results. The response body is spooled to `spool_dir`, next to a JSON
+    file with the state of the job, which any process on the host can read.
+
+    Jobs are only for authenticated users, as anonymous ones could not be told apart: they would
+    share a cap and could read each other's results.
+
+    Admission is limited per process: a user may have at most `max_per_principal` unfinished
+    jobs (429 otherwise), and there may be at most `max_active` in all (503 otherwise).
+    Jobs are deleted `ttl` seconds after they were submitted.
+    """
+    QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+    SEARCH_PATHS = ['/search', '/search/', '/search/@@export']
+    COMPOUND_SEARCH_PATH = '/compound_search'
+    # what the job request takes over from the submitting request, so it authenticates the same way
+    INHERITED_ENVIRON = ['REMOTE_USER', 'HTTP_AUTHORIZATION', 'HTTP_COOKIE']
+
+    def __init__(self, spool_dir, workers=2, max_per_principal=2, max_active=16, ttl=86400):
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.max_per_principal = max_per_principal
+        self.max_active = max_active
+        self.ttl = ttl
+        self._active = collections.Counter()  # owner -> unfinished jobs of this process
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        atexit.register(self.shutdown)
+
+    def _path(self, job_id, suffix):
+        return os.path.join(self.spool_dir, job_id + suffix)
+
+    def results_path(self, job_id):
+        return self._path(job_id, '.results')
+
+    @property
+    def executor(self):
+        # a forked worker inherits the executor but not its threads, so start one per process
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='search-job')
+            return self._executor
+
+    def get(self, job_id):
+        """ Returns the state of the given job, or None if there is no such job """
+        try:
+            uuid.UUID(job_id)
+            with open(self._path(job_id, '.json')) as f:
+                return json.load(f)
+        except (ValueError, OSError):
+            return None
+
+    def _save(self, job):
+        path = self._path(job['id'], '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(job, f)
+        os.replace(path + '.tmp', path)
+
+    def make_job_request(self, request, method, path, body=None):
+        """ A new top-level request for path, authenticated with the credentials of request """
+        environ = {key: request.environ[key] for key in self.INHERITED_ENVIRON if key in request.environ}
+        job_request = request.__class__.blank(path, environ=environ, base_url=request.application_url,
+                                              method=method)
+        job_request.headers['Accept'] = 'application/json'
+        if body is not None:
+            job_request.content_type = 'application/json'
+            job_request.body = json.dumps(body).encode('utf-8')
+        job_request._stats = {}
+        return job_request
+
+    def submit(self, request, method, path, body=None):
+        """ Queues a search on behalf of the user of request, returning the state of the new job """
+        owner = job_owner(request)
+        with self._lock:
+            if sum(self._active.values()) >= self.max_active:
+                raise HTTPServiceUnavailable('Too many search jobs are running, try again later')
+            if self._active[owner] >= self.max_per_principal:
+                raise HTTPTooManyRequests('At most %s search jobs may run at once per user' % self.max_per_principal)
+            self._active[owner] += 1
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self.expire()
+            job = {'id': uuid.uuid4().hex, 'owner': owner, 'status': self.QUEUED, 'method': method, 'path': path,
+                   'submitted': time.time()}
+            self._save(job)
+            job_request = self.make_job_request(request, method, path, body)
+            future = self._futures[job['id']] = self.executor.submit(
+                self._run, request.invoke_subrequest, job_request, dict(job))
+            future.add_done_callback(lambda _: self._futures.pop(job['id'], None))
+        except Exception:
+            self._release(owner)
+            raise
+        return job
+
+    def _release(self, owner):
+        with self._lock:
+            self._active[owner] -= 1
+            if self._active[owner] <= 0:
+                del self._active[owner]
+
+    def _run(self, invoke_subrequest, job_request, job):
+        job.update(status=self.RUNNING, started=time.time())
+        self._save(job)
+        results_path = self.results_path(job['id'])
+        # the search views run without tweens, so give them a transaction of their own (only ever read from)
+        transaction.begin()
+        try:
+            response = invoke_subrequest(job_request, use_tweens=False)
+            with open(results_path + '.tmp', 'wb') as f:
+                for chunk in response.app_iter:
+                    f.write(chunk)
+            if hasattr(response.app_iter, 'close'):
+                response.app_iter.close()
+            os.replace(results_path + '.tmp', results_path)
+            job.update(status=self.DONE, status_code=response.status_code, content_type=response.content_type,
+                       size=os.path.getsize(results_path))
+        except HTTPException as e:
+            job.update(status=self.FAILED, status_code=e.status_code, error=e.detail or e.explanation)
+        except Exception as e:
+            log.error('Search job %s (%s) failed: %r' % (job['id'], job['path'], e))
+            job.update(status=self.FAILED, status_code=500, error=str(e))
+        finally:
+            transaction.abort()
+            job['finished'] = time.time()
+            self._save(job)
+            self._release(job['owner'])
+
+    def wait(self, job_id, timeout=None):
+        """ Waits for a job submitted by this process to finish """
+        future = self._futures.get(job_id)
+        if future is not None:
+            future.exception(timeout)
+
+    def expire(self):
+        """ Deletes jobs (and their results) submitted more than ttl seconds ago """
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.spool_dir):
+            if not name.endswith('.json'):
+                continue
+            job = self.get(name[:-len('.json')])
+            if job is not None and job['submitted'] < cutoff:
+                for suffix in ['.json', '.results']:
+                    try:
+                        os.remove(self._path(job['id'], suffix))
+                    except OSError:
+                        pass
+
+    def shutdown(self):
+        """ Drops queued jobs; running ones are left to finish """
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def job_owner(request):
+    """ The user jobs of request belong to; jobs are only for authenticated users """
+    owner = request.authenticated_userid
+    if owner is None:
+        raise HTTPForbidden('Search jobs are only available to authenticated users')
+    return owner
+
+
+def get_search_jobs(request):
+    search_jobs = request.registry.get(SEARCH_JOBS)
+    if search_jobs is None:
+        raise HTTPNotFound('Search jobs are not enabled')
+    return search_jobs
+
+
+def get_own_job(request):
+    """ The job of the route, which only the user who submitted it may see """
+    search_jobs = get_search_jobs(request)
+    job = search_jobs.get(request.matchdict['job_id'])
+    if job is None or job['owner'] != job_owner(request):
+        raise HTTPNotFound('No such search job')
+    return search_jobs, job
+
+
+def job_view(request, job):
+    result = {key: value for key, value in job.items() if key != 'owner'}
+    result['@id'] = request.route_path('search_job', job_id=job['id'])
+    if job['status'] == SearchJobs.DONE:
+        result['results'] = request.route_path('search_job_results', job_id=job['id'])
+    return result
+
+
+@view_config(route_name='search_jobs', request_method='POST', permission='search')
+@debug_log
+def submit_search_job(context, request):
+    """ Starts a search in the background. The body is either
+            {"search": "/search/?type=Item&limit=all"} (a /search/ or /search/@@export path) or
+            {"compound_search": {...}} (the body of a /compound_search request)
+        Responds with 202 and the state of the job, to be polled at its @id until its status is
+        'done' (results can then be downloaded from `results`) or 'failed'.
+    """
+    search_jobs = get_search_jobs(request)
+    try:
+        body = request.json_body
+    except ValueError:
+        raise HTTPBadRequest('Body must be JSON')
+    if isinstance(body, dict) and isinstance(body.get('search'), str):
+        if urlsplit(body['search']).path not in SearchJobs.SEARCH_PATHS:
+            raise HTTPBadRequest('search must be one of %s, with a query string'
+                                 % ', '.join(SearchJobs.SEARCH_PATHS))
+        job = search_jobs.submit(request, 'GET', body['search'])
+    elif isinstance(body, dict) and isinstance(body.get('compound_search'), dict):
+        job = search_jobs.submit(request, 'POST', SearchJobs.COMPOUND_SEARCH_PATH, body['compound_search'])
+    else:
+        raise HTTPBadRequest('Body must have either a search path or a compound_search body')
+    request.response.status_code = 202
+    return job_view(request, job)
+
+
+@view_config(route_name='search_job', request_method='GET', permission='search')
+@debug_log
+def search_job(context, request):
+    """ State of a search job: status (queued, running, done or failed), times, status_code and error """
+    _, job = get_own_job(request)
+    return job_view(request, job)
+
+
+@view_config(route_name='search_job_results', request_method='GET', permission='search')
+@debug_log
+def search_job_results(context, request):
+    """ Response body of a finished search job, streamed from the spooled file """
+    search_jobs, job = get_own_job(request)
+    if job['status'] != SearchJobs.DONE:
+        raise HTTPNotFound('Search job %s is %s' % (job['id'], job['status']))
+    response = FileResponse(search_jobs.results_path(job['id']), request=request,
+                            content_type=job['content_type'])
+    response.status_code = job['status_code']
+    return response
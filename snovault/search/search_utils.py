@@ -1,5 +1,9 @@
 import structlog
+import threading
+import time
+import uuid
 from collections import OrderedDict
+from contextlib import contextmanager
 from elasticsearch import (
     TransportError,
     RequestError,
@@ -79,6 +83,160 @@ class QueryConstructionException(SearchException):
         self.query_type = query_type
 
 
+class DerivedValueCache(object):
+    """
+    Process-wide memos of values derived from objects that are replaced rather than modified,
+    such as type schemas (reified on their TypeInfo) or the cached ES mapping of an index.
+    Each memo is kept along with the objects it was derived from, and is started over once
+    any of them is replaced (e.g. schemas reloaded with a new app), so a memo never outlives
+    its sources. At most `capacity` memos are kept, least recently used first out.
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def memo(self, key, sources):
+        """ Returns the memo dict for key, empty if it was derived from other sources than the given ones """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or len(entry[0]) != len(sources) or any(
+                    kept is not source for kept, source in zip(entry[0], sources)):
+                entry = self._entries[key] = (tuple(sources), {})
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# field schemas and default facets, per doc types (see schema_memo)
+SCHEMA_CACHE = DerivedValueCache()
+# find_nested_path results, per IndexMapping.key
+NESTED_PATH_CACHE = DerivedValueCache(capacity=64)
+_MISSING = object()
+
+
+class IndexMapping(dict):
+    """ Properties mapping of an index, along with the key (index name and mapping version) that
+        values derived from it are memoized under (see find_nested_path)
+    """
+
+    def __init__(self, properties, key):
+        super().__init__(properties)
+        self.key = key
+
+
+def schema_memo(types, doc_types):
+    """ Memo dict for values derived from the schemas of the given doc types (in any order) """
+    doc_types = tuple(sorted(doc_types))
+    return SCHEMA_CACHE.memo(doc_types, [types[doc_type].schema for doc_type in doc_types])
+
+
+class SearchCanceller(object):
+    """
+    Cancels the Elasticsearch tasks of searches whose client has disconnected, so abandoned
+    (e.g. facet-heavy) searches stop holding ES search threads and web workers.
+
+    Searches are sent with an X-Opaque-Id, which ES keeps on their tasks. While a search runs
+    (see `watch`), a single daemon thread per process polls the client connection of its request
+    every `interval` seconds through the `waitress.client_disconnected` environ callable (only
+    effective when waitress is run with channel_request_lookahead > 0), and once it reports a
+    disconnect, cancels the tasks with that X-Opaque-Id.
+    """
+
+    class Search(object):
+
+        def __init__(self, es, client_disconnected):
+            self.es = es
+            self.client_disconnected = client_disconnected
+            self.opaque_id = 'search-' + uuid.uuid4().hex
+            self.cancelled = False
+
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self._searches = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @contextmanager
+    def watch(self, es, client_disconnected):
+        """ Watches a search while the block runs, yielding it (with the X-Opaque-Id to send it with) """
+        search = self.Search(es, client_disconnected)
+        with self._lock:
+            self._searches.add(search)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='search-canceller', daemon=True)
+                self._thread.start()
+        try:
+            yield search
+        finally:
+            with self._lock:
+                self._searches.discard(search)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._searches:
+                    self._thread = None
+                    return
+                searches = list(self._searches)
+            for search in searches:
+                try:
+                    if not search.cancelled and search.client_disconnected():
+                        search.cancelled = True
+                        self.cancel(search.es, search.opaque_id)
+                except Exception as e:
+                    log.error('Could not cancel search %s: %r' % (search.opaque_id, e))
+
+    @staticmethod
+    def cancel(es, opaque_id):
+        """ Cancels the ES search tasks sent with the given X-Opaque-Id """
+        tasks = es.tasks.list(actions='indices:data/read/search*', detailed=True)
+        for node in tasks.get('nodes', {}).values():
+            for task_id, task in node.get('tasks', {}).items():
+                if task.get('headers', {}).get('X-Opaque-Id') == opaque_id:
+                    es.tasks.cancel(task_id=task_id)
+        log.info('Cancelled search %s, as its client disconnected' % opaque_id)
+
+
+SEARCH_CANCELLER = SearchCanceller()
+DEFAULT_SEARCH_TIMEOUT = '30s'
+
+
+def search_budget(request):
+    """
+    Returns (timeout, terminate_after) for the searches of a request, from the settings
+        * search.timeout - ES search timeout (default 30s)
+        * search.terminate_after - max hits collected per shard (default none)
+    either of which can be set per route (request class), e.g. search.timeout.compound_search = 60s.
+    Subrequests use the budget of their own route.
+    """
+    settings = request.registry.settings or {}
+    route = getattr(request, 'matched_route', None)
+    budget = []
+    for setting, default in [('search.timeout', DEFAULT_SEARCH_TIMEOUT), ('search.terminate_after', None)]:
+        value = settings.get('%s.%s' % (setting, route.name)) if route is not None else None
+        budget.append(value or settings.get(setting) or default)
+    timeout, terminate_after = budget
+    return timeout, int(terminate_after) if terminate_after else None
+
+
+def get_client_disconnected(request):
+    """ The waitress.client_disconnected callable of the (top-level) request, or None """
+    while request is not None:
+        client_disconnected = request.environ.get('waitress.client_disconnected')
+        if client_disconnected is not None:
+            return client_disconnected
+        request = getattr(request, '__parent__', None)
+    return None
+
+
 # Functions
 
 
@@ -119,7 +277,23 @@ def find_nested_path(field, es_mapping):
                         For example: "experiments_in_set.biosample.biosource.individual.organism.name"
     :param es_mapping: dictionary representation of the es_mapping of the type we are searching on
     :return: path for nested query or None
+
+    Results are memoized per index and mapping version if es_mapping is an IndexMapping
+    (see NESTED_PATH_CACHE).
     """
+    if not es_mapping:
+        return None
+    key = getattr(es_mapping, 'key', None)
+    if key is None:
+        return _find_nested_path(field, es_mapping)
+    memo = NESTED_PATH_CACHE.memo(key, [])
+    nested_path = memo.get(field, _MISSING)
+    if nested_path is _MISSING:
+        nested_path = memo[field] = _find_nested_path(field, es_mapping)
+    return nested_path
+
+
+def _find_nested_path(field, es_mapping):
     location = es_mapping
     possible_nested_paths = []
     path = []
@@ -169,7 +343,7 @@ def schema_for_field(field, request, doc_types, should_log=False):
     Find the schema for the given field (in embedded '.' format). Uses
     ff_utils.crawl_schema from snovault and logs any cases where there is an
     error finding the field from the schema. Caches results based off of field
-    and doc types used
+    and doc types used, for the request and across requests (see schema_memo)
 
     :param field: embedded field path, separated by '.'
     :param request: current Request object
@@ -179,8 +353,6 @@ def schema_for_field(field, request, doc_types, should_log=False):
     :returns: Dictionary schema for the field, or None if not found
     """
     types = request.registry[TYPES]
-    schemas = [types[dt].schema for dt in doc_types]
-    field_schema = None
 
     # We cannot hash dict by list (of doc_types) so we convert to unique ordered string
     doc_type_string = ','.join(sorted(doc_types))  # use default sort
@@ -192,6 +364,16 @@ def schema_for_field(field, request, doc_types, should_log=False):
         request._field_schema_cache = cache = {}
     if cache_key in cache:
         return cache[cache_key]
+    # the shared memo is looked up (and its schemas checked) once per request and doc types
+    memo = cache.get((_MISSING, doc_type_string))
+    if memo is None:
+        memo = cache[(_MISSING, doc_type_string)] = schema_memo(types, doc_types)
+    field_schema = memo.get(('field', field), _MISSING)
+    if field_schema is not _MISSING:
+        cache[cache_key] = field_schema
+        return field_schema
+    schemas = [types[dt].schema for dt in doc_types]
+    field_schema = None
 
     # for 'validation_errors.*' and 'aggregated_items.*',
     # schema will never be found and logging isn't helpful
@@ -208,8 +390,8 @@ def schema_for_field(field, request, doc_types, should_log=False):
                 if field_schema is not None:
                     break
 
-    # Cache result, even if not found, for this request.
-    cache[cache_key] = field_schema
+    # Cache result, even if not found, for this request and the following ones.
+    cache[cache_key] = memo[('field', field)] = field_schema
 
     return field_schema
 
@@ -278,13 +460,15 @@ def get_es_mapping(es, es_index):
 
     :param es: elasticsearch client
     :param es_index: index to get mapping from
-    :return: the mapping for this item type or {} if we are not doing a single index search
+    :return: the mapping for this item type (an IndexMapping, versioned by the uuid of the index, as
+             mappings only change by recreating it) or {} if we are not doing a single index search
     """
     if '*' in es_index or ',' in es_index:  # no type=nested searches can be done on * or multi-index
         return {}
     else:
-        index = es.indices.get(es_index)
-        return index[es_index]['mappings']['properties']
+        index = es.indices.get(es_index)[es_index]
+        return IndexMapping(index['mappings']['properties'],
+                            (es_index, 'uuid', index.get('settings', {}).get('index', {}).get('uuid')))
 
 
 def get_search_fields(request, doc_types):
@@ -320,24 +504,46 @@ def is_linkto_or_object_array_root_field(field, types, doc_types):
     return False
 
 
-def execute_search(*, es, query, index, from_, size, session_id=None):
+def execute_search(*, es, query, index, from_, size, session_id=None, request=None):
     """
     Execute the given Elasticsearch-dsl search. Raise HTTPBadRequest for any
     exceptions that arise.
 
+    Given the request the search is made for, the search gets the budget of the
+    request (see search_budget) and is cancelled in ES if its client disconnects
+    (see SearchCanceller).
+
     :param es: handle to es
     :param query: dictionary representing ES query
     :param index: index to search
     :param from_: search start index
     :param size: # of records to return
     :param session_id: session if we are paginating
+    :param request: request the search is made for
     :returns: Dictionary search results
     """
     err_exp = None
     es_results = None
+    timeout, terminate_after = search_budget(request) if request is not None else (DEFAULT_SEARCH_TIMEOUT, None)
+    params = {}
+    if terminate_after:
+        params['terminate_after'] = terminate_after
+    client_disconnected = get_client_disconnected(request)
     try:
-        # set timeout
-        es_results = es.search(index=index, body=query, from_=from_, size=size, timeout='30s', preference=session_id)
+        if client_disconnected is None:
+            es_results = es.search(index=index, body=query, from_=from_, size=size, timeout=timeout,
+                                   preference=session_id, **params)
+        else:
+            with SEARCH_CANCELLER.watch(es, client_disconnected) as search:
+                try:
+                    es_results = es.search(index=index, body=query, from_=from_, size=size, timeout=timeout,
+                                           preference=session_id, opaque_id=search.opaque_id, **params)
+                except Exception:
+                    if search.cancelled:
+                        raise HTTPBadRequest(explanation='The search was cancelled, as the client disconnected.')
+                    raise
+    except HTTPBadRequest:
+        raise
     except ConnectionTimeout:
         err_exp = 'The search failed due to a timeout. Please try a different query.'
     except RequestError as exc:
@@ -361,19 +567,166 @@ def execute_search(*, es, query, index, from_, size, session_id=None):
     return es_results
 
 
+# uuids are unique, so sorting on them last gives every hit a distinct sort position
+SEARCH_AFTER_TIEBREAKER = {'embedded.uuid.raw': {'order': 'asc', 'unmapped_type': 'keyword'}}
+UNIQUE_SORT_FIELDS = ['embedded.uuid.raw', '_id']
+
+
+def add_search_after_tiebreaker(sort):
+    """
+    Returns the given sort (a list of clauses, a dict of field -> order or None) as a list of
+    clauses that ends with a unique field, as search_after otherwise skips or repeats hits
+    that tie on every sort field across a page boundary.
+    """
+    if not sort:
+        sort = ['_score']
+    elif isinstance(sort, dict):
+        sort = [{field: order} for field, order in sort.items()]
+    else:
+        sort = list(sort)
+    fields = set()
+    for clause in sort:
+        fields.update([clause] if isinstance(clause, str) else clause.keys())
+    if not fields.intersection(UNIQUE_SORT_FIELDS):
+        sort.append(SEARCH_AFTER_TIEBREAKER)
+    return sort
+
+
+def open_point_in_time(es, index, keep_alive):
+    """ Opens a point in time on the given index, returning its id or None if not supported """
+    try:
+        return es.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+    except Exception as e:  # e.g. AWS Elasticsearch before 7.10
+        log.warning('Could not open point in time on %s, paging without one: %r' % (index, e))
+        return None
+
+
+def close_point_in_time(es, pit_id):
+    try:
+        es.close_point_in_time(body={'id': pit_id})
+    except Exception as e:  # it expires after keep_alive anyway
+        log.warning('Could not close point in time: %r' % e)
+
+
+def execute_search_after(*, es, query, index, size, session_id=None, keep_alive='1m', request=None):
+    """
+    Generator over the raw ES results of every page of the given query, paged with search_after
+    on a point in time, so each page costs the same regardless of depth and paging is not limited
+    by index.max_result_window. If points in time are not supported, pages are searched on the
+    index directly, which is not a consistent snapshot should the index change meanwhile.
+
+    The first page is the query as given; later pages leave out `aggs` and total hit tracking, which
+    are only ever read from the first page. The point in time is closed once the generator is
+    exhausted or closed.
+
+    :param es: handle to es
+    :param query: dictionary representing ES query, not modified
+    :param index: index to search
+    :param size: # of records per page
+    :param session_id: preference used when searching without a point in time
+    :param keep_alive: how long the point in time is kept between pages
+    :param request: request the search is made for, see execute_search
+    """
+    pit_id = open_point_in_time(es, index, keep_alive)
+    body = dict(query, sort=add_search_after_tiebreaker(query.get('sort')))
+    try:
+        while True:
+            if pit_id is not None:
+                body['pit'] = {'id': pit_id, 'keep_alive': keep_alive}
+            es_results = execute_search(es=es, query=body, index=None if pit_id is not None else index,
+                                        from_=0, size=size, session_id=None if pit_id is not None else session_id,
+                                        request=request)
+            pit_id = es_results.get('pit_id', pit_id)
+            hits = es_results['hits']['hits']
+            yield es_results
+            if len(hits) < size:
+                return
+            if 'aggs' in body:
+                body = {k: v for k, v in body.items() if k != 'aggs'}
+                body['track_total_hits'] = False
+            body['search_after'] = hits[-1]['sort']
+    finally:
+        if pit_id is not None:
+            close_point_in_time(es, pit_id)
+
+
+# principals that stand for a single user (or service) rather than a group of them
+USER_PRINCIPAL_PREFIXES = ('userid.', 'accesskey.', 'remoteuser.', 'mailto.', 'auth0.')
+
+
+def split_principals(principals):
+    """
+    Splits the given principals into the group part (system.Everyone, group.admin, ...) and
+    the per-user part (userid.<uuid>, ...), each deduplicated and sorted.
+
+    :param principals: iterable of principals, typically request.effective_principals
+    :returns: 2-tuple of lists of principals
+    """
+    principals = set(principals)
+    user_part = {principal for principal in principals if principal.startswith(USER_PRINCIPAL_PREFIXES)}
+    return sorted(principals - user_part), sorted(user_part)
+
+
+def canonical_principals(principals):
+    """
+    Returns the given principals deduplicated and in a stable order: the group part, then
+    the per-user part (see split_principals).
+
+    :param principals: iterable of principals, typically request.effective_principals
+    :returns: list of principals
+    """
+    group_part, user_part = split_principals(principals)
+    return group_part + user_part
+
+
+def build_principals_filter(principals):
+    """
+    Builds the principals_allowed.view filter for the given principals: a terms clause on
+    the group part, or'd with a terms clause on the per-user part if there is one. The
+    clauses are identical whenever the principals are, whatever order the policy lists
+    them in, and users with the same groups share the group clause, so Elasticsearch can
+    reuse its cached results for it across users.
+
+    :param principals: iterable of principals, typically request.effective_principals
+    :returns: bool/should filter
+    """
+    group_part, user_part = split_principals(principals)
+    should = [{TERMS: {'principals_allowed.view': group_part}}]
+    if user_part:
+        should.append({TERMS: {'principals_allowed.view': user_part}})
+    return {BOOL: {SHOULD: should}}
+
+
+def principals_on_filter(query):
+    """
+    Returns the principals a filter built by build_principals_filter allows, or None if
+    query is not such a filter.
+    """
+    should = query.get(BOOL, {}).get(SHOULD) if isinstance(query, dict) else None
+    if not should or list(query[BOOL]) != [SHOULD]:
+        return None
+    principals = []
+    for clause in should:
+        terms = clause.get(TERMS) if isinstance(clause, dict) else None
+        if not terms or list(terms) != ['principals_allowed.view']:
+            return None
+        principals.extend(terms['principals_allowed.view'])
+    return principals
+
+
 def build_permission_filter(request):
     """Build the standard snovault view-permission filter for direct ES queries.
 
-    Returns a single ES `terms` filter that restricts results to documents
-    whose `principals_allowed.view` intersects the request's effective
-    principals. Use this when constructing ES queries OUTSIDE the snovault
+    Returns the ES filter that restricts results to documents whose
+    `principals_allowed.view` intersects the request's effective principals
+    (see build_principals_filter). Use this when constructing ES queries OUTSIDE the snovault
     SearchBuilder pipeline (e.g. for streaming endpoints that bypass the
     full search() machinery to avoid default-facet computation).
 
     Without this clause, a direct ES query would leak documents the caller
     is not authorized to view.
     """
-    return {'terms': {'principals_allowed.view': list(request.effective_principals)}}
+    return build_principals_filter(request.effective_principals)
 
 
 def execute_streaming_search(es, *, index, query, source_includes=None,
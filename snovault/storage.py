@@ -8,13 +8,14 @@ from botocore.client import Config
 from dcicutils.misc_utils import ignored, get_error_message
 from pyramid.httpexceptions import HTTPConflict, HTTPLocked, HTTPInternalServerError
 from pyramid.threadlocal import get_current_request
-from sqlalchemy import Column, ForeignKey, bindparam, func, orm, schema, types
+from sqlalchemy import Column, ForeignKey, bindparam, func, insert, orm, schema, select, types
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.dialects.postgresql import JSONB as JSON
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext import baked
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, collections
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.orm.exc import FlushError, MultipleResultsFound, NoResultFound
 from .interfaces import BLOBS, DBSESSION, STORAGE, TYPES
 
@@ -106,6 +107,8 @@ Base = declarative_base()
 # baked queries allow for caching of query construction to save Python overhead
 bakery = baked.bakery()
 baked_query_resource = bakery(lambda session: session.query(Resource))
+baked_query_resources = bakery(lambda session: session.query(Resource))
+baked_query_resources += lambda q: q.filter(Resource.rid.in_(bindparam('rids', expanding=True)))
 baked_query_unique_key = bakery(
     lambda session: session.query(Key).options(
         # This formerly called orm.joinedload_all, but that function has been deprecated since sqlalchemy 0.9.
@@ -182,6 +185,17 @@ class PickStorage(object):
                 return self.write.get_by_uuid(uuid)
         return model
 
+    def get_by_uuids(self, uuids, datastore=None):
+        """
+        Get write/read models of many uuids (those found). The write storage loads
+        them with one query per batch; the read storage one by one (see get_by_uuid)
+        """
+        storage = self.storage(datastore)
+        if storage is self.write:
+            return self.write.get_by_uuids(uuids)
+        models = (self.get_by_uuid(uuid, datastore=datastore) for uuid in uuids)
+        return [model for model in models if model is not None]
+
     def get_by_unique_key(self, unique_key, name, datastore=None, item_type=None):
         """
         Get write/read model by given unique key with value (name)
@@ -337,11 +351,19 @@ class PickStorage(object):
 
         return self.write.find_uuids_linked_to_item(uuid)
 
-    def revision_history(self, uuid):
+    def revision_history(self, uuid, after_sid=None, limit=None):
         """
         Gets the revision history for the given uuid from postgres.
+        See RDBStorage.revision_history for `after_sid` and `limit`
         """
-        return self.write.revision_history(rid=uuid)
+        return self.write.revision_history(rid=uuid, after_sid=after_sid, limit=limit)
+
+    def archive_revisions(self, before_sid, batch_size=None):
+        """
+        Moves a batch of non-current propsheet rows older than `before_sid` into
+        the archive table. Only functional with self.write
+        """
+        return self.write.archive_revisions(before_sid, batch_size=batch_size)
 
 
 class RDBStorage(object):
@@ -369,6 +391,31 @@ class RDBStorage(object):
             return default
         return model
 
+    def get_by_uuids(self, rids):
+        """
+        Get the models of the given rids that exist. Those not in the session yet are
+        loaded (with their current propsheets) with one query per `batchsize` rids,
+        after which get_by_uuid finds them in the session without a query.
+
+        Args:
+            rids (list): list of string rids (uuids)
+
+        Returns:
+            list of Resource models, in no particular order
+        """
+        session = self.DBSession()
+        models = []
+        missing = []
+        for rid in map(uuid.UUID, rids):
+            model = session.identity_map.get(identity_key(Resource, rid))
+            if model is not None:
+                models.append(model)
+            else:
+                missing.append(rid)
+        for start in range(0, len(missing), self.batchsize):
+            models.extend(baked_query_resources(session).params(rids=missing[start:start + self.batchsize]).all())
+        return models
+
     def get_by_uuid_direct(self, rid, item_type, default=None):
         """
         This method is meant to only work with ES, so return None (default)
@@ -534,6 +581,10 @@ class RDBStorage(object):
         sp = session.begin_nested()
         model = self.get_by_uuid(rid)
         try:
+            # archived history carries no relationship to the resource, so remove it explicitly
+            session.query(ArchivedPropertySheet).filter(
+                ArchivedPropertySheet.rid == model.rid
+            ).delete(synchronize_session=False)
             for current_propsheet in model.data.values():
                 # delete the propsheet history
                 for propsheet in current_propsheet.history:
@@ -590,6 +641,10 @@ class RDBStorage(object):
             ).all()
             for propsheet in stale:
                 session.delete(propsheet)
+            session.query(ArchivedPropertySheet).filter(
+                ArchivedPropertySheet.rid == model.rid,
+                ArchivedPropertySheet.name == name,
+            ).delete(synchronize_session=False)
 
     def _update_keys(self, model, unique_keys):
         keys_set = {(k, v) for k, values in unique_keys.items() for v in values}
@@ -638,11 +693,26 @@ class RDBStorage(object):
 
         return to_add, to_remove
 
-    def revision_history(self, *, rid):
-        """ Computes revision history of rid by returning all propsheets. """
+    def revision_history(self, *, rid, after_sid=None, limit=None):
+        """ Computes revision history of rid by returning all propsheets, including
+            those moved to the archive table by `archive_revisions`, ordered by sid.
+
+            Supports keyset pagination: only revisions with a sid greater than
+            `after_sid` are returned, at most `limit` of them.
+        """
         session = self.DBSession
+        archived = session.query(ArchivedPropertySheet).filter_by(rid=rid)
+        live = session.query(PropertySheet).filter_by(rid=rid)
+        if after_sid is not None:
+            archived = archived.filter(ArchivedPropertySheet.sid > after_sid)
+            live = live.filter(PropertySheet.sid > after_sid)
+        archived = archived.order_by(ArchivedPropertySheet.sid)
+        live = live.order_by(PropertySheet.sid)
+        if limit is not None:
+            archived = archived.limit(limit)
+            live = live.limit(limit)
         revisions = []
-        for revision in session.query(PropertySheet).filter_by(rid=rid).order_by(PropertySheet.sid):
+        for revision in sorted(list(archived) + list(live), key=lambda revision: revision.sid)[:limit]:
             # 2024-11-04/C4-1188/PR-306/dmichaels:
             # Fix for "sid" appearing in properties in some situations, and ultimately ending up
             # with validation-errors = Additional properties are not allowed ('sid' was unexpected).
@@ -654,6 +724,43 @@ class RDBStorage(object):
             revisions.append(revision_properties)
         return revisions
 
+    def archive_revisions(self, before_sid, batch_size=None):
+        """
+        Move up to `batch_size` non-current propsheet rows with a sid lower than
+        `before_sid` from `propsheets` into `propsheets_archive`. Rows referenced
+        by `current_propsheets` are never moved, so reads of current items are
+        unaffected; `revision_history` and `purge_uuid` read across both tables.
+
+        Intended to be called repeatedly (committing in between) until it returns
+        0, which keeps each transaction small on large tables.
+
+        Args:
+            before_sid (int): only rows with sid < before_sid are archived
+            batch_size (int): max number of rows to move, defaults to self.batchsize
+
+        Returns:
+            int: number of rows moved
+        """
+        session = self.DBSession()
+        batch_size = batch_size or self.batchsize
+        stale = (session.query(PropertySheet.sid)
+                 .outerjoin(CurrentPropertySheet, CurrentPropertySheet.sid == PropertySheet.sid)
+                 .filter(CurrentPropertySheet.sid.is_(None), PropertySheet.sid < before_sid)
+                 .order_by(PropertySheet.sid)
+                 .limit(batch_size))
+        sids = [sid for sid, in stale]
+        if not sids:
+            return 0
+        columns = ['sid', 'rid', 'name', 'properties']
+        session.execute(
+            insert(ArchivedPropertySheet).from_select(
+                columns,
+                select(*[getattr(PropertySheet, column) for column in columns]).where(PropertySheet.sid.in_(sids))
+            )
+        )
+        session.query(PropertySheet).filter(PropertySheet.sid.in_(sids)).delete(synchronize_session=False)
+        return len(sids)
+
 
 class UUID(types.TypeDecorator):
     """Platform-independent UUID type.
@@ -887,6 +994,24 @@ class PropertySheet(Base):
     resource = orm.relationship('Resource')
 
 
+class ArchivedPropertySheet(Base):
+    """
+    Non-current propsheet rows moved out of `propsheets` by `RDBStorage.archive_revisions`.
+    Same triple as PropertySheet, but nothing points at these rows, which keeps the
+    hot table (and its indexes) limited to recent history.
+    """
+    __tablename__ = 'propsheets_archive'
+    # sids are carried over from `propsheets`, never generated here
+    sid = Column(types.Integer, autoincrement=False, primary_key=True)
+    rid = Column(UUID,
+                 ForeignKey('resources.rid',
+                            deferrable=True,
+                            initially='DEFERRED'),
+                 nullable=False, index=True)
+    name = Column(types.String, nullable=False)
+    properties = Column(JSON)
+
+
 class CurrentPropertySheet(Base):
     """
     Table that optimizes access to most recent version of items
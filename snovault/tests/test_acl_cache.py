@@ -0,0 +1,109 @@
+"""
+Tests for the caching of ACL-derived results (principals_allowed and permission checks) of items
+agreeing on their ACL-relevant properties, see Item.acl_key and TypeInfo.acl_cache.
+"""
+
+import pytest
+
+from pyramid.interfaces import IAuthorizationPolicy
+from pyramid.security import Allow, Authenticated, DENY_ALL, Everyone
+from unittest import mock
+
+from ..interfaces import TYPES
+from ..local_roles import LocalRolesAuthorizationPolicy
+from ..resources import Item
+from .testing_views import TestingLinkTargetSno
+
+
+pytestmark = [pytest.mark.working]
+
+
+@pytest.fixture
+def targets(testapp, connection, threadlocals, monkeypatch):
+    """ Items of the same type: two current, one obsolete (only admins may view) and one without status """
+    monkeypatch.setattr(TestingLinkTargetSno, 'STATUS_ACL', {
+        'current': [(Allow, Everyone, ['view']), (Allow, 'group.admin', ['view', 'edit']), DENY_ALL],
+        'obsolete': [(Allow, 'group.admin', ['view', 'edit']), DENY_ALL],
+    })
+    uuids = [testapp.post_json('/testing-link-targets-sno/', properties, status=201).json['@graph'][0]['uuid']
+             for properties in [{'name': 'one', 'status': 'current'}, {'name': 'two', 'status': 'current'},
+                                {'name': 'three', 'status': 'obsolete'}, {'name': 'four'}]]
+    targets = [connection.get_by_uuid(uuid) for uuid in uuids]
+    targets[0].type_info.acl_cache.clear()
+    return targets
+
+
+def test_acl_fields(registry):
+    types = registry[TYPES]
+    assert types['TestingLinkTargetSno'].acl_fields == ('lab', 'award')
+    assert types['AccessKey'].acl_fields == ('user',)
+    # overrides __ac_local_roles__ (depending on its uuid) without declaring acl_fields
+    assert types['User'].acl_fields is None
+
+
+def test_acl_key(targets, monkeypatch):
+    one, two, three, four = targets
+    assert one.acl_key() == two.acl_key()
+    assert len({one.acl_key(), three.acl_key(), four.acl_key()}) == 3
+    monkeypatch.setitem(two.model.propsheets[''], 'lab', 'some-lab')
+    assert one.acl_key() != two.acl_key()
+    monkeypatch.setattr(two.type_info, 'acl_fields', None)
+    assert two.acl_key() is None
+
+
+def test_principals_allowed_cached(targets):
+    one, two, three, four = targets
+    uncached = [target._principals_allowed() for target in targets]
+    with mock.patch.object(Item, '_principals_allowed', autospec=True,
+                           side_effect=Item._principals_allowed) as principals_allowed:
+        assert [target.principals_allowed() for target in targets] == uncached
+        assert [target.principals_allowed() for target in targets] == uncached
+    # computed once per status
+    assert [call.args[0] for call in principals_allowed.call_args_list] == [one, three, four]
+    assert uncached[0]['view'] != uncached[2]['view']
+    # copies, so changing one does not change the others
+    one.principals_allowed()['view'].append('changed')
+    assert two.principals_allowed() == uncached[1]
+
+
+def test_permits_cached(targets):
+    one, two, three, four = targets
+    policy = LocalRolesAuthorizationPolicy()
+    principals = [Everyone, Authenticated, 'userid.someone']
+    uncached = {(target.uuid, permission): policy._permits(target, principals, permission)
+                for target in targets for permission in ['view', 'edit']}
+    with mock.patch.object(LocalRolesAuthorizationPolicy, '_permits', autospec=True,
+                           side_effect=LocalRolesAuthorizationPolicy._permits) as permits:
+        for _ in range(2):
+            for target in targets:
+                for permission in ['view', 'edit']:
+                    result = policy.permits(target, principals, permission)
+                    expected = uncached[(target.uuid, permission)]
+                    assert bool(result) == bool(expected)
+                    assert (result.ace, result.acl) == (expected.ace, expected.acl)
+                    # about the item (or the collection or root that decided)
+                    assert result.context is expected.context
+    assert permits.call_count == 6  # for 3 statuses and 2 permissions
+    assert policy.permits(one, principals, 'view') and not policy.permits(three, principals, 'view')
+
+
+def test_permits_not_cached_for_other_contexts(registry, targets):
+    policy = registry.getUtility(IAuthorizationPolicy)
+    with mock.patch.object(LocalRolesAuthorizationPolicy, '_permits', autospec=True,
+                           side_effect=LocalRolesAuthorizationPolicy._permits) as permits:
+        for _ in range(2):
+            policy.permits(targets[0].collection, [Everyone], 'list')
+    assert permits.call_count == 2
+
+
+def test_principals_allowed_cached_for_many_items(testapp, connection, threadlocals):
+    """ principals_allowed of 50 items of the same type and status is computed once """
+    uuids = [testapp.post_json('/testing-link-targets-sno/', {'name': 'target-%s' % i, 'status': 'current'},
+                               status=201).json['@graph'][0]['uuid'] for i in range(50)]
+    items = [connection.get_by_uuid(uuid) for uuid in uuids]
+    items[0].type_info.acl_cache.clear()
+    expected = items[0]._principals_allowed()
+    with mock.patch.object(Item, '_principals_allowed', autospec=True,
+                           side_effect=Item._principals_allowed) as principals_allowed:
+        assert all(item.principals_allowed() == expected for item in items)
+    assert principals_allowed.call_count == 1
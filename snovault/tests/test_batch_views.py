@@ -0,0 +1,171 @@
+import json
+import pytest
+
+from pyramid.httpexceptions import HTTPUnprocessableEntity
+from pyramid.request import Request
+from unittest import mock
+
+from .. import batch_views
+from ..batch_views import BATCH_PATH, parse_batch_rows
+from ..interfaces import DBSESSION
+from ..storage import Key
+from ..util import NDJSON
+
+
+pytestmark = [pytest.mark.working]
+
+TARGET_TYPE = 'TestingLinkTargetSno'
+SOURCE_TYPE = 'testing-link-sources-sno'
+
+
+def post_batch(testapp, rows, params='', status=200):
+    """ Posts the given rows to /batch as NDJSON, returning the parsed result rows """
+    body = '\n'.join(json.dumps(row) for row in rows)
+    res = testapp.post(BATCH_PATH + params, body, content_type=NDJSON, status=status)
+    assert res.content_type == NDJSON
+    return [json.loads(line) for line in res.text.splitlines()]
+
+
+def test_batch_creates_and_links(testapp):
+    """ Rows are written in order, so later rows may link to items created earlier in the batch """
+    results = post_batch(testapp, [
+        {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-target-1'}},
+        {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-target-2'}},
+        {'method': 'POST', 'type': SOURCE_TYPE, 'body': {'name': 'batch-source', 'target': 'batch-target-1'}},
+    ])
+    assert [result['row'] for result in results] == [0, 1, 2]
+    assert all(result['status'] == 'success' for result in results)
+    source = testapp.get(results[2]['@id'] + '?frame=object').json
+    assert source['target'] == results[0]['@id']
+
+
+def test_batch_patch(testapp):
+    results = post_batch(testapp, [
+        {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-target', 'status': 'current'}},
+    ])
+    uuid, item_id = results[0]['uuid'], results[0]['@id']
+    results = post_batch(testapp, [
+        {'method': 'PATCH', 'id': uuid, 'body': {'status': 'deleted'}},
+        {'method': 'PATCH', 'id': '/testing-link-targets-sno/no-such-item/', 'body': {'status': 'deleted'}},
+    ])
+    assert results[0]['status'] == 'success'
+    assert results[1]['status'] == 'error'
+    assert testapp.get(item_id + '?frame=object').json['status'] == 'deleted'
+    revisions = testapp.get(item_id + '@@revision-history').json['revisions']
+    assert [r['status'] for r in revisions] == ['current', 'deleted']
+
+
+def test_batch_bad_rows_are_isolated(testapp):
+    """ An invalid row is reported and skipped while the others are still written """
+    results = post_batch(testapp, [
+        {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-good'}},
+        {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-bad', 'not_a_field': 1}},
+        {'method': 'POST', 'type': 'NoSuchType', 'body': {}},
+        {'method': 'DELETE', 'type': TARGET_TYPE, 'body': {}},
+        {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-good'}},  # unique key conflict
+    ])
+    assert [result['status'] for result in results] == ['success', 'error', 'error', 'error', 'error']
+    assert 'not_a_field' in results[1]['errors'][0]['description']
+    testapp.get('/testing-link-targets-sno/batch-good/', status=200)
+    testapp.get('/testing-link-targets-sno/batch-bad/', status=404)
+
+
+def test_batch_atomic(testapp):
+    results = post_batch(testapp, [
+        {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-atomic'}},
+        {'method': 'POST', 'type': TARGET_TYPE, 'body': {'not_a_field': 1}},
+    ], params='?atomic=true', status=422)
+    assert [result['status'] for result in results] == ['rolled back', 'error']
+    testapp.get('/testing-link-targets-sno/batch-atomic/', status=404)
+
+
+def test_batch_check_only(testapp):
+    results = post_batch(testapp, [
+        {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-check'}},
+    ], params='?check_only=true')
+    assert results[0]['status'] == 'success'
+    testapp.get('/testing-link-targets-sno/batch-check/', status=404)
+
+
+def test_batch_permissions(testapp):
+    """ Rows are checked against the same permissions as the single-item endpoints """
+    results = post_batch(testapp, [{'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-perm'}}])
+    # the testing types let everyone add and edit, so deny those permissions explicitly
+    with mock.patch.object(Request, 'has_permission',
+                           side_effect=lambda permission, context=None: permission not in ('add', 'edit')):
+        results = post_batch(testapp, [
+            {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-denied'}},
+            {'method': 'PATCH', 'id': results[0]['uuid'], 'body': {'status': 'deleted'}},
+        ])
+    assert [result['errors'][0]['name'] for result in results] == ['permission', 'permission']
+    testapp.get('/testing-link-targets-sno/batch-denied/', status=404)
+
+
+def test_batch_queues_once_after_commit(testapp):
+    """ All written items are queued for indexing in a single after-commit hook """
+    with mock.patch.object(batch_views, 'add_batch_to_indexing_queue') as mock_queue:
+        results = post_batch(testapp, [
+            {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': 'batch-queue-%s' % i}} for i in range(3)
+        ])
+    assert mock_queue.call_count == 1
+    success, _, queued = mock_queue.call_args[0]
+    assert success is True
+    assert [item['uuid'] for item, _ in queued] == [result['uuid'] for result in results]
+    assert {edit_or_add for _, edit_or_add in queued} == {'add'}
+
+
+def test_batch_failed_rows_not_queued(testapp):
+    """ A row failing after its item was written (and queued) is rolled back along with its queue entry """
+    create_item = batch_views.create_item
+
+    def failing_create_item(type_info, request, properties):
+        item = create_item(type_info, request, properties)
+        if properties['name'] == 'batch-late-failure':
+            raise HTTPUnprocessableEntity('failed after writing')
+        return item
+
+    with mock.patch.object(batch_views, 'add_batch_to_indexing_queue') as mock_queue:
+        with mock.patch.object(batch_views, 'create_item', side_effect=failing_create_item):
+            results = post_batch(testapp, [
+                {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': name}}
+                for name in ['batch-before', 'batch-late-failure', 'batch-after']
+            ])
+    assert [result['status'] for result in results] == ['success', 'error', 'success']
+    _, _, queued = mock_queue.call_args[0]
+    assert [item['uuid'] for item, _ in queued] == [results[0]['uuid'], results[2]['uuid']]
+    testapp.get('/testing-link-targets-sno/batch-late-failure/', status=404)
+
+
+def test_batch_integrity_error_is_row_error(testapp):
+    """ A row whose writes conflict in the database is reported and rolled back on its own """
+    create_item = batch_views.create_item
+
+    def conflicting_create_item(type_info, request, properties):
+        item = create_item(type_info, request, properties)
+        if properties['name'] == 'batch-conflict':
+            session = request.registry[DBSESSION]()
+            key = session.query(Key).filter(Key.rid == item.uuid).first()
+            session.add(Key(name=key.name, value=key.value, rid=item.uuid))
+            session.flush()
+        return item
+
+    with mock.patch.object(batch_views, 'add_batch_to_indexing_queue') as mock_queue:
+        with mock.patch.object(batch_views, 'create_item', side_effect=conflicting_create_item):
+            results = post_batch(testapp, [
+                {'method': 'POST', 'type': TARGET_TYPE, 'body': {'name': name}}
+                for name in ['batch-no-conflict', 'batch-conflict', 'batch-after-conflict']
+            ])
+    assert [result['status'] for result in results] == ['success', 'error', 'success']
+    assert results[1]['errors'][0]['name'] == 'IntegrityError'
+    _, _, queued = mock_queue.call_args[0]
+    assert [item['uuid'] for item, _ in queued] == [results[0]['uuid'], results[2]['uuid']]
+    testapp.get('/testing-link-targets-sno/batch-conflict/', status=404)
+    testapp.get('/testing-link-targets-sno/batch-after-conflict/', status=200)
+
+
+def test_parse_batch_rows():
+    assert parse_batch_rows(b'{"a": 1}\n\n{"b": 2}\n') == [{'a': 1}, {'b': 2}]
+    with pytest.raises(Exception):
+        parse_batch_rows(b'{"a": 1}\nnot json\n')
+    with pytest.raises(Exception):
+        parse_batch_rows(b'[1, 2]\n')
@@ -1,3 +1,5 @@
+import cProfile
+import pstats
 import pytest
 
 
@@ -48,3 +50,29 @@ def test_calculated_build_object(testapp, basic_calculated_item):
             assert entry['keyvalue'] == 'appleorange'
         elif entry['key'] == 'blah':
             assert entry['keyvalue'] == 'blahblah'
+
+
+def test_calculated_required_fields(testapp, basic_calculated_item):
+    """ Tests that only the required calculated properties are computed, and that their costs are counted """
+    [res] = testapp.post_json(CONNECTION_URL, basic_calculated_item, status=201).json['@graph']
+    full = testapp.get(res['@id'] + '@@object').json
+    partial = testapp.get(res['@id'] + '@@object?required_fields=combination,name').json
+    assert 'combination' in partial and 'combination' in full
+    assert 'display_title' in full and 'display_title' not in partial
+    assert partial['name'] == 'cat'  # stored properties are all there
+    stats = testapp.get('/calculated-property-stats').json['@graph']
+    display_title, = [entry for entry in stats
+                      if entry['type'] == 'TestingCalculatedProperties' and entry['name'] == 'display_title']
+    assert display_title['computed'] >= 1 and display_title['skipped'] >= 1
+
+
+def test_calculated_property_discovery_out_of_hot_path(testapp, basic_calculated_item):
+    """ Tests that the properties of a class and the arguments they take are only looked up once """
+    [res] = testapp.post_json(CONNECTION_URL, basic_calculated_item, status=201).json['@graph']
+    testapp.get(res['@id'] + '@@object')
+    profile = cProfile.Profile()
+    profile.runcall(testapp.get, res['@id'] + '@@object')
+    called = {function_name for _, _, function_name in pstats.Stats(profile).stats}
+    assert 'calculate_properties' in called
+    assert '_collect_props' not in called
+    assert '_arg_names' not in called
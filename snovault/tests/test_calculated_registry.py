@@ -9,8 +9,8 @@ Complements (does not replace) test_calculated.py's end-to-end check.
 """
 import pytest
 
-from ..calculated import CalculatedProperty, CalculatedProperties, ItemNamespace
-from ..interfaces import CONNECTION
+from ..calculated import CalculatedProperty, CalculatedProperties, ItemNamespace, calculate_properties
+from ..interfaces import CALCULATED_PROPERTIES, CONNECTION
 
 
 pytestmark = [pytest.mark.unit]
@@ -141,3 +141,72 @@ class TestCalculatedPropertiesRegistry:
         assert set(registry.props_for(Sub, category='object')) == {'objprop'}
         assert set(registry.props_for(Sub, category='page')) == {'pageprop'}
         assert registry.props_for(Sub, category='missing') == {}
+
+
+class TestCalculatePropertiesFields:
+
+    @pytest.fixture
+    def request_(self):
+        class Thing:
+            pass
+
+        registry = CalculatedProperties()
+        calls = []
+        registry.register_prop(lambda: calls.append('cheap') or 'cheap', 'cheap', Thing)
+        registry.register_prop(lambda: calls.append('costly') or 'costly', 'costly', Thing)
+        registry.register_prop(lambda base: calls.append('derived') or base + '!', 'derived', Thing)
+        registry.register_prop(lambda: calls.append('base') or 'base', 'base', Thing, define=True)
+
+        class Request:
+            pass
+
+        request = Request()
+        request.registry = {CALCULATED_PROPERTIES: registry, CONNECTION: None}
+        return request, Thing(), calls
+
+    def test_all_computed_without_fields(self, request_):
+        request, thing, calls = request_
+        assert calculate_properties(thing, request) == {
+            'cheap': 'cheap', 'costly': 'costly', 'derived': 'base!', 'base': 'base'}
+
+    def test_only_required_computed(self, request_):
+        request, thing, calls = request_
+        assert calculate_properties(thing, request, fields={'derived', 'name'}) == {'derived': 'base!'}
+        # what derived depends on is computed for it, the rest is skipped
+        assert calls == ['base', 'derived']
+
+    def test_costs_counted(self, request_):
+        request, thing, calls = request_
+        calculate_properties(thing, request)
+        calculate_properties(thing, request, fields={'cheap'})
+        stats = {entry['name']: entry for entry in request.registry[CALCULATED_PROPERTIES].stats()}
+        assert set(stats) == {'cheap', 'costly', 'derived', 'base'}
+        assert (stats['cheap']['computed'], stats['cheap']['skipped']) == (2, 0)
+        assert (stats['costly']['computed'], stats['costly']['skipped']) == (1, 1)
+        assert stats['cheap']['type'] == 'Thing' and stats['cheap']['time'] >= 0
+
+
+class TestCalculatedPropertiesTables:
+
+    def test_table_computed_once(self, monkeypatch):
+        class Thing:
+            pass
+
+        registry = CalculatedProperties()
+        registry.register_prop(lambda: 'v', 'prop', Thing)
+        registry.register_prop(lambda: 'd', 'base', Thing, define=True)
+        props, defined = registry.table_for(Thing())
+        assert set(props) == {'prop', 'base'} and set(defined) == {'base'}
+        monkeypatch.setattr(registry, '_collect_props', None)
+        assert registry.table_for(Thing) == (props, defined)
+        assert registry.props_for(Thing()) is props
+
+    def test_registration_resets_tables(self):
+        class Thing:
+            pass
+
+        registry = CalculatedProperties()
+        registry.register_prop(lambda: 'v', 'prop', Thing)
+        assert set(registry.props_for(Thing)) == {'prop'}
+        registry.register_prop(lambda: 'w', 'other', Thing)
+        assert set(registry.props_for(Thing)) == {'prop', 'other'}
@@ -0,0 +1,99 @@
+"""
+Tests that compound_search's in-process compilation of filter blocks
+(CompoundSearchBuilder.build_filter_block_queries) gives the same queries as the
+/build_query subrequests it replaces. Neither touches ES, so the ES client is a mock
+and the single-type mapping lookup is skipped. The search routes are only registered
+with ES, so route paths (only used in the full search response) are faked too.
+"""
+
+import contextlib
+import json
+import pytest
+
+from pyramid.url import URLMethodsMixin
+from unittest import mock
+
+from ..elasticsearch.interfaces import ELASTIC_SEARCH
+from ..json_renderer import json_renderer
+from ..search.compound_search import CompoundSearchBuilder, build_query
+from ..search.lucene_builder import LuceneBuilder
+from ..search.search import SearchBuilder
+
+
+pytestmark = [pytest.mark.working]
+
+SEARCH_TYPE = 'TestingBiosampleSno'
+TYPE_FLAG = 'type=' + SEARCH_TYPE
+FLAGS = [
+    {'name': 'reviewed', 'query': 'technical_reviews.uuid!=No value'},
+    {'name': 'current', 'query': 'status=current'},
+]
+
+
+@pytest.fixture
+def search_request(dummy_request):
+    dummy_request.environ['REMOTE_USER'] = 'TEST'
+    with mock.patch.dict(dummy_request.registry, {ELASTIC_SEARCH: mock.Mock()}):
+        with mock.patch.object(SearchBuilder, '_get_es_mapping_if_necessary', return_value={}):
+            with mock.patch.object(URLMethodsMixin, 'route_path', lambda self, name, **kw: '/%s/' % name):
+                yield dummy_request
+
+
+def make_blocks(n):
+    queries = ['identifier=sample-{i}', 'quality.from={i}&quality.to=1{i}', 'q=sample&alias=a{i}',
+               'contributor=someone&ranking!={i}']
+    return [{'name': 'block-%s' % i, 'query': queries[i % len(queries)].format(i=i),
+             'flags_applied': [FLAGS[i % len(FLAGS)]['name']] if i % 3 else []} for i in range(n)]
+
+
+def build_with_subrequests(request, blocks, global_flags=None):
+    """ What execute_filter_set used to do: run /build_query for each block, keeping only its query """
+    sub_queries = []
+    for i, block in enumerate(blocks):
+        query = block['query']
+        if global_flags:
+            query = CompoundSearchBuilder.combine_query_strings(global_flags, query)
+        for flag in FLAGS:
+            if flag['name'] in block['flags_applied']:
+                query = CompoundSearchBuilder.combine_query_strings(query, flag['query'])
+        query = CompoundSearchBuilder._add_type_to_flag_if_needed(query, TYPE_FLAG)
+        subreq = CompoundSearchBuilder.build_subreq_from_single_query(
+            request, query, route=CompoundSearchBuilder.BUILD_QUERY_URL)
+        sub_query = json.loads(json_renderer.dumps(build_query(None, subreq)))['query']
+        sub_query['bool']['_name'] = str(block.get('name', i))
+        sub_queries.append(sub_query)
+    return sub_queries
+
+
+def build_in_process(request, blocks, global_flags=None):
+    return CompoundSearchBuilder.build_filter_block_queries(None, request, blocks, FLAGS, TYPE_FLAG,
+                                                            global_flags=global_flags)
+
+
+@pytest.mark.parametrize('global_flags', [None, 'status=current&sort=identifier'])
+def test_filter_block_queries_match_build_query(search_request, global_flags):
+    blocks = make_blocks(8)
+    expected = build_with_subrequests(search_request, blocks, global_flags)
+    actual = build_in_process(search_request, blocks, global_flags)
+    assert json.loads(json_renderer.dumps(actual)) == expected
+    # principals of the request are applied to every block
+    assert all('principals_allowed.view' in json.dumps(query) for query in actual)
+    assert [query['bool']['_name'] for query in actual] == ['block-%s' % i for i in range(8)]
+
+
+def test_filter_block_compile_skips_full_build(search_request):
+    """ Compiling blocks in-process builds one filter query per block, and none of the sort, facets
+        and aggregations (nor subrequests) that building each block's full search like /build_query does
+    """
+    blocks = make_blocks(20)
+    skipped = [(SearchBuilder, 'set_sort_order'), (SearchBuilder, 'initialize_facets'),
+               (LuceneBuilder, 'build_facets')]
+    with contextlib.ExitStack() as stack:
+        spies = {name: stack.enter_context(mock.patch.object(cls, name, autospec=True, side_effect=getattr(cls, name)))
+                 for cls, name in skipped + [(LuceneBuilder, 'build_filters')]}
+        stack.enter_context(mock.patch.object(search_request, 'invoke_subrequest', side_effect=AssertionError))
+        build_in_process(search_request, blocks)
+        assert spies['build_filters'].call_count == len(blocks)
+        assert not any(spies[name].called for _, name in skipped)
+        build_with_subrequests(search_request, blocks)
+        assert all(spies[name].call_count == len(blocks) for _, name in skipped)
@@ -0,0 +1,71 @@
+"""
+Tests for the batch mode of the /embed API (custom_embed.CustomEmbedBatch), which embeds many
+ids at once and keys the results by id.
+"""
+
+import pytest
+
+from pyramid.security import DENY_ALL
+from unittest import mock
+
+from .. import custom_embed
+from ..interfaces import TYPES
+from ..custom_embed import CustomEmbedBatch
+from .testing_views import TestingBiosourceSno
+
+
+pytestmark = [pytest.mark.working]
+
+
+SAMPLES = ['6a8ab4ee-0000-4000-8000-%012d' % i for i in range(3)]
+SOURCES = ['7a8ab4ee-0000-4000-8000-%012d' % i for i in range(8)]
+
+
+@pytest.fixture
+def sources(testapp):
+    """ Biosources sharing their biosamples """
+    for i, uuid in enumerate(SAMPLES):
+        testapp.post_json('/testing-biosample-sno/', {'identifier': 'sample%s' % i, 'uuid': uuid}, status=201)
+    for i, uuid in enumerate(SOURCES):
+        testapp.post_json('/testing-biosource-sno/', {'identifier': 'source%s' % i, 'uuid': uuid,
+                                                     'samples': [SAMPLES[i % 2], SAMPLES[2]]}, status=201)
+    return SOURCES
+
+
+@pytest.mark.parametrize('params', [{}, {'fields': ['identifier', 'samples.identifier', 'samples.@id']},
+                                    {'depth': 1}])
+def test_embed_batch(testapp, sources, params):
+    ids = sources[:6] + ['/testing-biosource-sno/source6/']
+    results = testapp.post_json('/embed', dict(params, ids=ids, batch=True)).json
+    # the same as embedding ids one at a time
+    assert results == {item_id: testapp.post_json('/embed', dict(params, ids=[item_id])).json[0] for item_id in ids}
+    assert [sample['identifier'] for sample in results[sources[0]]['samples']] == ['sample0', 'sample2']
+
+
+def test_embed_batch_limits(testapp, sources, monkeypatch):
+    testapp.post_json('/embed', {'ids': sources}, status=400)  # too many without batch
+    monkeypatch.setattr(custom_embed, 'MAX_BATCH_IDS', 4)
+    testapp.post_json('/embed', {'ids': sources, 'batch': True}, status=400)
+    res = testapp.post_json('/embed', {'ids': sources[:2] + ['not-an-id'], 'batch': True}, status=400)
+    assert 'not-an-id' in res.json['detail']
+
+
+def test_embed_batch_permissions(testapp, registry, sources, monkeypatch):
+    acl = TestingBiosourceSno.__acl__
+    monkeypatch.setattr(TestingBiosourceSno, '__acl__',
+                        lambda self: [DENY_ALL] if str(self.uuid) == sources[1] else acl(self))
+    # depends on the uuid, so must not be cached by status
+    monkeypatch.setattr(registry[TYPES]['TestingBiosourceSno'], 'acl_fields', None)
+    results = testapp.post_json('/embed', {'ids': sources[:3], 'batch': True}).json
+    assert results[sources[1]] is None
+    assert results[sources[0]]['uuid'] == sources[0]
+    assert testapp.post_json('/embed', {'ids': [sources[1]]}).json == [None]
+
+
+def test_embed_batch_renders_objects_once(sources, dummy_request, threadlocals):
+    embed_props = {'ignored_embeds': [], 'desired_embeds': [], 'embed_depth': 4, 'requested_fields': []}
+    with mock.patch.object(dummy_request, 'embed', wraps=dummy_request.embed) as embed:
+        results = CustomEmbedBatch(dummy_request, sources, embed_props).results
+    assert sorted(results) == sorted(sources)
+    rendered = [call.args[0] for call in embed.call_args_list]
+    assert len(rendered) == len(set(rendered)) == len(sources) + len(SAMPLES)
@@ -3,8 +3,8 @@ import pytest
 
 from ..interfaces import TYPES
 from ..util import (
-    build_embedded_model, build_default_embeds, crawl_schema, expand_embedded_list,
-    find_collection_subtypes, find_default_embeds_for_schema,
+    EmbeddedPlan, add_default_embeds, build_embedded_model, build_default_embeds, crawl_schema,
+    expand_embedded_list, expand_embedded_model, find_collection_subtypes, find_default_embeds_for_schema,
 )
 
 
@@ -203,3 +203,55 @@ def test_build_embedded_model():
             "fields_to_use": ["*"]
         }
     }
+
+
+def test_embedded_plan():
+    plan = EmbeddedPlan.compile(['lab.uuid', 'lab.title', 'award.*', 'modifications.regions.chromosome'])
+    assert plan.all_fields and plan.fields == ()
+    links = dict(plan.links)
+    assert set(links) == {'lab', 'award', 'modifications'}
+    assert not links['lab'].all_fields and links['lab'].fields == ('uuid', 'title')
+    assert links['award'].all_fields
+    regions, = links['modifications'].links
+    assert regions[0] == 'regions' and regions[1].fields == ('chromosome',)
+    with pytest.raises(AttributeError):
+        plan.fields = ('x',)
+
+
+def test_embedded_plan_object_view():
+    """ Linked items are embedded computing only the calculated properties the plan takes from them """
+    links = dict(EmbeddedPlan.compile(['lab.uuid', 'lab.title', 'lab.pi.name', 'award.*']).links)
+    assert links['lab'].object_view == '@@object?required_fields=@id,pi,title,uuid'
+    assert links['award'].object_view == '@@object'
+
+
+def test_expand_embedded_plan():
+    """ A plan expands like the model it was compiled from, without following links here (no linkTos) """
+    obj = {'a': 1, 'sub': {'x': 1, 'y': 2}, 'subs': [{'x': 3, 'y': 4}, {'y': 5}]}
+    model = build_embedded_model(['sub.x', 'subs.x'])
+    plan = EmbeddedPlan(model)
+
+    class Request:
+        _aggregated_items = {}
+        _indexing_view = False
+
+    expected = {'a': 1, 'sub': {'x': 1}, 'subs': [{'x': 3}, {}]}
+    assert expand_embedded_model(Request(), obj, plan) == expected
+    assert expand_embedded_model(Request(), obj, model) == expected
+    assert obj['sub'] == {'x': 1, 'y': 2}
+
+
+def test_type_info_embedded_compiled_once(registry, monkeypatch):
+    type_info = registry[TYPES]['TestingLinkSourceSno']
+    expected = add_default_embeds(type_info.item_type, registry[TYPES], type_info.embedded_list, type_info.schema)
+    assert sorted(type_info.embedded) == sorted(expected)
+    plan = type_info.embedded_plan
+    assert dict(plan.links)['target'].fields
+    # reused until the schema (or embedded_list) is replaced, as when reloading schemas
+    calls = []
+    monkeypatch.setattr('snovault.typeinfo.add_default_embeds', lambda *args: calls.append(args) or ['target.uuid'])
+    assert type_info.embedded_plan is plan
+    monkeypatch.setitem(type_info.__dict__, 'schema', dict(type_info.schema))
+    assert type_info.embedded == ('target.uuid',)
+    assert type_info.embedded_plan is not plan
+    assert len(calls) == 1
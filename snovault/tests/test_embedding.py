@@ -2,10 +2,17 @@ import pytest
 
 from dcicutils.misc_utils import ignored
 from dcicutils.qa_utils import notice_pytest_fixtures, Retry, Eventually
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.security import Allow, DENY_ALL
 from re import findall
-from ..interfaces import TYPES
-from ..util import add_default_embeds, crawl_schemas_by_embeds
+from unittest import mock
+from .. import embed as embed_module, util
+from ..cache import estimate_size
+from ..connection import Connection
+from ..interfaces import DBSESSION, TYPES
+from ..util import add_default_embeds, crawl_schemas_by_embeds, embedded_principals_index
 from .test_views import PARAMETERIZED_NAMES
+from .testing_views import TestingLinkSourceSno
 
 
 class DecayingRetry(Retry):
@@ -185,6 +192,8 @@ def test_linked_uuids_index_data(content, dummy_request, threadlocals):
 
     # embedded view linked uuids are unchanged
     assert res['rev_link_names'] == {}
+    assert res['embedded_principals'] == embedded_principals_index(res['embedded'])
+    assert [path for path, _ in res['embedded_principals']['paths']] == [[], ['target']]
     assert res['rev_linked_to_me'] == [targets[0]['uuid']]
     # object view linked uuids are contained within the embedded linked uuids
     assert set((linked['uuid'], linked['item_type'])
@@ -203,3 +212,125 @@ def test_linked_uuids_index_data(content, dummy_request, threadlocals):
     res3 = dummy_request.embed('/testing-link-targets-sno/', targets[1]['uuid'], '@@index-data', as_user='INDEXER')
     assert {sources[0]['uuid'], targets[0]['uuid'], targets[1]['uuid']} <= set(dummy_request._sid_cache)
     ignored(res3)
+
+
+def test_embed_item_view_directly(content, dummy_request, threadlocals, monkeypatch):
+    notice_pytest_fixtures(content, dummy_request, threadlocals)
+    dummy_request._indexing_view = True
+    path = '/testing-link-sources-sno/%s/@@embedded' % sources[0]['uuid']
+    with mock.patch.object(dummy_request, 'invoke_subrequest', side_effect=AssertionError('not direct')):
+        direct = dummy_request.embed(path, as_user=True)
+    direct_linked_uuids = dummy_request._linked_uuids
+    assert direct_linked_uuids == {(sources[0]['uuid'], 'TestingLinkSourceSno'),
+                                   (targets[0]['uuid'], 'TestingLinkTargetSno')}
+
+    # the same as going through the router
+    monkeypatch.setattr(embed_module, 'DIRECT_VIEWS', ())
+    dummy_request._linked_uuids = set()
+    assert dummy_request.embed(path, as_user=True) == direct
+    assert dummy_request._linked_uuids == direct_linked_uuids
+
+
+def test_embed_cache_stats(content, dummy_request, threadlocals):
+    notice_pytest_fixtures(content, dummy_request, threadlocals)
+    dummy_request._stats = {}
+    path = '/testing-link-sources-sno/%s/@@object' % sources[0]['uuid']
+    first = dummy_request.embed(path)
+    assert dummy_request.embed(path) == first
+    stats = dummy_request._stats
+    assert (stats['embed_cache_hits'], stats['embed_cache_misses'], stats['embed_cache_evictions']) == (1, 1, 0)
+    assert stats['embed_cache_bytes'] == dummy_request.registry['connection'].embed_cache.size > 0
+
+
+def test_embed_cache_entries_sized_without_shared_caches(content, dummy_request, threadlocals):
+    notice_pytest_fixtures(content, dummy_request, threadlocals)
+    dummy_request._indexing_view = True
+    # the sid cache (like aggregated items) is shared by every entry of the request
+    dummy_request._sid_cache.update({str(n): n for n in range(100000)})
+    embed_cache = dummy_request.registry['connection'].embed_cache
+    for source in sources:
+        dummy_request.embed('/testing-link-sources-sno/%s/@@object' % source['uuid'])
+    assert 0 < embed_cache.size < estimate_size(dummy_request._sid_cache) / 100
+    assert len(embed_cache.cache) == len(sources)
+
+
+def test_embed_cache_object_subsets(content, dummy_request, threadlocals):
+    """ An item embedded for different sets of fields is rendered at most twice """
+    notice_pytest_fixtures(content, dummy_request, threadlocals)
+    item_path = '/testing-link-sources-sno/%s/' % sources[0]['uuid']
+    with mock.patch.object(embed_module, '_embed', side_effect=embed_module._embed) as spy:
+        partial = dummy_request.embed(item_path, '@@object?required_fields=@id,name')
+        assert dummy_request.embed(item_path, '@@object?required_fields=@id') == partial
+        assert [call[0][1] for call in spy.call_args_list] == [item_path + '@@object?required_fields=@id,name']
+        full = dummy_request.embed(item_path, '@@object?required_fields=@id,display_title')
+        assert dummy_request.embed(item_path, '@@object?required_fields=@id,name') == full
+        assert dummy_request.embed(item_path, '@@object') == full
+    assert [call[0][1] for call in spy.call_args_list] == [item_path + '@@object?required_fields=@id,name',
+                                                           item_path + '@@object']
+    assert 'display_title' not in partial and full['display_title']
+
+
+@pytest.mark.parametrize('direct_views', [(), ('object',)])
+def test_embed_item_view_directly_checks_permissions(content, dummy_request, threadlocals, monkeypatch,
+                                                     direct_views):
+    notice_pytest_fixtures(content, dummy_request, threadlocals)
+    monkeypatch.setattr(embed_module, 'DIRECT_VIEWS', direct_views)
+    monkeypatch.setattr(TestingLinkSourceSno, '__acl__', lambda self: [(Allow, 'remoteuser.EMBED', ['view']), DENY_ALL])
+    path = '/testing-link-sources-sno/%s/@@object' % sources[0]['uuid']
+    assert dummy_request.embed(path, as_user='EMBED')['uuid'] == sources[0]['uuid']
+    with pytest.raises(HTTPForbidden):
+        dummy_request.embed(path, as_user='someone')
+
+
+def test_embed_item_view_directly_many_links(testapp, dummy_request, threadlocals, monkeypatch):
+    """ Uncached @@embedded renders of items linking to 20 others each never go through the router """
+    notice_pytest_fixtures(dummy_request, threadlocals)
+    for target in targets:
+        testapp.post_json('/testing-link-targets-sno/', target, status=201)
+    uuids = [testapp.post_json('/testing-link-aggregates-sno/', {
+        'name': 'many-%s' % i,
+        'targets': [{'target': targets[j % 2]['uuid'], 'test_description': str(j)} for j in range(20)],
+        'status': 'current',
+    }, status=201).json['@graph'][0]['uuid'] for i in range(3)]
+    paths = ['/testing-link-aggregates-sno/%s/@@embedded' % uuid for uuid in uuids]
+
+    with mock.patch.object(dummy_request, 'invoke_subrequest', side_effect=AssertionError('not direct')):
+        direct = [dummy_request.embed(path, as_user=True) for path in paths]
+    monkeypatch.setattr(embed_module, 'DIRECT_VIEWS', ())
+    with mock.patch.object(dummy_request, 'invoke_subrequest', wraps=dummy_request.invoke_subrequest) as routed:
+        assert [dummy_request.embed(path, as_user=True) for path in paths] == direct
+    assert routed.call_count >= len(paths)
+
+
+def test_embed_linked_items_loaded_in_bulk(testapp, registry, dummy_request, threadlocals, monkeypatch):
+    """ Items linked from lists are loaded together rather than one by one """
+    notice_pytest_fixtures(dummy_request)
+    individuals = ['6a8ab4ee-0000-4000-8000-%012d' % i for i in range(10)]
+    samples = ['7a8ab4ee-0000-4000-8000-%012d' % i for i in range(10)]
+    for i in range(10):
+        testapp.post_json('/testing-individual-sno/', {'full_name': 'Individual Number%s' % i,
+                                                       'uuid': individuals[i]}, status=201)
+        testapp.post_json('/testing-biosample-sno/', {'identifier': 'sample%s' % i, 'contributor': individuals[i],
+                                                     'uuid': samples[i]}, status=201)
+    testapp.post_json('/testing-biosource-sno/', {'identifier': 'source', 'samples': samples,
+                                                  'contributor': individuals[0]}, status=201)
+    testapp.post_json('/testing-biogroup-sno/', {'name': 'group', 'sources': 'source'}, status=201)
+
+    def embed(path):
+        """ Embeds path from an empty session and caches, returning the result and the queries it took """
+        registry[DBSESSION]().expunge_all()
+        for cache in ['snovault.connection.item_cache', 'snovault.connection.key_cache']:
+            threadlocals.pop(cache, None)
+        dummy_request._stats.clear()
+        result = dummy_request.embed(path, as_user=True)
+        return result, dummy_request._stats['db_count']
+
+    for path in ['/testing-biosource-sno/source/@@embedded', '/testing-biogroup-sno/group/@@embedded']:
+        bulk, bulk_count = embed(path)
+        with monkeypatch.context() as m:
+            m.setattr(util, 'prefetch_linked_items', lambda request, obj_val: None)
+            m.setattr(Connection, 'get_by_uuids',
+                      lambda self, uuids, datastore=None: [self.get_by_uuid(uuid) for uuid in uuids])
+            one_by_one, one_by_one_count = embed(path)
+        assert bulk == one_by_one
+        assert bulk_count < one_by_one_count / 4
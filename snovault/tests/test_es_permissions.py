@@ -1,7 +1,10 @@
 import pytest
 
 from copy import deepcopy
+from unittest import mock
+from .. import util
 from ..elasticsearch.cached_views import filter_embedded
+from ..util import embedded_principals_index
 
 
 def test_filtered_embedded_admin(embedded_lab, effective_princ_admin):
@@ -38,6 +41,49 @@ def test_filtered_embedded_array(embedded_3rd_array, effective_princ_lab):
     assert 'uuid' in modified['biosample']['biosource'][0]['individual']['organism'].keys()
 
 
+def test_embedded_principals_index(embedded_2nd):
+    assert embedded_principals_index(embedded_2nd) == {
+        'principals': [['system.Everyone'], ['group.admin']],
+        'paths': [[['lab'], 0], [['lab', 'award'], 1]],
+    }
+    assert embedded_principals_index({'lab': {'name': 'no principals'}}) == {'principals': [], 'paths': []}
+
+
+@pytest.mark.parametrize('embedded', ['embedded_lab', 'embedded_2nd', 'embedded_3rd_array'])
+@pytest.mark.parametrize('principals', [[], 'effective_princ_not_logged_in', 'effective_princ_lab',
+                                        'effective_princ_admin'])
+def test_filtered_embedded_by_index(request, embedded, principals):
+    """ Filtering with the index of the embedded view gives what walking it does """
+    embedded = request.getfixturevalue(embedded)
+    if principals:
+        principals = request.getfixturevalue(principals)
+    index = embedded_principals_index(embedded)
+    assert filter_embedded(deepcopy(embedded), principals, index) == filter_embedded(deepcopy(embedded), principals)
+    # including of a view the principals may not see at all
+    top_level = {'principals_allowed': {'view': ['nobody']}, **deepcopy(embedded)}
+    assert (filter_embedded(top_level, principals, embedded_principals_index(top_level))
+            == {'error': 'no view permissions'})
+
+
+def test_filtered_embedded_by_index_allowed_everything(embedded_3rd_array, effective_princ_admin):
+    index = embedded_principals_index(embedded_3rd_array)
+    original = deepcopy(embedded_3rd_array)
+    # the document is not walked at all
+    with mock.patch.object(util, 'filter_embedded', side_effect=AssertionError('walked')):
+        assert filter_embedded(embedded_3rd_array, effective_princ_admin, index) is embedded_3rd_array
+    assert embedded_3rd_array == original
+
+
+def test_filtered_embedded_by_index_large(embedded_3rd_array, effective_princ_admin, effective_princ_lab):
+    """ Filtering a large embedded view with its index gives what walking it does """
+    embedded = {'biosamples': [deepcopy(embedded_3rd_array) for _ in range(50)],
+                'principals_allowed': {'view': ['system.Everyone']}}
+    index = embedded_principals_index(embedded)
+    for principals in [effective_princ_admin, effective_princ_lab]:
+        assert (filter_embedded(deepcopy(embedded), principals, index)
+                == filter_embedded(deepcopy(embedded), principals))
+
+
 @pytest.fixture()
 def effective_princ_not_logged_in():
     return ['system.Everyone']
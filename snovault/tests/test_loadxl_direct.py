@@ -0,0 +1,149 @@
+import json
+import pytest
+import uuid
+
+from dcicutils.data_readers import RowReader
+from unittest import mock
+
+from .. import loadxl_direct
+from ..interfaces import COLLECTIONS
+from ..loadxl import load_all_gen
+from ..loadxl_direct import load_all_direct, supports_direct_write
+
+
+pytestmark = [pytest.mark.setone, pytest.mark.working]
+
+
+TARGET_TYPE = 'testing_link_target_sno'
+SOURCE_TYPE = 'testing_link_source_sno'
+PPP_TYPE = 'testing_post_put_patch_sno'
+
+
+def make_store(prefix):
+    """ Same items for both loaders; sources link to targets by name """
+    store = {
+        TARGET_TYPE: [
+            {'name': f'{prefix}-target-1', 'status': 'current'},
+            {'name': f'{prefix}-target-2'},
+        ],
+        SOURCE_TYPE: [
+            {'name': f'{prefix}-source-1', 'target': f'{prefix}-target-1', 'status': 'current'},
+            {'name': f'{prefix}-source-2', 'target': f'{prefix}-target-1'},
+        ],
+        PPP_TYPE: [
+            {'required': f'{prefix} required', 'simple2': 'simple2 value'},
+        ],
+    }
+    for items in store.values():
+        for item in items:
+            item['uuid'] = str(uuid.uuid5(uuid.NAMESPACE_URL, item.get('name') or item['required']))
+    return store
+
+
+def get_loaded(testapp, store, prefix):
+    """ Returns the loaded items, with links resolved to names and the prefix removed, keyed by name """
+    items = {}
+    for item in [item for items in store.values() for item in items]:
+        key = item.get('name') or item['required']
+        item = testapp.get('/' + item['uuid'] + '?frame=object').maybe_follow().json
+        for field in ['uuid', '@id']:
+            del item[field]
+        if 'target' in item:
+            item['target'] = testapp.get(item['target'] + '?frame=object').json['name']
+        if 'reverse' in item:
+            item['reverse'] = sorted(testapp.get(source + '?frame=object').json['name'] for source in item['reverse'])
+        items[key] = item
+    return json.loads(json.dumps(items).replace(prefix, 'prefix'))
+
+
+def test_load_all_direct_parity(testapp):
+    """ Items loaded directly look the same as the items loaded through the app """
+    # the testing schemas have no identifyingProperties, so post whole items through the app
+    http_store = make_store('http')
+    http_output = [line.decode('utf-8') for line in load_all_gen(testapp, http_store, None, from_json=True,
+                                                                 post_only=True, noset_last_modified=True)]
+    assert not [line for line in http_output if line.startswith('ERROR')]
+    # sources come first here: links to items of the same load resolve before they are written
+    store = make_store('direct')
+    store = {SOURCE_TYPE: store[SOURCE_TYPE], TARGET_TYPE: store[TARGET_TYPE], PPP_TYPE: store[PPP_TYPE]}
+    assert load_all_direct(testapp, store, from_json=True, noset_last_modified=True) is None
+
+    http_items, direct_items = get_loaded(testapp, http_store, 'http'), get_loaded(testapp, store, 'direct')
+    assert len(direct_items) == 5
+    assert direct_items == http_items
+    assert direct_items['prefix-target-1']['reverse'] == ['prefix-source-1', 'prefix-source-2']
+    # unique keys were written too
+    testapp.get('/testing-link-targets-sno/direct-target-2/', status=200)
+
+
+def test_load_all_direct_errors_write_nothing(testapp):
+    store = make_store('broken')
+    store[TARGET_TYPE][1]['not_a_field'] = 'bad'
+    store[SOURCE_TYPE][1]['target'] = 'no-such-target'
+    result = load_all_direct(testapp, store, from_json=True, noset_last_modified=True)
+    assert isinstance(result, Exception)
+    errors = str(result).splitlines()
+    assert all(error.startswith('ERROR: /') for error in errors)
+    # one or more errors for each of the two bad items
+    assert len({error.split()[1] for error in errors}) == 2
+    assert 'no-such-target' in str(result)
+    testapp.get('/testing-link-targets-sno/broken-target-1/', status=404)
+
+
+def test_load_all_direct_duplicates(testapp):
+    """ Items of a load sharing a uuid or unique key are reported rather than failing the COPY """
+    store = make_store('duplicate')
+    store[TARGET_TYPE].append(dict(store[TARGET_TYPE][0], name='duplicate-target-3'))  # same uuid
+    store[SOURCE_TYPE][1]['name'] = 'duplicate-source-1'  # same name (a unique key)
+    result = load_all_direct(testapp, store, from_json=True, noset_last_modified=True)
+    assert isinstance(result, Exception)
+    errors = str(result).splitlines()
+    assert len(errors) == 2
+    assert all(error.startswith('ERROR: /') and ' duplicate: ' in error for error in errors)
+    assert "uuid '%s'" % store[TARGET_TYPE][0]['uuid'] in errors[0]
+    assert "'duplicate-source-1' is also used by /%s/" % SOURCE_TYPE in errors[1]
+    testapp.get('/testing-link-targets-sno/duplicate-target-1/', status=404)
+
+
+def test_load_all_direct_existing_items(testapp):
+    assert load_all_direct(testapp, {TARGET_TYPE: [{'name': 'existing-target', 'status': 'current'}]},
+                           from_json=True, noset_last_modified=True) is None
+    item_id = '/testing-link-targets-sno/existing-target/'
+    # without overwrite, items that exist (here found by unique key) are left alone
+    assert load_all_direct(testapp, {TARGET_TYPE: [{'name': 'existing-target', 'status': 'deleted'}]},
+                           from_json=True, overwrite=False, noset_last_modified=True) is None
+    assert testapp.get(item_id + '?frame=object').json['status'] == 'current'
+    # with overwrite, they are patched through the app
+    assert load_all_direct(testapp, {TARGET_TYPE: [{'name': 'existing-target', 'status': 'deleted'}]},
+                           from_json=True, overwrite=True, noset_last_modified=True) is None
+    assert testapp.get(item_id + '?frame=object').json['status'] == 'deleted'
+    revisions = testapp.get(item_id + '@@revision-history').json['revisions']
+    assert [revision['status'] for revision in revisions] == ['current', 'deleted']
+
+
+def test_load_all_direct_overwrite_deletes_properties(testapp):
+    item = dict(make_store('deleting')[PPP_TYPE][0], field_no_default='value')
+    assert load_all_direct(testapp, {PPP_TYPE: [item]}, from_json=True, noset_last_modified=True) is None
+    assert testapp.get('/' + item['uuid'] + '?frame=object').maybe_follow().json['field_no_default'] == 'value'
+    item = dict(item, field_no_default=RowReader.CELL_DELETION_SENTINEL)
+    assert load_all_direct(testapp, {PPP_TYPE: [item]}, from_json=True, overwrite=True,
+                           noset_last_modified=True) is None
+    assert 'field_no_default' not in testapp.get('/' + item['uuid'] + '?frame=object').maybe_follow().json
+
+
+def test_load_all_direct_queues_for_indexing(testapp):
+    with mock.patch.object(loadxl_direct, 'add_batch_to_indexing_queue') as mock_queue:
+        assert load_all_direct(testapp, make_store('queued'), from_json=True, noset_last_modified=True) is None
+    assert mock_queue.call_count == 1
+    success, _, queued = mock_queue.call_args[0]
+    assert success is True
+    assert len(queued) == 5
+    assert {edit_or_add for _, edit_or_add in queued} == {'add'}
+    assert len({item['sid'] for item, _ in queued}) == 5
+
+
+def test_supports_direct_write(registry):
+    collections = registry[COLLECTIONS]
+    assert supports_direct_write(collections[TARGET_TYPE])
+    # AccessKey customizes create and update, so it goes through the ORM
+    assert not supports_direct_write(collections['access_key'])
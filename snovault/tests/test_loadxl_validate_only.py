@@ -112,3 +112,12 @@ def test_loadxl_validate_only_existing_item_uses_check_only_skip_links(testapp,
     res = testapp.get(loadxl_item)
     assert res.json['required'] == EXISTING_ITEM['required']
     assert res.json['simple1'] == 'simple1 default'
+
+
+def test_loadxl_post_only_skips_second_round(testapp, external_tx):
+    """ post_only has no second (PATCH) round, which used to fail with a KeyError """
+    notice_pytest_fixtures(external_tx)
+    item = {'uuid': '0c6b5a8e-6f3e-4b8d-9d4e-1f6b2d8a7c11', 'required': 'posted whole'}
+    lines = run_load_all_gen(testapp, {ITEM_TYPE: [item]}, post_only=True)
+    assert not [line for line in lines if line.startswith('ERROR')]
+    assert testapp.get(COLLECTION_URL + item['uuid'] + '/').json['required'] == 'posted whole'
@@ -23,6 +23,9 @@ def test_stats_tween_logs_stats(testapp, mocked):
         assert mocked_log.bind.call_count == 2
         assert mocked_log.bind.call_args_list[0] == mock.call(url_path='/', url_qs='', host='localhost')
         mocked_log.bind.assert_called_with(db_count=mock.ANY, db_time=mock.ANY,
+                                           calculated_count=mock.ANY, calculated_time=mock.ANY,
+                                           embed_cache_hits=mock.ANY, embed_cache_misses=mock.ANY,
+                                           embed_cache_evictions=mock.ANY, embed_cache_bytes=mock.ANY,
                                            rss_begin=mock.ANY, rss_change=mock.ANY, rss_end=mock.ANY,
                                            wsgi_begin=mock.ANY, wsgi_end=mock.ANY, wsgi_time=mock.ANY,
                                            url_path='/', url_qs='', host='localhost')
@@ -38,6 +41,9 @@ def test_stats_tween_logs_telemetry_id(testapp, mocked):
                                                               url_qs='telemetry_id=test_telem',
                                                               host='localhost')
         mocked_log.bind.assert_called_with(db_count=mock.ANY, db_time=mock.ANY,
+                                           calculated_count=mock.ANY, calculated_time=mock.ANY,
+                                           embed_cache_hits=mock.ANY, embed_cache_misses=mock.ANY,
+                                           embed_cache_evictions=mock.ANY, embed_cache_bytes=mock.ANY,
                                            rss_begin=mock.ANY, rss_change=mock.ANY,
                                            rss_end=mock.ANY, wsgi_begin=mock.ANY,
                                            wsgi_end=mock.ANY, wsgi_time=mock.ANY,
@@ -10,7 +10,7 @@ import pytest
 from webob.multidict import MultiDict
 
 from snovault.search.lucene_builder import LuceneBuilder
-from snovault.search.search_utils import QueryConstructionException
+from snovault.search.search_utils import QueryConstructionException, build_principals_filter
 
 
 class DummyTypeInfo:
@@ -249,3 +249,15 @@ class TestHandleRangeFilters:
         LuceneBuilder.handle_range_filters(request, result, field_filters, ['Item'])
         assert field_filters == {}
         assert result['filters'] == []
+
+
+class TestGenerateFiltersForTermsAgg:
+
+    def test_principals_filter_is_kept(self):
+        principals_filter = build_principals_filter(['system.Everyone', 'userid.abc'])
+        status_filter = {'bool': {'should': [{'terms': {'embedded.status.raw': ['released']}},
+                                             {'bool': {'must_not': {'exists': {'field': 'embedded.status.raw'}}}}]}}
+        search_filters = {'bool': {'must': [principals_filter, status_filter], 'must_not': []}}
+        result = LuceneBuilder.generate_filters_for_terms_agg_from_search_filters(
+            'embedded.status.raw', search_filters, None)
+        assert result == {'bool': {'must': [principals_filter], 'must_not': []}}
@@ -3,13 +3,15 @@ Unit tests for snovault.cache.ManagerLRUCache -- the per-transaction LRU cache
 layered on pyramid's threadlocal stack (used for embed/collection caches on hot
 read paths). Locks the degraded no-op behavior outside a request, capacity
 resolution from registry settings, and the transaction-completion flush.
+Also covers the byte-bounded GreedyDualSizeCache behind the embed cache.
 No services required.
 """
 import pytest
+import random
 
 from pyramid.threadlocal import manager
 
-from ..cache import ManagerLRUCache
+from ..cache import GreedyDualSizeCache, ManagerGreedyDualCache, ManagerLRUCache, estimate_size
 
 
 pytestmark = [pytest.mark.unit]
@@ -69,3 +71,96 @@ class TestWithinRequest:
         cache['key'] = 'value'
         cache.afterCompletion(transaction=None)
         assert cache.get('key', 'flushed') == 'flushed'
+
+
+class TestGreedyDualSizeCache:
+
+    def test_estimate_size(self):
+        value = {'result': {'@id': '/things/abc/', 'count': 3}, 'linked': {('uuid', 'Thing')}}
+        assert estimate_size(value) == 82
+        assert estimate_size('x' * 1000) > estimate_size('x' * 100)
+
+    def test_bounded_by_bytes(self):
+        cache = GreedyDualSizeCache(max_bytes=100)
+        for key in range(5):
+            cache.put(key, 'x', size=30)
+        assert len(cache) == 3 and cache.size == 90
+        assert cache.evictions == 2
+        # too large to be cached at all
+        assert cache.put('huge', 'x', size=101) == 0
+        assert 'huge' not in cache and len(cache) == 3
+
+    def test_bounded_by_capacity(self):
+        cache = GreedyDualSizeCache(max_bytes=1000, capacity=2)
+        for key in range(3):
+            cache.put(key, 'x', size=1)
+        assert len(cache) == 2
+
+    def test_evicts_cheapest_per_byte(self):
+        cache = GreedyDualSizeCache(max_bytes=100)
+        cache.put('costly', 'x', cost=10, size=40)
+        cache.put('cheap', 'x', cost=1, size=40)
+        assert cache.put('new', 'x', cost=1, size=40) == 1
+        assert 'costly' in cache and 'cheap' not in cache
+
+    def test_unused_entries_age_out(self):
+        cache = GreedyDualSizeCache(max_bytes=100)
+        cache.put('costly', 'x', cost=3, size=50)
+        for key in range(20):
+            cache.put(key, 'x', cost=1, size=50)
+        assert 'costly' not in cache
+        # whereas one kept in use stays
+        cache.put('costly', 'x', cost=3, size=50)
+        for key in range(20):
+            cache.put(key, 'x', cost=1, size=50)
+            assert cache['costly'] == 'x'
+
+    def test_hits_misses_and_replacement(self):
+        cache = GreedyDualSizeCache(max_bytes=100)
+        cache.put('key', 'value', size=10)
+        cache.put('key', 'other', size=20)
+        assert cache.get('key') == 'other' and cache.size == 20
+        assert cache.get('missing') is None
+        del cache['key']
+        assert cache.size == 0
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_heap_stays_bounded(self):
+        cache = GreedyDualSizeCache(max_bytes=1000)
+        cache.put('key', 'x', size=1)
+        for _ in range(1000):
+            cache.get('key')
+        assert len(cache._heap) <= cache.HEAP_SLACK + 64
+
+    def test_manager_cache_settings(self, threadlocal_registry):
+        threadlocal_registry.settings.update({'t.gds.max_bytes': '500', 't.gds.capacity': '7'})
+        cache = ManagerGreedyDualCache('t.gds', default_max_bytes=100)
+        assert (cache.cache.max_bytes, cache.cache.capacity) == (500, 7)
+        assert cache.put('key', 'x' * 10, cost=1) == 0
+        assert cache.get('key') == 'x' * 10 and cache.size == 12
+        cache.afterCompletion(transaction=None)
+        assert cache.size == 0
+
+    def test_cost_aware_loses_less_than_lru(self):
+        """ Render time lost to misses over a skewed workload of cheap large and costly small
+            entries, evicting least recently used vs GreedyDual-Size, with the same bytes
+        """
+        rng = random.Random(0)
+        entries = {key: (rng.choice([2000, 4000]), 0.001) for key in range(200)}
+        entries.update({key: (rng.choice([100, 200]), 0.01) for key in range(200, 400)})
+        keys = list(entries)
+        trace = [keys[min(int(rng.expovariate(1 / 80)), len(keys) - 1)] for _ in range(20000)]
+        rng.shuffle(keys)
+
+        def lost(cache, lru):
+            total = 0
+            for key in trace:
+                if cache.get(key) is None:
+                    size, cost = entries[key]
+                    total += cost
+                    cache.put(key, key, cost=0 if lru else cost, size=size)
+            return total
+
+        lru = lost(GreedyDualSizeCache(max_bytes=100000), lru=True)
+        gds = lost(GreedyDualSizeCache(max_bytes=100000), lru=False)
+        assert gds < lru
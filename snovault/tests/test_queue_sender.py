@@ -0,0 +1,181 @@
+import json
+import os
+import pytest
+import threading
+
+from unittest import mock
+
+from ..elasticsearch.interfaces import INDEXER_QUEUE, INDEXER_QUEUE_MIRROR, INDEXER_QUEUE_SENDER
+from ..elasticsearch.queue_sender import BackgroundQueueSender
+from ..invalidation import add_batch_to_indexing_queue
+
+
+pytestmark = [pytest.mark.working]
+
+
+class FakeQueue(object):
+    """ Records the messages sent by send_messages; raises the first `fail_times` calls, reports the
+        messages with a uuid in `failing` as failed as often as it says, and those in `malformed` always
+    """
+
+    def __init__(self, fail_times=0, failing=None, malformed=()):
+        self.batches = []
+        self.fail_times = fail_times
+        self.failing = dict(failing or {})
+        self.malformed = set(malformed)
+        self.lock = threading.Lock()
+
+    def send_messages(self, items, target_queue='primary', max_retries=4):
+        with self.lock:
+            if self.fail_times:
+                self.fail_times -= 1
+                raise Exception('SQS unavailable')
+            failed, sent = [], []
+            for index, item in enumerate(items):
+                if item['uuid'] in self.malformed:
+                    failed.append({'Id': str(index), 'SenderFault': True, 'Code': 'InvalidMessageContents'})
+                elif self.failing.get(item['uuid']):
+                    self.failing[item['uuid']] -= 1
+                    failed.append({'Id': str(index), 'SenderFault': False, 'Code': 'InternalError'})
+                else:
+                    sent.append(item)
+            self.batches.append(sent)
+        return failed
+
+    @property
+    def sent(self):
+        return [item for batch in self.batches for item in batch]
+
+
+def make_items(n, start=0):
+    return [{'uuid': str(i), 'sid': i} for i in range(start, start + n)]
+
+
+@pytest.fixture
+def make_sender():
+    senders = []
+
+    def make(*args, **kwargs):
+        sender = BackgroundQueueSender(*args, **kwargs)
+        senders.append(sender)
+        return sender
+
+    yield make
+    for sender in senders:
+        sender.stop(timeout=1)
+
+
+def test_sender_batches_messages(make_sender):
+    primary, mirror = FakeQueue(), FakeQueue()
+    sender = make_sender([primary, mirror, None], flush_interval=0.05)
+    sender.enqueue(make_items(23))
+    assert sender.flush(timeout=5)
+    assert primary.sent == mirror.sent == make_items(23)
+    assert all(len(batch) <= 10 for batch in primary.batches)
+    assert len(primary.batches) == 3
+    assert sender.pending() == 0
+
+
+def test_sender_retries_failed_batches(make_sender):
+    primary = FakeQueue(fail_times=2)
+    sender = make_sender([primary], retry_interval=0.01)
+    sender.enqueue(make_items(3))
+    assert sender.flush(timeout=5)
+    assert primary.sent == make_items(3)
+
+
+def test_sender_retries_messages_reported_failed(tmpdir, make_sender):
+    primary = FakeQueue(failing={'1': 1000})
+    sender = make_sender([primary], spool_dir=str(tmpdir), retry_interval=0.01, max_retry_interval=0.01,
+                         max_attempts=1000)
+    sender.enqueue(make_items(3))
+    assert not sender.flush(timeout=0.2)
+    # only the failed message is retried, and it stays spooled until sent
+    assert primary.batches[0] == [make_items(3)[0], make_items(3)[2]]
+    assert sender.pending() == 1
+    with open(sender.spool_path) as spool:
+        assert make_items(1, start=1)[0] in [json.loads(line) for line in spool]
+    primary.failing.clear()
+    assert sender.flush(timeout=5)
+    assert primary.sent == [make_items(3)[0], make_items(3)[2], make_items(3)[1]]
+    with open(sender.spool_path) as spool:
+        assert spool.read() == ''
+
+
+def test_sender_dead_letters_permanent_failures(tmpdir, make_sender):
+    """ A message that can never be sent does not hold up the ones queued behind it """
+    primary = FakeQueue(malformed={'1'}, failing={'2': 1000})
+    sender = make_sender([primary], spool_dir=str(tmpdir), retry_interval=0.01, max_attempts=3)
+    sender.enqueue(make_items(25))
+    assert sender.flush(timeout=5)
+    assert primary.sent == [item for item in make_items(25) if item['uuid'] not in ('1', '2')]
+    assert primary.failing['2'] == 1000 - 3
+    with open(sender.dead_letter_path) as dead_letters:
+        dead = [json.loads(line) for line in dead_letters]
+    assert [(entry['message'], entry['attempts'], entry['failure']['Code']) for entry in dead] == [
+        (make_items(1, start=1)[0], 1, 'InvalidMessageContents'),
+        (make_items(1, start=2)[0], 3, 'InternalError'),
+    ]
+    with open(sender.spool_path) as spool:
+        assert spool.read() == ''
+
+
+def test_sender_stop_drains(make_sender):
+    primary = FakeQueue()
+    sender = make_sender([primary], flush_interval=10)
+    sender.enqueue(make_items(4))
+    sender.stop(timeout=5)
+    assert primary.sent == make_items(4)
+
+
+def test_sender_spool(tmpdir, make_sender):
+    """ Messages are spooled until sent, and spools no running process holds are re-sent by the next sender """
+    spool_dir = str(tmpdir)
+    live = make_sender([FakeQueue(fail_times=1000)], spool_dir=spool_dir, retry_interval=10)
+    live.enqueue(make_items(2))
+    with open(live.spool_path) as spool:
+        assert [json.loads(line) for line in spool] == make_items(2)
+
+    # a spool left behind by a crashed process, whose pid is in use again
+    crashed = os.path.join(spool_dir, 'spool-%s-0123.ndjson' % os.getpid())
+    with open(crashed, 'w') as spool:
+        spool.write(''.join(json.dumps(item) + '\n' for item in make_items(3, start=10)))
+    recovered, other = FakeQueue(), FakeQueue()
+    new_sender = make_sender([recovered], spool_dir=spool_dir)
+    assert os.path.exists(crashed)  # taken over once the sender is used, so not by a process about to fork
+    new_sender.enqueue(make_items(1, start=20))
+    # a second sender starting meanwhile must not also take it over
+    other_sender = make_sender([other], spool_dir=spool_dir)
+    other_sender.enqueue(make_items(1, start=30))
+    assert new_sender.flush(timeout=5) and other_sender.flush(timeout=5)
+    assert recovered.sent == make_items(3, start=10) + make_items(1, start=20)
+    assert other.sent == make_items(1, start=30)
+    assert not os.path.exists(crashed) and os.path.exists(live.spool_path)
+    with open(new_sender.spool_path) as spool:
+        assert spool.read() == ''
+
+
+def test_sender_compacts_spool(tmpdir, make_sender):
+    """ The spool does not keep growing while some message stays unsent """
+    primary = FakeQueue(failing={'0': 1000})
+    sender = make_sender([primary], spool_dir=str(tmpdir), retry_interval=10, max_attempts=1000)
+    sender.enqueue(make_items(1))
+    for start in range(1, 101, 5):
+        sender.enqueue(make_items(5, start=start))
+    assert not sender.flush(timeout=0.5)
+    assert sender.pending() == 1
+    assert primary.sent == make_items(100, start=1)
+    with open(sender.spool_path) as spool:
+        spooled = [json.loads(line) for line in spool]
+    assert make_items(1)[0] in spooled and len(spooled) <= 2 + sender.batch_size
+    assert os.listdir(str(tmpdir)) == [os.path.basename(sender.spool_path)]
+
+
+def test_add_to_indexing_queue_uses_sender(dummy_request):
+    primary, sender = mock.Mock(), mock.Mock()
+    with mock.patch.dict(dummy_request.registry,
+                         {INDEXER_QUEUE: primary, INDEXER_QUEUE_MIRROR: None, INDEXER_QUEUE_SENDER: sender}):
+        add_batch_to_indexing_queue(True, dummy_request, [({'uuid': 'a', 'sid': 1}, 'add')])
+    primary.send_messages.assert_not_called()
+    [items], _ = sender.enqueue.call_args
+    assert [(item['uuid'], item['method']) for item in items] == [('a', 'POST')]
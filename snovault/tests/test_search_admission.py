@@ -0,0 +1,119 @@
+"""
+Tests for the admission control of heavy search requests (snovault/search/admission.py).
+"""
+
+import json
+import pytest
+import threading
+
+from pyramid.request import Request
+from pyramid.response import Response
+from types import SimpleNamespace
+
+from ..interfaces import SEARCH_ADMISSION
+from ..search.admission import SearchAdmission, admission_tween_factory
+
+
+pytestmark = [pytest.mark.working]
+
+
+class AdmissionRequest(Request):
+    unauthenticated_userid = None  # as set by the authentication policy
+    authenticated_userid = None
+
+
+def make_request(path, user='TEST', body=None, claimed_user=None):
+    request = AdmissionRequest.blank(path, method='POST' if body else 'GET', remote_addr='10.0.0.1')
+    if body is not None:
+        request.content_type = 'application/json'
+        request.body = json.dumps(body).encode('utf-8')
+    request.unauthenticated_userid = claimed_user or user
+    request.authenticated_userid = user
+    request._stats = {}
+    return request
+
+
+@pytest.mark.parametrize('path, body, cost', [
+    ('/profiles/', None, 0),
+    ('/search/?type=TestingSearchSchema', None, 1),
+    ('/search/?type=TestingSearchSchema&limit=250', None, 3),
+    ('/search/?type=TestingSearchSchema&type=TestingLinkTargetSno&additional_facet=status', None, 3),
+    ('/search/?type=Item', None, 4),
+    ('/search/?type=TestingSearchSchema&limit=all', None, 11),
+    ('/testing-search-schemas/?limit=all', None, 14),
+    ('/search/@@export?type=TestingSearchSchema', None, 11),
+    ('/compound_search', {'search_type': 'Item', 'limit': 'all'}, 16),
+])
+def test_estimate_cost(path, body, cost):
+    assert SearchAdmission.estimate_cost(make_request(path, body=body)) == cost
+
+
+def test_principal_for():
+    assert SearchAdmission.principal_for(make_request('/search/')) == 'TEST'
+    assert SearchAdmission.principal_for(make_request('/search/', user=None)) == 'anonymous:10.0.0.1'
+    # a userid that does not authenticate does not count as that user
+    assert SearchAdmission.principal_for(make_request('/search/', user=None, claimed_user='TEST')) == 'anonymous:10.0.0.1'
+
+
+def test_admission_caps():
+    admission = SearchAdmission(max_heavy=2, max_heavy_per_principal=1, queue_timeout=0.05)
+    assert admission.acquire('a')
+    assert not admission.acquire('a')  # per principal
+    assert admission.acquire('b')
+    assert not admission.acquire('c')  # per process
+    admission.release('a')
+    assert admission.acquire('c')
+    stats = admission.stats()
+    assert (stats['admitted'], stats['queued'], stats['rejected'], stats['active']) == (3, 2, 2, 2)
+
+
+def test_admission_queues():
+    admission = SearchAdmission(max_heavy=1, queue_timeout=5)
+    assert admission.acquire('a')
+    threading.Timer(0.05, admission.release, ['a']).start()
+    assert admission.acquire('b')
+    assert admission.stats()['admitted_after_queueing'] == 1
+
+
+def make_tween(admission, app_iter_factory=lambda: [b'{}']):
+    handled = []
+
+    def handler(request):
+        handled.append(request)
+        return Response(app_iter=app_iter_factory())
+
+    registry = {SEARCH_ADMISSION: admission}
+    return admission_tween_factory(handler, SimpleNamespace(get=registry.get)), handled
+
+
+def test_admission_tween():
+    admission = SearchAdmission(max_heavy=1, queue_timeout=0.01, retry_after=7)
+    tween, handled = make_tween(admission, lambda: (chunk for chunk in [b'{"@graph": ', b'[]}']))
+    # streamed: the slot is held until the body has been sent
+    response = tween(make_request('/search/?type=Item&limit=all'))
+    assert admission.stats()['active'] == 1
+    rejected = tween(make_request('/search/?type=Item&limit=all', user='other'))
+    assert rejected.status_code == 429 and rejected.headers['Retry-After'] == '7'
+    # light requests are not held up
+    assert tween(make_request('/search/?type=TestingSearchSchema')).status_code == 200
+    assert b''.join(response.app_iter) == b'{"@graph": []}'
+    response.app_iter.close()
+    assert admission.stats()['active'] == 0
+    assert len(handled) == 2
+
+
+def test_admission_tween_releases_on_errors():
+    admission = SearchAdmission(max_heavy=1)
+
+    def fail():
+        raise ValueError('oops')
+
+    tween, _ = make_tween(admission, fail)
+    with pytest.raises(ValueError):
+        tween(make_request('/search/?type=Item&limit=all'))
+    assert admission.stats()['active'] == 0
+
+
+def test_admission_tween_disabled():
+    tween, _ = make_tween(None)
+    assert tween.__name__ == 'handler'
@@ -0,0 +1,133 @@
+import json
+import pytest
+
+from collections import OrderedDict
+from elasticsearch import TransportError
+from pyramid.testing import DummyRequest
+from webob.multidict import MultiDict
+
+from ..search.search import SearchBuilder
+from ..search.search_utils import SEARCH_AFTER_TIEBREAKER, add_search_after_tiebreaker, execute_search_after
+
+
+pytestmark = [pytest.mark.working]
+
+
+class FakeES(object):
+    """ Serves `total` hits with a single sort value, honoring search_after and points in time """
+
+    def __init__(self, total, supports_pit=True):
+        self.total = total
+        self.supports_pit = supports_pit
+        self.searches = []
+        self.open_pits = set()
+
+    def open_point_in_time(self, index, keep_alive):
+        if not self.supports_pit:
+            raise TransportError(400, 'no such api')
+        pit_id = 'pit-%s' % len(self.searches)
+        self.open_pits.add(pit_id)
+        return {'id': pit_id}
+
+    def close_point_in_time(self, body):
+        self.open_pits.remove(body['id'])
+
+    def search(self, index, body, from_, size, timeout, preference):
+        self.searches.append({'index': index, 'body': dict(body), 'from_': from_, 'preference': preference})
+        start = body['search_after'][0] + 1 if 'search_after' in body else 0
+        hits = [{'_source': {'embedded': {'n': i}}, 'sort': [i]} for i in range(start, min(start + size, self.total))]
+        result = {'hits': {'hits': hits, 'total': {'value': self.total}}}
+        if 'pit' in body:
+            # ES may hand out a new id with every page
+            result['pit_id'] = body['pit']['id']
+        return result
+
+
+@pytest.mark.parametrize('sort, expected', [
+    (None, ['_score', SEARCH_AFTER_TIEBREAKER]),
+    (OrderedDict([('embedded.date_created.raw', {'order': 'desc'}), ('embedded.label.raw', {'order': 'asc'})]),
+     [{'embedded.date_created.raw': {'order': 'desc'}}, {'embedded.label.raw': {'order': 'asc'}},
+      SEARCH_AFTER_TIEBREAKER]),
+    ([{'_score': {'order': 'desc'}}, {'_id': {'order': 'asc'}}], [{'_score': {'order': 'desc'}},
+                                                                  {'_id': {'order': 'asc'}}]),
+    ([{'embedded.uuid.raw': {'order': 'desc'}}], [{'embedded.uuid.raw': {'order': 'desc'}}]),
+])
+def test_add_search_after_tiebreaker(sort, expected):
+    assert add_search_after_tiebreaker(sort) == expected
+
+
+@pytest.mark.parametrize('supports_pit', [True, False])
+def test_execute_search_after(supports_pit):
+    es = FakeES(total=25, supports_pit=supports_pit)
+    query = {'query': {'match_all': {}}, 'aggs': {'type': {}}, 'sort': {'embedded.n': {'order': 'asc'}}}
+    pages = list(execute_search_after(es=es, query=query, index='sno_item', size=10, session_id='SESSION'))
+    assert [len(page['hits']['hits']) for page in pages] == [10, 10, 5]
+    assert [hit['sort'][0] for page in pages for hit in page['hits']['hits']] == list(range(25))
+    first, *subsequent = es.searches
+    assert 'aggs' in first['body'] and 'search_after' not in first['body']
+    assert all('aggs' not in search['body'] and search['body']['track_total_hits'] is False
+               for search in subsequent)
+    assert [search['body'].get('search_after') for search in es.searches] == [None, [9], [19]]
+    assert all(search['from_'] == 0 for search in es.searches)
+    if supports_pit:
+        assert all(search['index'] is None and search['body']['pit']['id'] == 'pit-0' for search in es.searches)
+    else:
+        assert all(search['index'] == 'sno_item' and search['preference'] == 'SESSION' for search in es.searches)
+    assert not es.open_pits
+    # the caller's query is not modified
+    assert query == {'query': {'match_all': {}}, 'aggs': {'type': {}}, 'sort': {'embedded.n': {'order': 'asc'}}}
+
+
+def test_execute_search_after_closes_pit_when_abandoned():
+    es = FakeES(total=100)
+    pages = execute_search_after(es=es, query={'query': {}}, index='sno_item', size=10)
+    next(pages)
+    assert es.open_pits
+    pages.close()
+    assert not es.open_pits
+
+
+def make_streaming_builder(es, context):
+    builder = object.__new__(SearchBuilder)
+    builder.es = es
+    builder.es_index = 'sno_item'
+    builder.search_session_id = None
+    builder.query = {'query': {}}
+    builder.context = context
+    builder.request = DummyRequest(context=context)
+    builder.request.__parent__ = None
+    builder.request.normalized_params = MultiDict()
+    builder.size = 'all'
+    builder.return_generator = False
+    builder.search_frame = 'embedded'
+    return builder
+
+
+def test_stream_response(monkeypatch):
+    monkeypatch.setattr(SearchBuilder, 'STREAM_CHUNK_SIZE', 100)
+    builder = make_streaming_builder(FakeES(total=42), context=object())
+    assert builder.streams_graph()
+    es_results = builder.execute_search_for_all_results(size_increment=10)
+    graph = builder._format_results(es_results['hits']['hits'])
+    response = builder.stream_response({'total': 42, '@graph': graph, 'facets': []})
+    chunks = list(response.app_iter)
+    assert len(chunks) > 1
+    assert response.content_type == 'application/json'
+    assert json.loads(b''.join(chunks)) == {'total': 42, 'facets': [], '@graph': [{'n': i} for i in range(42)]}
+
+
+def test_streams_graph_only_for_the_requested_search():
+    context = object()
+    builder = make_streaming_builder(FakeES(total=1), context=context)
+    assert builder.streams_graph()
+    builder.return_generator = True
+    assert not builder.streams_graph()
+    builder = make_streaming_builder(FakeES(total=1), context=context)
+    builder.request.__parent__ = DummyRequest()
+    assert not builder.streams_graph()
+    builder = make_streaming_builder(FakeES(total=1), context=context)
+    builder.context = object()  # search called from another view
+    assert not builder.streams_graph()
+    builder = make_streaming_builder(FakeES(total=1), context=context)
+    builder.size = 10
+    assert not builder.streams_graph()
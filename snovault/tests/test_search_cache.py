@@ -0,0 +1,207 @@
+import pytest
+
+from pyramid.registry import Registry
+from pyramid.testing import DummyRequest
+from types import SimpleNamespace
+from unittest import mock
+from webob.multidict import MultiDict
+
+from ..elasticsearch.index_generations import IndexGenerations, bump_index_generation
+from ..elasticsearch.interfaces import INDEX_GENERATIONS
+from ..interfaces import FACET_AGGREGATION_CACHE, SEARCH_RESPONSE_CACHE
+from ..redis.interfaces import REDIS
+from ..search.search import SearchBuilder
+from ..search import search_cache
+from ..search.search_cache import FacetAggregationCache, SearchResponseCache
+
+
+pytestmark = [pytest.mark.working]
+
+
+class FakeRedis(object):
+    """ Just the parts of the Redis client used by the cache and generations """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode('utf-8') if isinstance(value, str) else str(value).encode('utf-8')
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode('utf-8')
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def execute(self):
+        pass
+
+
+def make_registry(redis=None, **settings):
+    registry = Registry()
+    registry.settings = dict(settings)
+    registry[REDIS] = SimpleNamespace(redis=redis) if redis is not None else None
+    registry[INDEX_GENERATIONS] = IndexGenerations(registry)
+    return registry
+
+
+def make_builder(es_index='sno_target', principals=('system.Everyone',), limit='10', parent=None, **params):
+    request = SimpleNamespace(method='GET', __parent__=parent, effective_principals=list(principals),
+                              normalized_params=MultiDict(limit=limit, **params), environ={},
+                              registry=SimpleNamespace(settings={}))
+    return SimpleNamespace(request=request, return_generator=False, debug_is_active=[], forced_type='Search',
+                           doc_types=['TestingLinkTargetSno'], search_base='?type=TestingLinkTargetSno',
+                           custom_aggregations=None, es_index=es_index, size=int(limit) if limit.isdigit() else limit,
+                           query={'query': {'bool': {'filter': list(principals)}}, 'aggs': {'all_items': {}}})
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_index_generations(shared):
+    registry = make_registry(redis=FakeRedis() if shared else None)
+    generations = registry[INDEX_GENERATIONS]
+    assert generations.get('sno_target') == ((0,), 0)
+    with mock.patch('time.time', return_value=100.0):
+        bump_index_generation(registry, 'sno_target')
+    assert generations.get('sno_target') == ((1,), 100.0)
+    assert generations.get('sno_source,sno_target') == ((0, 1), 100.0)
+    # a search on all indices is covered by the '*' generation, bumped with every index
+    bump_index_generation(registry, 'sno_source')
+    assert generations.get('sno*')[0] == (2,)
+
+
+@pytest.mark.parametrize('settings, enabled', [
+    ({}, False),
+    ({'redis.server': 'redis://localhost:6379'}, True),
+    ({'search.response_cache.single_process': 'true', 'search.facet_cache.single_process': 'true'}, True),
+])
+def test_search_caches_need_shared_generations(settings, enabled):
+    # without Redis, index generations bumped by other processes would never be seen
+    config = mock.Mock(registry=make_registry(**{'search.response_cache': 'true', 'search.facet_cache': 'true'},
+                                              **settings))
+    search_cache.includeme(config)
+    assert isinstance(config.registry[SEARCH_RESPONSE_CACHE], SearchResponseCache) is enabled
+    assert isinstance(config.registry[FACET_AGGREGATION_CACHE], FacetAggregationCache) is enabled
+
+
+def test_search_cache_key():
+    registry = make_registry()
+    cache = SearchResponseCache(registry, refresh_window=0)
+    key, storable = cache.key_for(make_builder())
+    assert storable
+    assert key == cache.key_for(make_builder())[0]
+    assert key != cache.key_for(make_builder(principals=['system.Everyone', 'group.admin']))[0]
+    bump_index_generation(registry, 'sno_target')
+    assert key != cache.key_for(make_builder())[0]
+    # not cached at all
+    assert cache.key_for(make_builder(limit='all')) == (None, False)
+    assert cache.key_for(make_builder(parent=DummyRequest())) == (None, False)
+
+
+def test_search_cache_refresh_window():
+    """ Responses are not stored right after a write, which ES may not have made searchable yet """
+    registry = make_registry()
+    cache = SearchResponseCache(registry, refresh_window=60)
+    assert cache.key_for(make_builder())[1]
+    bump_index_generation(registry, 'sno_target')
+    assert not cache.key_for(make_builder())[1]
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_search_cache_get_set(shared):
+    redis = FakeRedis()
+    registry = make_registry(redis=redis if shared else None, **{'redis.server': 'redis://fake'})
+    cache = SearchResponseCache(registry, capacity=2, shared=shared)
+    request = DummyRequest()
+    assert cache.get(request, 'a') is None
+    cache.set('a', {'@graph': [], 'total': 0}, 404)
+    assert cache.get(request, 'a') == {'@graph': [], 'total': 0}
+    assert request.response.status_code == 404
+    cache.set('b', {'total': 1}, 200)
+    cache.set('c', {'total': 2}, 200)
+    cache.clear()
+    # only the shared tier still has 'a'
+    assert (cache.get(request, 'a') is not None) == shared
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == (1 if shared else 2)
+    assert stats['shared_hits'] == (1 if shared else 0)
+    assert stats['stores'] == 3
+    assert stats['shared'] == shared
+
+
+def test_search_cache_lru_and_size():
+    cache = SearchResponseCache(make_registry(), capacity=2, max_entry_bytes=100)
+    request = DummyRequest()
+    for key in 'abc':
+        cache.set(key, {'key': key}, 200)
+    assert cache.get(request, 'a') is None
+    assert cache.get(request, 'c') == {'key': 'c'}
+    cache.set('d', {'key': 'x' * 200}, 200)
+    assert cache.get(request, 'd') is None
+    assert cache.stats()['too_large'] == 1
+
+
+def test_facet_cache_key():
+    registry = make_registry()
+    cache = FacetAggregationCache(registry, refresh_window=0)
+    key, storable = cache.key_for(make_builder(type='TestingLinkTargetSno', sort='-date_created'))
+    assert key is not None and storable
+    # pages and sort orders of a landing page share its aggregations, other principals do not
+    assert key == cache.key_for(make_builder(type='TestingLinkTargetSno', limit='25'))[0]
+    assert key != cache.key_for(make_builder(type='TestingLinkTargetSno', principals=['group.admin']))[0]
+    bump_index_generation(registry, 'sno_target')
+    assert key != cache.key_for(make_builder(type='TestingLinkTargetSno'))[0]
+    # filtered searches are only cached when they are for facets only
+    assert cache.key_for(make_builder(type='TestingLinkTargetSno', status='current'))[0] is None
+    assert cache.key_for(make_builder(limit='0', type='TestingLinkTargetSno', status='current'))[0] is not None
+    builder = make_builder()
+    del builder.query['aggs']
+    assert cache.key_for(builder)[0] is None
+
+
+def test_facet_cache_get_set():
+    cache = FacetAggregationCache(make_registry(), capacity=1)
+    assert cache.get('a') is None
+    cache.set('a', {'all_items': {'doc_count': 1}})
+    aggregations = cache.get('a')
+    aggregations['all_items']['doc_count'] = 2
+    assert cache.get('a') == {'all_items': {'doc_count': 1}}  # a copy was handed out
+    cache.set('b', {}, storable=False)
+    assert cache.get('b') is None
+    cache.set('c', {})
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['stores'], stats['too_fresh']) == (2, 3, 2, 1)
+    assert stats['entries'] == 1
+
+
+def test_search_with_cached_aggregations():
+    """ The aggregations of a landing page are computed once, hits are fetched every time """
+    registry = make_registry()
+    registry[FACET_AGGREGATION_CACHE] = FacetAggregationCache(registry, refresh_window=0)
+    calls = []
+
+    def search(**kwargs):
+        calls.append(kwargs['body'])
+        results = {'hits': {'hits': [{'_id': str(len(calls))}], 'total': {'value': 1}}}
+        if 'aggs' in kwargs['body']:
+            results['aggregations'] = {'all_items': {'doc_count': 1}}
+        return results
+
+    def execute():
+        builder = make_builder(type='TestingLinkTargetSno')
+        builder.request.registry = registry
+        builder.es = SimpleNamespace(search=search)
+        builder.from_, builder.search_session_id = 0, None
+        return SearchBuilder.execute_search_with_cached_aggregations(builder)
+
+    first, second = execute(), execute()
+    assert 'aggs' in calls[0] and 'aggs' not in calls[1]
+    assert first['aggregations'] == second['aggregations'] == {'all_items': {'doc_count': 1}}
+    assert second['hits']['hits'] == [{'_id': '2'}]
@@ -26,7 +26,6 @@ constructed query dict, without invoking `execute_filter_set` end-to-end.
 """
 
 from snovault.search.search import SearchBuilder
-import snovault.search.search as search_module
 import snovault.search.search_utils as search_utils_module
 import snovault.search.compound_search as compound_search_module
 
@@ -170,6 +169,26 @@ class TestCompoundSearchSourceRestriction:
         )
 
 
+class FakePagingES:
+    """ Serves `total` hits sorted by a single key, honoring search_after """
+
+    def __init__(self, total):
+        self.total = total
+        self.bodies = []
+
+    def open_point_in_time(self, index, keep_alive):
+        return {'id': 'pit'}
+
+    def close_point_in_time(self, body):
+        pass
+
+    def search(self, index, body, from_, size, timeout, preference):
+        self.bodies.append(dict(body))
+        start = body['search_after'][0] + 1 if 'search_after' in body else 0
+        hits = [{'_source': {}, 'sort': [i]} for i in range(start, min(start + size, self.total))]
+        return {'hits': {'hits': hits, 'total': {'value': self.total}}, 'pit_id': 'pit'}
+
+
 class TestGetAllSubsequentResultsDropsAggs:
     """ Fix #4: `limit=all` pagination re-sent the full default-facet
         aggregation block (and total-hit tracking) on every page, even though
@@ -180,59 +199,51 @@ class TestGetAllSubsequentResultsDropsAggs:
         rest of the query body (used for the actual hit search) must be
         unaffected. """
 
-    def test_subsequent_pages_drop_aggs_and_total_hit_tracking(self, monkeypatch):
-        captured_queries = []
-
-        def fake_execute_search(es, query, index, from_, size, session_id=None):
-            captured_queries.append(query)
-            return {'hits': {'hits': []}}
-
-        monkeypatch.setattr(search_module, 'execute_search', fake_execute_search)
-
+    @staticmethod
+    def make_builder(es, query):
         builder = object.__new__(SearchBuilder)
-        builder.es = None
+        builder.request = None
+        builder.es = es
         builder.es_index = 'test-index'
         builder.search_session_id = None
-        builder.query = {
+        builder.query = query
+        return builder
+
+    def test_subsequent_pages_drop_aggs_and_total_hit_tracking(self):
+        es = FakePagingES(total=350)
+        builder = self.make_builder(es, {
             'query': {'bool': {'must': ['sentinel']}},
             'sort': ['sentinel-sort'],
             'aggs': {'all_items': {'global': {}, 'aggs': {'type': {}}}},
-        }
+        })
 
-        list(builder.get_all_subsequent_results(extra_requests_needed_count=3, size_increment=100))
+        es_result = builder.execute_search_for_all_results(size_increment=100)
+        assert len(list(es_result['hits']['hits'])) == 350
 
-        assert len(captured_queries) == 3
-        for query in captured_queries:
+        first, *subsequent = es.bodies
+        assert len(subsequent) == 3
+        assert 'aggs' in first
+        for query in subsequent:
             assert 'aggs' not in query
             assert query['track_total_hits'] is False
             # the rest of the query body (what actually finds/sorts hits) is untouched
             assert query['query'] == {'bool': {'must': ['sentinel']}}
-            assert query['sort'] == ['sentinel-sort']
+            assert query['sort'][0] == 'sentinel-sort'
 
         # the original query object (used for the first page) must not be mutated
         assert 'aggs' in builder.query
+        assert builder.query['sort'] == ['sentinel-sort']
 
-    def test_first_page_query_still_keeps_aggs(self, monkeypatch):
-        # execute_search_for_all_results issues the first page directly with self.query,
+    def test_first_page_query_still_keeps_aggs(self):
+        # execute_search_for_all_results issues the first page with self.query,
         # which format_facets reads aggregations from - only subsequent pages should drop aggs.
-        first_page_queries = []
-
-        def fake_execute_search(es, query, index, from_, size, session_id=None):
-            first_page_queries.append(query)
-            return {'hits': {'hits': [], 'total': {'value': 0}}}
-
-        monkeypatch.setattr(search_module, 'execute_search', fake_execute_search)
-
-        builder = object.__new__(SearchBuilder)
-        builder.es = None
-        builder.es_index = 'test-index'
-        builder.search_session_id = None
-        builder.query = {'query': {'bool': {}}, 'aggs': {'all_items': {}}}
+        es = FakePagingES(total=0)
+        builder = self.make_builder(es, {'query': {'bool': {}}, 'aggs': {'all_items': {}}})
 
         builder.execute_search_for_all_results()
 
-        assert len(first_page_queries) == 1
-        assert 'aggs' in first_page_queries[0]
+        assert len(es.bodies) == 1
+        assert 'aggs' in es.bodies[0]
 
 
 class TestSkipDefaultFacetsExcludedFromFieldFilters:
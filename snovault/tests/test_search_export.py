@@ -0,0 +1,97 @@
+"""
+Tests for the streaming search export (snovault/search/export.py). The search routes are only
+registered with ES, so SearchExport is exercised directly on a request, with a fake ES client.
+"""
+
+import csv
+import io
+import json
+import pytest
+
+from pyramid.request import apply_request_extensions
+from unittest import mock
+
+from ..elasticsearch.interfaces import ELASTIC_SEARCH
+from ..search.export import SearchExport
+from ..search.search import SearchBuilder
+
+
+pytestmark = [pytest.mark.working]
+
+
+class FakeES(object):
+    """ Serves `total` embedded frames, honoring search_after, without point in time support """
+
+    def __init__(self, total):
+        self.total = total
+        self.bodies = []
+
+    def open_point_in_time(self, index, keep_alive):
+        raise Exception('not supported')
+
+    def search(self, index, body, from_, size, timeout, preference):
+        self.bodies.append(body)
+        start = body['search_after'][0] + 1 if 'search_after' in body else 0
+        hits = [{'_source': {'embedded': {'@id': '/sample/%s/' % i, 'identifier': 'sample-%s' % i,
+                                          'technical_reviews': [{'assessment': 'pass'}, {'assessment': 'fail'}],
+                                          'quality': i}},
+                 'sort': [i]}
+                for i in range(start, min(start + size, self.total))]
+        return {'hits': {'hits': hits, 'total': {'value': self.total}}}
+
+
+@pytest.fixture
+def make_export(root, registry, app):
+    def make_export(query_string, total=3, page_size=2):
+        request = app.request_factory.blank('/search/?' + query_string, environ={'REMOTE_USER': 'TEST'})
+        request.root = root
+        request.registry = registry
+        request._stats = {}
+        apply_request_extensions(request)
+        es = FakeES(total)
+        with mock.patch.dict(registry, {ELASTIC_SEARCH: es}):
+            with mock.patch.object(SearchBuilder, '_get_es_mapping_if_necessary', return_value={}):
+                with mock.patch.object(SearchExport, 'PAGE_SIZE', page_size):
+                    export = SearchExport(None, request, request.params.get('format', 'ndjson'))
+                    response = export.response()
+                    body = b''.join(response.app_iter).decode('utf-8')
+        return es, response, body
+    return make_export
+
+
+def test_export_ndjson(make_export):
+    es, response, body = make_export('type=TestingBiosampleSno&status=current&field=identifier&format=ndjson',
+                                     total=5)
+    assert response.content_type == 'application/x-ndjson'
+    rows = [json.loads(line) for line in body.splitlines()]
+    assert [row['identifier'] for row in rows] == ['sample-%s' % i for i in range(5)]
+    # filters and permissions of the search apply, without facets, aggregations or totals
+    assert len(es.bodies) == 3
+    query = json.dumps(es.bodies[0]['query'])
+    assert 'principals_allowed.view' in query and 'embedded.status' in query
+    assert 'aggs' not in es.bodies[0]
+    assert sorted(es.bodies[0]['_source']) == ['embedded.@id', 'embedded.@type', 'embedded.identifier']
+
+
+def test_export_tsv(make_export):
+    _, response, body = make_export('type=TestingBiosampleSno&format=tsv&field=identifier'
+                                    '&field=technical_reviews.assessment&field=quality')
+    assert response.content_type == 'text/tab-separated-values'
+    assert 'attachment' in response.content_disposition
+    rows = list(csv.reader(io.StringIO(body), delimiter='\t'))
+    assert rows == [['identifier', 'technical_reviews.assessment', 'quality']] + [
+        ['sample-%s' % i, 'pass, fail', str(i)] for i in range(3)
+    ]
+
+
+def test_export_tsv_default_columns(make_export):
+    es, _, body = make_export('type=TestingBiosampleSno&format=tsv', total=1)
+    header = body.splitlines()[0].split('\t')
+    assert header[:2] == ['@id', 'display_title']
+    assert es.bodies[0]['_source'] == ['embedded.' + field for field in header]
+
+
+def test_export_unsupported_format(make_export):
+    with pytest.raises(Exception) as exc:
+        make_export('type=TestingBiosampleSno&format=xml')
+    assert 'Unsupported export format' in str(exc.value)
@@ -0,0 +1,159 @@
+"""
+Tests for asynchronous search jobs (snovault/search/search_jobs.py). The search routes are only
+registered with ES, so jobs invoke a fake app instead of the search views.
+"""
+
+import json
+import os
+import pytest
+import threading
+
+from pyramid.httpexceptions import (
+    HTTPBadRequest, HTTPForbidden, HTTPNotFound, HTTPServiceUnavailable, HTTPTooManyRequests,
+)
+from pyramid.request import apply_request_extensions
+from pyramid.response import Response
+from pyramid.url import URLMethodsMixin
+from unittest import mock
+
+from ..interfaces import SEARCH_JOBS
+from ..search.search_jobs import SearchJobs, search_job, search_job_results, submit_search_job
+
+
+pytestmark = [pytest.mark.working]
+
+
+class FakeApp(object):
+    """ Stands in for the router: records job requests and answers them with `respond` """
+
+    def __init__(self, respond=None):
+        self.requests = []
+        self.respond = respond or (lambda request: Response(app_iter=[b'{"@graph": ', b'[]}'],
+                                                            content_type='application/json'))
+
+    def invoke_subrequest(self, request, use_tweens=False):
+        self.requests.append(request)
+        return self.respond(request)
+
+
+@pytest.fixture
+def search_jobs(tmpdir):
+    search_jobs = SearchJobs(str(tmpdir.join('jobs')), workers=2, max_per_principal=1, max_active=2)
+    yield search_jobs
+    search_jobs.shutdown()
+
+
+@pytest.fixture
+def make_request(app, registry, search_jobs):
+    def make_request(path='/search-jobs', user='TEST', fake_app=None, body=None, **matchdict):
+        request = app.request_factory.blank(path, environ={'REMOTE_USER': user} if user else {},
+                                            method='POST' if body else 'GET')
+        if body is not None:
+            request.content_type = 'application/json'
+            request.body = json.dumps(body).encode('utf-8')
+        request.registry = registry
+        request.matchdict = matchdict
+        apply_request_extensions(request)
+        request.invoke_subrequest = (fake_app or FakeApp()).invoke_subrequest
+        return request
+    with mock.patch.dict(registry, {SEARCH_JOBS: search_jobs}):
+        with mock.patch.object(URLMethodsMixin, 'route_path',
+                               lambda self, name, **kw: '/%s/%s' % (name, kw.get('job_id'))):
+            yield make_request
+
+
+def test_search_job(search_jobs, make_request):
+    fake_app = FakeApp()
+    request = make_request(fake_app=fake_app, body={'search': '/search/?type=Item&limit=all'})
+    job = submit_search_job(None, request)
+    assert request.response.status_code == 202
+    assert job['status'] == 'queued' and 'owner' not in job
+    search_jobs.wait(job['id'])
+
+    # the search ran as a new top-level request of the same user
+    job_request, = fake_app.requests
+    assert job_request.path_qs == '/search/?type=Item&limit=all'
+    assert job_request.remote_user == 'TEST'
+    assert job_request.__parent__ is None
+
+    job = search_job(None, make_request(job_id=job['id']))
+    assert job['status'] == 'done'
+    assert job['status_code'] == 200
+    assert job['results'] == '/search_job_results/%s' % job['id']
+    response = search_job_results(None, make_request(job_id=job['id']))
+    assert json.loads(b''.join(response.app_iter)) == {'@graph': []}
+    assert response.content_type == 'application/json'
+
+    # other users do not see the job
+    with pytest.raises(HTTPNotFound):
+        search_job(None, make_request(user='TEST_AUTHENTICATED', job_id=job['id']))
+
+
+def test_search_jobs_need_authentication(search_jobs, make_request):
+    job = submit_search_job(None, make_request(body={'search': '/search/'}))
+    with pytest.raises(HTTPForbidden):
+        submit_search_job(None, make_request(user=None, body={'search': '/search/'}))
+    with pytest.raises(HTTPForbidden):
+        search_job(None, make_request(user=None, job_id=job['id']))
+
+
+def test_compound_search_job(search_jobs, make_request):
+    fake_app = FakeApp()
+    job = submit_search_job(None, make_request(fake_app=fake_app, body={'compound_search': {'search_type': 'Item'}}))
+    search_jobs.wait(job['id'])
+    job_request, = fake_app.requests
+    assert job_request.method == 'POST' and job_request.path == '/compound_search'
+    assert job_request.json_body == {'search_type': 'Item'}
+
+
+@pytest.mark.parametrize('body', [{'search': '/items/?limit=all'}, {'compound_search': 'x'}, ['x']])
+def test_search_job_bad_requests(make_request, body):
+    with pytest.raises(HTTPBadRequest):
+        submit_search_job(None, make_request(body=body))
+
+
+def test_failed_search_job(search_jobs, make_request):
+    def respond(request):
+        if 'bad' in request.path_qs:
+            raise HTTPBadRequest('bad query')
+        raise RuntimeError('oops')
+
+    fake_app = FakeApp(respond)
+    for query, status_code, error in [('bad', 400, 'bad query'), ('other', 500, 'oops')]:
+        job = submit_search_job(None, make_request(fake_app=fake_app, body={'search': '/search/?q=' + query}))
+        search_jobs.wait(job['id'])
+        job = search_jobs.get(job['id'])
+        assert (job['status'], job['status_code'], job['error']) == ('failed', status_code, error)
+        with pytest.raises(HTTPNotFound):
+            search_job_results(None, make_request(job_id=job['id']))
+
+
+def test_search_job_admission(search_jobs, make_request):
+    release = threading.Event()
+
+    def respond(request):
+        release.wait(10)
+        return Response(app_iter=[b'{}'], content_type='application/json')
+
+    fake_app = FakeApp(respond)
+    body = {'search': '/search/?type=Item'}
+    first = submit_search_job(None, make_request(fake_app=fake_app, body=body))
+    with pytest.raises(HTTPTooManyRequests):
+        submit_search_job(None, make_request(fake_app=fake_app, body=body))
+    second = submit_search_job(None, make_request(user='TEST_SUBMITTER', fake_app=fake_app, body=body))
+    with pytest.raises(HTTPServiceUnavailable):
+        submit_search_job(None, make_request(user='IMPORT', fake_app=fake_app, body=body))
+    release.set()
+    for job in [first, second]:
+        search_jobs.wait(job['id'])
+    assert submit_search_job(None, make_request(fake_app=fake_app, body=body))['status'] == 'queued'
+
+
+def test_search_jobs_expire(search_jobs, make_request):
+    job = submit_search_job(None, make_request(body={'search': '/search/'}))
+    search_jobs.wait(job['id'])
+    assert search_jobs.get(job['id'])['status'] == 'done'
+    search_jobs.ttl = -1
+    search_jobs.expire()
+    assert search_jobs.get(job['id']) is None
+    assert not os.listdir(search_jobs.spool_dir)
@@ -0,0 +1,135 @@
+"""
+Tests for the memoization of schema- and mapping-derived search data (field schemas, nested
+paths and schema facets) across requests, see search_utils.DerivedValueCache.
+"""
+
+import pytest
+
+from pyramid.url import URLMethodsMixin
+from unittest import mock
+
+from ..elasticsearch.interfaces import ELASTIC_SEARCH
+from ..interfaces import TYPES
+from ..search import search_utils
+from ..search.search import SearchBuilder
+from ..search.search_utils import (
+    SCHEMA_CACHE, DerivedValueCache, IndexMapping, find_nested_path, get_es_mapping, schema_for_field,
+)
+
+
+pytestmark = [pytest.mark.working]
+
+
+class TypeInfo(object):
+
+    def __init__(self, schema):
+        self.schema = schema
+
+
+class Request(object):
+
+    def __init__(self, types):
+        self.registry = {'types': types}
+
+
+def test_derived_value_cache():
+    cache = DerivedValueCache(capacity=2)
+    a, b = {}, {}
+    cache.memo('x', [a])['value'] = 1
+    assert cache.memo('x', [a]) == {'value': 1}
+    # derived from another object: started over
+    assert cache.memo('x', [b]) == {}
+    cache.memo('y', [a])
+    cache.memo('z', [a])
+    assert cache.memo('x', [b]) == {}  # evicted
+
+
+def test_schema_for_field_shared_across_requests(monkeypatch):
+    calls = []
+
+    def crawl_schema(types, field, schema):
+        calls.append(field)
+        return schema['properties'][field]
+
+    monkeypatch.setattr(search_utils, 'crawl_schema', crawl_schema)
+    schema = {'properties': {'status': {'type': 'string'}}}
+    types = {'Thing': TypeInfo(schema)}
+    assert schema_for_field('status', Request(types), ['Thing']) == {'type': 'string'}
+    assert schema_for_field('status', Request(types), ['Thing']) == {'type': 'string'}
+    assert calls == ['status']
+    # schemas reloaded (a new TypeInfo.schema object): crawled again
+    types['Thing'] = TypeInfo({'properties': {'status': {'type': 'integer'}}})
+    assert schema_for_field('status', Request(types), ['Thing']) == {'type': 'integer'}
+    assert calls == ['status', 'status']
+
+
+def test_find_nested_path_memoized(monkeypatch):
+    properties = {'files': {'type': 'nested', 'properties': {'accession': {'type': 'keyword'}}}}
+    assert find_nested_path('files.accession', IndexMapping(properties, ('sno_files', 'uuid', 'a'))) == 'files'
+    # memoized per index and mapping version, not per mapping object (fetched anew for each request)
+    with mock.patch.object(search_utils, '_find_nested_path', side_effect=AssertionError):
+        assert find_nested_path('files.accession', IndexMapping(properties, ('sno_files', 'uuid', 'a'))) == 'files'
+    changed = {'files': {'type': 'object', 'properties': {'accession': {'type': 'keyword'}}}}
+    assert find_nested_path('files.accession', IndexMapping(changed, ('sno_files', 'uuid', 'b'))) is None
+    # mappings of no known version are not memoized
+    with mock.patch.object(search_utils, '_find_nested_path', wraps=search_utils._find_nested_path) as uncached:
+        for _ in range(2):
+            assert find_nested_path('files.accession', properties) == 'files'
+    assert uncached.call_count == 2
+    assert find_nested_path('files.accession', {}) is None
+
+
+def test_get_es_mapping_versioned():
+    es = mock.Mock()
+    es.indices.get.return_value = {'sno_files': {'mappings': {'properties': {'uuid': {'type': 'keyword'}}},
+                                                 'settings': {'index': {'uuid': 'index-uuid'}}}}
+    mapping = get_es_mapping(es, 'sno_files')
+    assert mapping == {'uuid': {'type': 'keyword'}}
+    assert mapping.key == ('sno_files', 'uuid', 'index-uuid')
+    assert get_es_mapping(es, 'sno_*') == {}
+
+
+@pytest.fixture
+def search_request(dummy_request):
+    dummy_request.environ['REMOTE_USER'] = 'TEST'
+    with mock.patch.dict(dummy_request.registry, {ELASTIC_SEARCH: mock.Mock()}):
+        with mock.patch.object(SearchBuilder, '_get_es_mapping_if_necessary', return_value={}):
+            with mock.patch.object(URLMethodsMixin, 'route_path', lambda self, name, **kw: '/%s/' % name):
+                yield dummy_request
+
+
+def make_builder(request, query_string):
+    """ Builds the query of a search with the given query string on request, as if it was new """
+    request.environ['QUERY_STRING'] = query_string
+    for name in ['GET', 'params', 'normalized_params', '_field_schema_cache']:
+        request.__dict__.pop(name, None)
+    builder = SearchBuilder(None, request)
+    builder._build_query()
+    return builder
+
+
+def test_schema_facets_copied(search_request):
+    query_string = 'type=TestingBiosampleSno'
+    first = make_builder(search_request, query_string)
+    first.facets[-1][1]['title'] = 'changed by the first search'
+    second = make_builder(search_request, query_string)
+    assert second.facets[-1][1]['title'] != 'changed by the first search'
+    assert [field for field, _ in first.facets] == [field for field, _ in second.facets]
+
+
+def test_field_schema_memo_hits(registry):
+    """ Per-request field schema resolution of a search on all types crawls schemas only for the
+        first request, later ones are served from the shared memo
+    """
+    types = registry[TYPES]
+    doc_types = sorted(type_info.name for type_info in types.by_item_type.values())
+    fields = sorted({field for doc_type in doc_types for field in types[doc_type].schema['properties']})
+    fields += [field + '.display_title' for field in fields]
+    SCHEMA_CACHE.clear()
+    with mock.patch.object(search_utils, 'crawl_schema', wraps=search_utils.crawl_schema) as crawl_schema:
+        first = [schema_for_field(field, Request(types), doc_types) for field in fields]
+        crawled = crawl_schema.call_count
+        assert crawled >= len(fields)
+        request = Request(types)  # a new request, without field schemas of its own yet
+        assert [schema_for_field(field, request, doc_types) for field in fields] == first
+        assert crawl_schema.call_count == crawled
@@ -9,6 +9,7 @@ Elasticsearch cluster.
 """
 
 import pytest
+import threading
 from elasticsearch import ConnectionTimeout, RequestError, TransportError
 from pyramid.httpexceptions import HTTPBadRequest
 
@@ -23,7 +24,12 @@ from snovault.search.search_utils import (
     execute_search,
     execute_streaming_search,
     build_permission_filter,
+    build_principals_filter,
+    canonical_principals,
+    principals_on_filter,
+    search_budget,
 )
+from snovault.search.lucene_builder import LuceneBuilder
 
 
 class DummyTypeInfo:
@@ -391,4 +397,109 @@ class TestBuildPermissionFilter:
     def test_builds_terms_filter_from_effective_principals(self):
         request = DummyRequest(effective_principals=['system.Everyone', 'userid.abc'])
         result = build_permission_filter(request)
-        assert result == {'terms': {'principals_allowed.view': ['system.Everyone', 'userid.abc']}}
+        assert result == {'bool': {'should': [{'terms': {'principals_allowed.view': ['system.Everyone']}},
+                                              {'terms': {'principals_allowed.view': ['userid.abc']}}]}}
+
+    def test_permission_filter_is_canonical(self):
+        request = DummyRequest(effective_principals=['userid.abc', 'system.Everyone', 'group.admin',
+                                                     'system.Everyone', 'system.Authenticated'])
+        result = build_permission_filter(request)
+        assert result == {'bool': {'should': [
+            {'terms': {'principals_allowed.view': ['group.admin', 'system.Authenticated', 'system.Everyone']}},
+            {'terms': {'principals_allowed.view': ['userid.abc']}}]}}
+
+    def test_permission_filter_without_user(self):
+        request = DummyRequest(effective_principals=['system.Everyone'])
+        result = build_permission_filter(request)
+        assert result == {'bool': {'should': [{'terms': {'principals_allowed.view': ['system.Everyone']}}]}}
+
+
+def test_canonical_principals():
+    # groups first, then the per-user principals, each sorted and deduplicated
+    assert canonical_principals(['userid.b', 'remoteuser.TEST', 'system.Everyone', 'group.admin', 'userid.b']) == [
+        'group.admin', 'system.Everyone', 'remoteuser.TEST', 'userid.b']
+    # users with the same groups get the same group part
+    first = canonical_principals(['system.Everyone', 'userid.a', 'group.submitter'])
+    second = canonical_principals(['group.submitter', 'userid.z', 'system.Everyone'])
+    assert first[:2] == second[:2] == ['group.submitter', 'system.Everyone']
+    assert canonical_principals([]) == []
+
+
+def test_principals_filter_shares_group_clause():
+    # users with the same groups get the same group clause, whatever their order
+    first = build_principals_filter(['system.Everyone', 'userid.a', 'group.submitter'])
+    second = build_principals_filter(['group.submitter', 'userid.z', 'system.Everyone'])
+    assert first['bool']['should'][0] == second['bool']['should'][0] == {
+        'terms': {'principals_allowed.view': ['group.submitter', 'system.Everyone']}}
+    assert principals_on_filter(first) == ['group.submitter', 'system.Everyone', 'userid.a']
+    assert principals_on_filter({'terms': {'principals_allowed.view': ['system.Everyone']}}) is None
+    assert principals_on_filter({'bool': {'should': [{'terms': {'embedded.status.raw': ['released']}}]}}) is None
+
+
+def test_verify_search_has_permissions_canonical():
+    request = DummyRequest(effective_principals=['userid.abc', 'system.Everyone'])
+    query = {'query': {'bool': {'filter': {'bool': {'must': [
+        build_principals_filter(reversed(request.effective_principals))]}}}}}
+    LuceneBuilder.verify_search_has_permissions(request, query)
+    query['query']['bool']['filter']['bool']['must'][0]['bool']['should'][0]['terms'][
+        'principals_allowed.view'].append('group.admin')
+    with pytest.raises(HTTPBadRequest):
+        LuceneBuilder.verify_search_has_permissions(request, query)
+
+
+class BudgetRequest:
+
+    def __init__(self, settings, route=None, client_disconnected=None):
+        self.registry = type('Registry', (), {'settings': settings})()
+        self.matched_route = type('Route', (), {'name': route})() if route else None
+        self.environ = {'waitress.client_disconnected': client_disconnected} if client_disconnected else {}
+
+
+def test_search_budget():
+    settings = {'search.timeout.compound_search': '60s', 'search.terminate_after.search': '1000'}
+    assert search_budget(BudgetRequest({})) == ('30s', None)
+    assert search_budget(BudgetRequest(settings, route='search')) == ('30s', 1000)
+    assert search_budget(BudgetRequest(settings, route='compound_search')) == ('60s', None)
+    assert search_budget(BudgetRequest(dict(settings, **{'search.timeout': '10s'}), route='search')) == ('10s', 1000)
+
+
+class FakeTasksES:
+    """ Search that runs until its task (found by X-Opaque-Id) is cancelled, or `duration` passed """
+
+    def __init__(self, duration=5):
+        self.duration = duration
+        self.searches = []
+        self.cancelled = threading.Event()
+        self.tasks = self
+
+    def search(self, **kwargs):
+        self.searches.append(kwargs)
+        if self.cancelled.wait(self.duration):
+            raise TransportError(400, 'task_cancelled_exception')
+        return {'hits': {'hits': []}}
+
+    def list(self, actions, detailed):
+        opaque_id = self.searches[-1]['opaque_id']
+        return {'nodes': {'node': {'tasks': {'other:1': {'headers': {}},
+                                             'node:2': {'headers': {'X-Opaque-Id': opaque_id}}}}}}
+
+    def cancel(self, task_id):
+        assert task_id == 'node:2'
+        self.cancelled.set()
+
+
+def test_search_cancelled_when_client_disconnects():
+    es = FakeTasksES()
+    request = BudgetRequest({'search.timeout.search': '5s'}, route='search', client_disconnected=lambda: True)
+    with pytest.raises(HTTPBadRequest) as exc_info:
+        execute_search(es=es, query={}, index='test-index', from_=0, size=10, request=request)
+    assert 'client disconnected' in str(exc_info.value)
+    assert es.searches[0]['timeout'] == '5s'
+
+
+def test_search_not_cancelled_while_client_connected():
+    es = FakeTasksES(duration=0.5)
+    request = BudgetRequest({}, client_disconnected=lambda: False)
+    assert execute_search(es=es, query={}, index='test-index', from_=0, size=10, request=request) == {
+        'hits': {'hits': []}}
+    assert es.searches[0]['opaque_id'].startswith('search-') and not es.cancelled.is_set()
@@ -1,3 +1,4 @@
+import json
 from unittest import mock
 import pytest
 import re
@@ -6,11 +7,13 @@ import boto3
 
 from dcicutils.misc_utils import filtered_warnings
 from pyramid.threadlocal import manager
-from sqlalchemy import func
+from sqlalchemy import event, func
 from sqlalchemy.exc import IntegrityError
+from .. import crud_views
 from ..interfaces import DBSESSION, STORAGE, TYPES
 from ..storage import (
     POSTGRES_COMPATIBLE_MAJOR_VERSIONS,
+    ArchivedPropertySheet,
     Blob,
     CurrentPropertySheet,
     Key,
@@ -22,6 +25,7 @@ from ..storage import (
     Resource,
     S3BlobStorage,
 )
+from ..util import json_patch
 from moto import mock_aws
 
 pytestmark = pytest.mark.storage
@@ -195,6 +199,57 @@ def test_delete_compound(session, storage):
     assert storage.revision_history(uuid=str(resource.rid)) == []
 
 
+def _make_revisions(session, n, name=''):
+    """ Creates a resource with n revisions of the given sheet, returning it. """
+    resource = Resource('test_item', {name: {'foo': 'v1'}})
+    session.add(resource)
+    session.flush()
+    for i in range(2, n + 1):
+        resource[name] = {'foo': 'v%s' % i}
+        session.flush()
+    return resource
+
+
+def test_archive_revisions(session, storage):
+    """ Non-current revisions move to the archive table, history is unchanged. """
+    resource = _make_revisions(session, 5)
+    rid = str(resource.rid)
+    before = storage.revision_history(uuid=rid)
+    assert [r['foo'] for r in before] == ['v1', 'v2', 'v3', 'v4', 'v5']
+
+    current_sid = resource.sid
+    # incremental: batch size bounds each move
+    assert storage.archive_revisions(current_sid + 1, batch_size=3) == 3
+    assert storage.archive_revisions(current_sid + 1, batch_size=3) == 1
+    assert storage.archive_revisions(current_sid + 1, batch_size=3) == 0
+    assert session.query(PropertySheet).count() == 1
+    assert session.query(ArchivedPropertySheet).count() == 4
+    # the current version is untouched and history reads across both tables
+    assert storage.get_by_uuid(rid)['']['foo'] == 'v5'
+    assert storage.revision_history(uuid=rid) == before
+
+
+def test_archive_revisions_threshold(session, storage):
+    """ Only rows older than the given sid are archived. """
+    resource = _make_revisions(session, 4)
+    sids = [r['sid'] for r in storage.revision_history(uuid=str(resource.rid))]
+    assert storage.archive_revisions(sids[2]) == 2
+    assert sorted(sid for sid, in session.query(ArchivedPropertySheet.sid)) == sids[:2]
+    assert sorted(sid for sid, in session.query(PropertySheet.sid)) == sids[2:]
+
+
+def test_purge_uuid_archived_revisions(session, storage):
+    """ Purge removes archived history along with everything else. """
+    resource = _make_revisions(session, 3)
+    rid = str(resource.rid)
+    storage.archive_revisions(resource.sid)
+    assert session.query(ArchivedPropertySheet).count() == 2
+    storage.purge_uuid(rid)
+    assert session.query(ArchivedPropertySheet).count() == 0
+    assert session.query(PropertySheet).count() == 0
+    assert storage.revision_history(uuid=rid) == []
+
+
 def test_keys(session):
     name = 'testdata'
     props1 = {'foo': 'bar'}
@@ -235,6 +290,26 @@ def test_get_sids_by_uuids(session, storage):
     assert set(sids) == {str(resource.rid)}
 
 
+def test_get_by_uuids(session, storage):
+    rids = []
+    for i in range(3):
+        resource = Resource('test_item', {'': {'foo': i}})
+        session.add(resource)
+        session.flush()
+        rids.append(str(resource.rid))
+    session.expunge_all()
+    missing = str(uuid.uuid4())
+    models = storage.get_by_uuids(rids + [missing])
+    assert sorted(str(model.rid) for model in models) == sorted(rids)
+    assert {model.properties['foo'] for model in models} == {0, 1, 2}
+    # loaded into the session, where get_by_uuid(s) find them without a query
+    statements = []
+    event.listen(session.connection(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    assert storage.get_by_uuid(rids[0]) in models
+    assert sorted(map(id, storage.get_by_uuids(rids))) == sorted(map(id, models))
+    assert statements == []
+
+
 @pytest.mark.parametrize(
     's3_encrypt_key_id,kms_args_expected',
     [(None, False), ("", False), (str(uuid.uuid4()), True)],
@@ -419,6 +494,75 @@ def test_track_revisions_enabled_accumulates_rows(testapp, session):
     assert _count_propsheet_rows(session, item_uuid) == 6
 
 
+def _post_revisions(testapp, n):
+    """ Posts a history-enabled item and patches it so it has n revisions. """
+    res = testapp.post_json('/testing-revision-history-enabled',
+                            {'title': 'v1', 'description': 'first'}, status=201)
+    item_id = res.json['@graph'][0]['@id']
+    for i in range(2, n + 1):
+        testapp.patch_json(item_id, {'title': f'v{i}'}, status=200)
+    return item_id
+
+
+def test_revision_history_pagination(testapp):
+    """ after_sid/limit page through the history in sid order. """
+    item_id = _post_revisions(testapp, 5)
+    page = testapp.get(item_id + '@@revision-history?limit=2').json
+    assert [r['title'] for r in page['revisions']] == ['v1', 'v2']
+    titles = [r['title'] for r in page['revisions']]
+    while 'next_after_sid' in page:
+        page = testapp.get(item_id + '@@revision-history?limit=2&after_sid=%s' % page['next_after_sid']).json
+        titles.extend(r['title'] for r in page['revisions'])
+    assert titles == ['v1', 'v2', 'v3', 'v4', 'v5']
+    testapp.get(item_id + '@@revision-history?limit=many', status=400)
+    testapp.get(item_id + '@@revision-history?after_sid=-1', status=400)
+
+
+def test_revision_history_diff(testapp):
+    """ diff=true returns the first revision whole and JSON patches after it. """
+    item_id = _post_revisions(testapp, 3)
+    full = testapp.get(item_id + '@@revision-history').json['revisions']
+    diffed = testapp.get(item_id + '@@revision-history?diff=true').json['revisions']
+    assert diffed[0] == full[0]
+    assert [r['sid'] for r in diffed] == [r['sid'] for r in full]
+    assert {'op': 'replace', 'path': '/title', 'value': 'v2'} in diffed[1]['patch']
+    assert not any(op['path'] == '/sid' for op in diffed[2]['patch'])
+
+
+def test_revision_history_ndjson(testapp):
+    """ format=ndjson streams the same revisions, one per line. """
+    item_id = _post_revisions(testapp, 4)
+    full = testapp.get(item_id + '@@revision-history').json['revisions']
+    res = testapp.get(item_id + '@@revision-history?format=ndjson')
+    assert res.content_type == 'application/x-ndjson'
+    assert [json.loads(line) for line in res.text.splitlines()] == full
+    storage = testapp.app.registry[STORAGE]
+    with mock.patch.object(crud_views, 'REVISION_HISTORY_PAGE_SIZE', 3):
+        with mock.patch.object(storage, 'revision_history', wraps=storage.revision_history) as pages:
+            res = testapp.get(item_id + '@@revision-history?format=ndjson&diff=true')
+    # streamed in pages of 3
+    assert [call[1]['limit'] for call in pages.call_args_list] == [3, 3]
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert lines[0] == full[0]
+    assert [line['sid'] for line in lines] == [r['sid'] for r in full]
+    # limit is honored across pages
+    with mock.patch.object(crud_views, 'REVISION_HISTORY_PAGE_SIZE', 2):
+        res = testapp.get(item_id + '@@revision-history?format=ndjson&limit=3&after_sid=%s' % full[0]['sid'])
+    assert [json.loads(line) for line in res.text.splitlines()] == full[1:4]
+
+
+def test_json_patch():
+    old = {'a': 1, 'b': {'c': 2, 'd': 3}, 'e/f': [1], 'g': 'x'}
+    new = {'a': 1, 'b': {'c': 2, 'd': 4}, 'e/f': [1, 2], 'h': 'y'}
+    assert json_patch(old, new) == [
+        {'op': 'remove', 'path': '/g'},
+        {'op': 'replace', 'path': '/b/d', 'value': 4},
+        {'op': 'replace', 'path': '/e~1f', 'value': [1, 2]},
+        {'op': 'add', 'path': '/h', 'value': 'y'},
+    ]
+    assert json_patch(new, new) == []
+
+
 def test_track_revisions_disabled_mixed_sheets(testapp, session, storage, connection):
     """ Edge case: a history-disabled type with more than one sheet name keeps at
         most one row PER (rid, name). Exercises the storage `sheets` write path
@@ -1,4 +1,5 @@
 import copy
+import json
 import pytest
 import random
 import re
@@ -10,6 +11,7 @@ from .. import util
 from ..util import (
     dictionary_lookup, DictionaryKeyError, merge_calculated_into_properties, CachedField,
     generate_indexer_namespace_for_testing, extra_kwargs_for_s3_encrypt_key_id, ExtraArgs,
+    process_aggregated_items,
 )
 
 
@@ -265,3 +267,64 @@ class TestExtraKwargsForS3EncryptKeyId:
             extra_kwargs_for_s3_encrypt_key_id(s3_encrypt_key_id=None, client_name='test_client')
         assert mocked_log.error.call_count == 0
         assert mocked_log.warning.call_count == 1
+
+
+def make_aggregated_items(n, distinct):
+    """ n aggregated items (of `distinct` different ones), as collected while embedding """
+    return {
+        'targets': {
+            '_fields': ['uuid', 'sub.value'],
+            'items': [{'parent': '/parents/%s/' % (i % 3), 'embedded_path': 'targets.target',
+                       'item': {'uuid': 'uuid-%s' % (i % distinct), 'sub': {'value': i % distinct, 'other': 'x'},
+                                'description': 'target %s' % (i % distinct)}}
+                      for i in range(n)],
+        },
+    }
+
+
+def quadratic_process_aggregated_items(aggregated_items):
+    """ How process_aggregated_items used to deduplicate: against a list of json dumps, deleting by index """
+    for agg_body in aggregated_items.values():
+        covered_json_items, item_idxs_to_remove = [], []
+        for agg_idx, agg_item in enumerate(agg_body['items']):
+            if json.dumps(agg_item, sort_keys=True) in covered_json_items:
+                item_idxs_to_remove.append(agg_idx)
+                continue
+            covered_json_items.append(json.dumps(agg_item, sort_keys=True))
+            agg_item['item'] = {'uuid': agg_item['item']['uuid'], 'sub': {'value': agg_item['item']['sub']['value']}}
+        for dedup_idx in reversed(item_idxs_to_remove):
+            del agg_body['items'][dedup_idx]
+
+
+def test_process_aggregated_items():
+    request = mock.Mock(_aggregated_items=make_aggregated_items(12, 4))
+    items = request._aggregated_items['targets']['items']
+    process_aggregated_items(request)
+    # duplicates (same item under the same parent) dropped, in order, and only the aggregated fields kept
+    assert request._aggregated_items['targets']['items'] is items
+    assert [(item['parent'], item['item']) for item in items] == [
+        ('/parents/%s/' % (i % 3), {'uuid': 'uuid-%s' % (i % 4), 'sub': {'value': i % 4}}) for i in range(12)]
+    request = mock.Mock(_aggregated_items=make_aggregated_items(24, 4))
+    process_aggregated_items(request)
+    expected = make_aggregated_items(24, 4)
+    quadratic_process_aggregated_items(expected)
+    assert request._aggregated_items == expected
+    assert len(expected['targets']['items']) == 12
+
+
+def test_process_aggregated_items_work_is_linear():
+    """ Deduplication of large aggregated lists serializes each item once and processes the fields of
+        the distinct ones only, rather than deleting duplicates by index (which was quadratic)
+    """
+    n, distinct = 10000, 50
+    old = make_aggregated_items(n, distinct)
+    quadratic_process_aggregated_items(old)
+    assert len(old['targets']['items']) == 150  # each item under each of the 3 parents
+    request = mock.Mock(_aggregated_items=make_aggregated_items(n, distinct))
+    with mock.patch.object(util.json, 'dumps', wraps=json.dumps) as dumps:
+        with mock.patch.object(util, 'recursively_process_field', wraps=util.recursively_process_field) as process:
+            process_aggregated_items(request)
+    assert request._aggregated_items == old
+    assert dumps.call_count == n
+    # uuid and sub.value (one call per path segment) of each item kept
+    assert process.call_count == 3 * len(old['targets']['items'])
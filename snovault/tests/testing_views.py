@@ -191,6 +191,7 @@ class Item(BaseItem):
         'archived': ALLOW_CURRENT,
     }
     filtered_rev_statuses = ('deleted', 'replaced')
+    acl_fields = ('lab', 'award')  # see __ac_local_roles__
 
     @property
     def __name__(self):
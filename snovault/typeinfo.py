@@ -1,11 +1,13 @@
 from collections import defaultdict
 from functools import reduce
 from pyramid.decorator import reify
+from sqlalchemy.util import LRUCache
 from .interfaces import (
     CALCULATED_PROPERTIES,
     TYPES,
 )
 from .schema_utils import combine_schemas
+from .util import EmbeddedPlan, add_default_embeds
 
 
 def includeme(config):
@@ -86,6 +88,9 @@ class TypeInfo(AbstractTypeInfo):
     related attributes, as well as connections to properties on the item
     itself (through `factory`)
     """
+    # distinct ACL-relevant inputs (see Item.acl_key) whose results are kept per type
+    ACL_CACHE_CAPACITY = 1000
+
     def __init__(self, registry, item_type, factory, abstract=False):
         """
         Args:
@@ -103,6 +108,7 @@ class TypeInfo(AbstractTypeInfo):
         self.embedded_list = factory.embedded_list
         self.default_diff = factory.default_diff
         self.is_abstract = abstract
+        self._embedded = None  # ((schema, embedded_list), embedded, embedded_plan), see embedded_plan
 
     @reify
     def calculated_properties(self):
@@ -115,6 +121,26 @@ class TypeInfo(AbstractTypeInfo):
         except (KeyError, TypeError):
             return None
 
+    @reify
+    def acl_fields(self):
+        """
+        The acl_fields of the item class, or None if they were declared above the class that
+        defines its ACL (__acl__ or __ac_local_roles__), in which case its ACL is not cached
+        """
+        mro = self.factory.__mro__
+
+        def defined_at(name):
+            return next((idx for idx, cls in enumerate(mro) if name in cls.__dict__), len(mro))
+
+        if defined_at('acl_fields') > min(defined_at('__acl__'), defined_at('__ac_local_roles__')):
+            return None
+        return tuple(self.factory.acl_fields)
+
+    @reify
+    def acl_cache(self):
+        """ principals_allowed and permission checks of items of this type, by Item.acl_key """
+        return LRUCache(self.ACL_CACHE_CAPACITY)
+
     @reify
     def schema_links(self):
         return sorted('.'.join(path) for path in extract_schema_links(self.factory.schema))
@@ -141,6 +167,27 @@ class TypeInfo(AbstractTypeInfo):
             merged.update(back_rev)
         return merged
 
+    def _compile_embedded(self):
+        sources = (self.schema, self.embedded_list)
+        if self._embedded is None or any(kept is not source for kept, source in zip(self._embedded[0], sources)):
+            embedded = add_default_embeds(self.item_type, self.types, self.embedded_list, self.schema)
+            self._embedded = (sources, tuple(embedded), EmbeddedPlan.compile(embedded))
+        return self._embedded
+
+    @property
+    def embedded(self):
+        """
+        Fields embedded in items of this type: the embedded_list expanded with default
+        embeds (see add_default_embeds). Computed once per schema and embedded_list, i.e.
+        again only if either is replaced (as when schemas are reloaded).
+        """
+        return self._compile_embedded()[1]
+
+    @property
+    def embedded_plan(self):
+        """ The compiled EmbeddedPlan of `embedded`, used to render @@embedded """
+        return self._compile_embedded()[2]
+
     @reify
     def schema(self):
         props = self.calculated_properties.props_for(self.factory)
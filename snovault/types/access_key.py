@@ -60,6 +60,7 @@ class AccessKey(Item):
         'current': [(Allow, 'role.owner', ['view', 'edit'])] + ONLY_ADMIN_VIEW_ACL,
         'deleted': DELETED_ACL,
     }
+    acl_fields = ('user',)  # see __ac_local_roles__
 
     @classmethod
     def create(cls, registry, uuid, properties, sheets=None):
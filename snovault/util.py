@@ -19,11 +19,12 @@ from datetime import datetime, timedelta
 from io import BytesIO
 from pyramid.httpexceptions import HTTPUnprocessableEntity, HTTPForbidden
 from pyramid.threadlocal import manager as threadlocal_manager
+from pyramid.traversal import find_resource
 from dcicutils.ecs_utils import ECSUtils
 from dcicutils.misc_utils import ignored, PRINT, VirtualApp, count_if, identity
 from dcicutils.secrets_utils import assume_identity
 
-from .interfaces import CONNECTION, STORAGE, TYPES
+from .interfaces import CONNECTION, ROOT, STORAGE, TYPES
 from .settings import Settings
 
 
@@ -229,6 +230,38 @@ def deduplicate_list(lst):
     return list(set(lst))
 
 
+def _json_pointer_token(key):
+    """ Escapes a single key for use in a JSON pointer (RFC 6901) """
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def json_patch(old, new, path=''):
+    """ Computes a JSON patch (RFC 6902) that turns dict `old` into dict `new`.
+
+    Only 'add', 'remove' and 'replace' operations are produced. Nested dicts are
+    diffed key by key; lists and scalar values that changed are replaced whole.
+
+    :param old: source dict
+    :param new: target dict
+    :param path: JSON pointer prefix of old/new within the enclosing document
+    :return: list of patch operations
+    """
+    ops = []
+    for key in old:
+        if key not in new:
+            ops.append({'op': 'remove', 'path': path + '/' + _json_pointer_token(key)})
+    for key, value in new.items():
+        key_path = path + '/' + _json_pointer_token(key)
+        if key not in old:
+            ops.append({'op': 'add', 'path': key_path, 'value': value})
+        elif old[key] != value:
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                ops.extend(json_patch(old[key], value, key_path))
+            else:
+                ops.append({'op': 'replace', 'path': key_path, 'value': value})
+    return ops
+
+
 def gunzip_content(content):
     """ Helper that will gunzip content (into memory) """
     f_in = BytesIO()
@@ -267,13 +300,52 @@ def debuglog(*args):
 _skip_fields = ['@type', 'principals_allowed']  # globally accessible if need be in the future
 
 
+def embedded_principals_index(embedded):
+    """
+    Compact index of the objects in embedded that filter_embedded checks, built
+    when indexing and stored next to the embedded view so it can be filtered
+    without walking it. Looks like:
+        {'principals': [<distinct principals_allowed.view lists>],
+         'paths': [[<path: list of keys and list indices>, <index into principals>], ...]}
+    with paths in document order, so an object comes before those it embeds.
+    """
+    principals = []
+    principal_ids = {}
+    paths = []
+
+    def walk(obj, path):
+        if isinstance(obj, dict):
+            if 'principals_allowed' in obj:
+                view = obj['principals_allowed']['view']
+                key = tuple(view)
+                if key not in principal_ids:
+                    principal_ids[key] = len(principals)
+                    principals.append(list(view))
+                paths.append([path, principal_ids[key]])
+            for name, value in obj.items():
+                if isinstance(value, (dict, list)) and name not in _skip_fields:
+                    walk(value, path + [name])
+        elif isinstance(obj, list):
+            for idx, value in enumerate(obj):
+                walk(value, path + [idx])
+
+    walk(embedded, [])
+    return {'principals': principals, 'paths': paths}
+
+
 # TODO: This is a priority candidate for unit testing. -kmp 27-Jul-2020
-def filter_embedded(embedded, effective_principals):
+def filter_embedded(embedded, effective_principals, principals_index=None):
     """
     Filter the embedded items by principals_allowed, replacing them with
     a 'no view allowed' error message if the effective principals on the
     request are disjointed
+
+    If the embedded_principals_index of embedded is given, embedded is returned
+    as is when the principals may view everything in it, and otherwise only the
+    objects they may not view are visited, rather than the whole document.
     """
+    if principals_index is not None:
+        return _filter_embedded_by_index(embedded, effective_principals, principals_index)
     # handle dictionary
     if isinstance(embedded, dict):
         if 'principals_allowed' in embedded.keys():
@@ -296,6 +368,27 @@ def filter_embedded(embedded, effective_principals):
     return embedded
 
 
+def _filter_embedded_by_index(embedded, effective_principals, principals_index):
+    effective_principals = set(effective_principals)
+    denied = [not effective_principals.intersection(principals) for principals in principals_index['principals']]
+    if not any(denied):
+        return embedded
+    for path, principals_id in principals_index['paths']:
+        if not denied[principals_id]:
+            continue
+        if not path:
+            return {'error': 'no view permissions'}
+        parent = embedded
+        try:
+            for key in path[:-1]:
+                parent = parent[key]
+            if 'principals_allowed' in parent[path[-1]]:
+                parent[path[-1]] = {'error': 'no view permissions'}
+        except (KeyError, IndexError, TypeError):
+            pass  # within an object already filtered out
+    return embedded
+
+
 def debug_log(func):
     """ Decorator that adds some debug output of the view to log that we got there """
     @functools.wraps(func)
@@ -551,9 +644,9 @@ def secure_embed(request, item_path, addition='@@object'):
 
 def expand_embedded_model(request, obj, model, parent_path='', embedded_path=None):
     """
-    A similar idea to expand_path, but takes in model from build_embedded_model
-    instead. Takes in the @@object view of the item (obj) and returns a
-    fully embedded result.
+    A similar idea to expand_path, but executes an EmbeddedPlan (or a model from
+    build_embedded_model, compiled on the fly) instead. Takes in the @@object view
+    of the item (obj) and returns a fully embedded result.
     This is also used recursively to handle dictionaries encountered during
     this process.
     parent_path and embedded_path are passed in for aggregated_items tracking.
@@ -561,7 +654,7 @@ def expand_embedded_model(request, obj, model, parent_path='', embedded_path=Non
     Args:
         request: current Request
         obj (dict): item to expand the embedded model on
-        model (dict): model for embedding from build_embedded_model
+        model (EmbeddedPlan): plan for embedding, e.g. TypeInfo.embedded_plan
         parent_path (str): resource path of the parent linkTo item encountered
             while embedding. If no external items embedded, is an empty string
             Used for aggregated items
@@ -571,27 +664,25 @@ def expand_embedded_model(request, obj, model, parent_path='', embedded_path=Non
     Returns:
         dict: embedded result
     """
+    if isinstance(model, dict):
+        model = EmbeddedPlan(model)
     embedded_res = {}
     if embedded_path is None:
         embedded_path = []  # initialize
-    # first take care of the fields_to_use at this level; get them from obj
-    fields_to_use = model.get('fields_to_use')
-    if fields_to_use:
-        if '*' in fields_to_use:
-            # Shallow-copy to avoid aliasing the input `obj` — this function
-            # later mutates `embedded_res[to_embed] = obj_embedded`, which
-            # would corrupt the embed_cache entry under the deepcopy-skip
-            # indexing optimization (where `obj` is the shared cache result).
-            embedded_res = dict(obj)
-        else:
-            for field in fields_to_use:
-                found = obj.get(field)
-                if found is not None:
-                    embedded_res[field] = found
+    # first take care of the fields to use at this level; get them from obj
+    if model.all_fields:
+        # Shallow-copy to avoid aliasing the input `obj` — this function
+        # later mutates `embedded_res[to_embed] = obj_embedded`, which
+        # would corrupt the embed_cache entry under the deepcopy-skip
+        # indexing optimization (where `obj` is the shared cache result).
+        embedded_res = dict(obj)
+    else:
+        for field in model.fields:
+            found = obj.get(field)
+            if found is not None:
+                embedded_res[field] = found
     # then handle objects at the next level
-    for to_embed in model:
-        if to_embed == 'fields_to_use':
-            continue
+    for to_embed, downstream_model in model.links:
         obj_val = obj.get(to_embed)
         if obj_val is None:
             continue
@@ -599,7 +690,7 @@ def expand_embedded_model(request, obj, model, parent_path='', embedded_path=Non
         this_embedded_path = embedded_path.copy()
         # pass to_embed (field name) to track aggregated_items
         obj_embedded = expand_val_for_embedded_model(request, obj_val,
-                                                     model[to_embed],
+                                                     downstream_model,
                                                      to_embed, parent_path,
                                                      this_embedded_path)
         if obj_embedded is not None:
@@ -627,8 +718,7 @@ def expand_val_for_embedded_model(request, obj_val, downstream_model, field_name
     Args:
         request: current Request
         obj_val: value of the embedded field from the previous model
-        downstream_model (dict): model for downstream embedding, originally
-            from build_embedded_model
+        downstream_model (EmbeddedPlan): plan for downstream embedding
         field_name (str): name of the current field being embedded. Used for
             aggregated items
         parent_path (str): resource path of the parent linkTo item encountered
@@ -644,6 +734,7 @@ def expand_val_for_embedded_model(request, obj_val, downstream_model, field_name
     # if the value is a list, process each value sequentially
     # we are not actually progressing down the embedded model yet
     if isinstance(obj_val, list):
+        prefetch_linked_items(request, obj_val)
         obj_list = []
         for idx, member in enumerate(obj_val):
             # branch embedded_path for each item in list
@@ -671,10 +762,12 @@ def expand_val_for_embedded_model(request, obj_val, downstream_model, field_name
             agg_items[field_name]['items'].append(new_agg)
         return obj_embedded
     elif isinstance(obj_val, str):
-        # get the @@object view of obj to embed
+        # get the @@object view of obj to embed, computing only the calculated properties
+        # downstream_model takes (aggregated items are taken whole, though)
         # TODO: per-field invalidation by adding uuids to request._linked_uuids
         # ONLY if the field is used in downstream_model (i.e. in embedded_list)
-        obj_val = secure_embed(request, obj_val, '@@object')
+        object_view = '@@object' if field_name in agg_items else downstream_model.object_view
+        obj_val = secure_embed(request, obj_val, object_view)
         if not obj_val or obj_val == {'error': 'no view permissions'}:
             return obj_val
 
@@ -696,6 +789,35 @@ def expand_val_for_embedded_model(request, obj_val, downstream_model, field_name
         return obj_val
 
 
+def prefetch_linked_items(request, obj_val):
+    """
+    Before the members of a list of linkTos are embedded one by one, loads the items they
+    link to all at once, so each member does not load its own when its links are turned
+    into paths (see Item.item_with_links) and followed. Items are only loaded into the
+    item cache; permissions are checked when they are embedded, as usual.
+
+    Args:
+        request: current Request
+        obj_val (list): value of the embedded field, resource paths if it lists linkTos
+    """
+    if len(obj_val) < 2 or not all(isinstance(member, str) for member in obj_val):
+        return
+    root = request.registry[ROOT]
+    uuids = []
+    for path in obj_val:
+        try:
+            item = find_resource(root, path)
+        except KeyError:
+            continue
+        type_info = getattr(item, 'type_info', None)
+        if type_info is None or not hasattr(item, 'upgrade_properties'):
+            continue
+        properties = item.upgrade_properties()
+        for link in type_info.schema_links:
+            uuids.extend(simple_path_ids(properties, link))
+    request.registry[CONNECTION].get_by_uuids(uuids)
+
+
 def build_embedded_model(fields_to_embed):
     """
     Takes a list of fields to embed and builds the framework used to generate
@@ -732,6 +854,48 @@ def build_embedded_model(fields_to_embed):
     return embedded_model
 
 
+# the @@object view of an item, computing only the calculated properties among the listed fields
+REQUIRED_FIELDS_VIEW = '@@object?required_fields='
+
+
+class EmbeddedPlan(object):
+    """
+    Compiled, immutable form of an embedded model (see build_embedded_model), which
+    expand_embedded_model executes directly. Each level of the plan has:
+        * all_fields - whether all fields of the object are taken ('*')
+        * fields - otherwise, the fields taken from the object (these include any calculated
+          properties needed, which the @@object view of linked items provides)
+        * links - (field, plan) pairs for the linkTos and sub-objects followed from the object
+        * object_view - the view a linked item at this level is embedded with: @@object, asked
+          to compute only the calculated properties among the fields and links taken (plus @id)
+          unless all fields are taken
+    Plans of item types are compiled once and kept on their TypeInfo (see TypeInfo.embedded_plan).
+    """
+    __slots__ = ('all_fields', 'fields', 'links', 'object_view')
+
+    def __init__(self, model):
+        fields_to_use = model.get('fields_to_use') or []
+        object.__setattr__(self, 'all_fields', '*' in fields_to_use)
+        object.__setattr__(self, 'fields', () if self.all_fields else tuple(fields_to_use))
+        object.__setattr__(self, 'links', tuple((field, EmbeddedPlan(downstream_model))
+                                                for field, downstream_model in model.items()
+                                                if field != 'fields_to_use'))
+        if self.all_fields:
+            object_view = '@@object'
+        else:
+            required_fields = {'@id', *self.fields, *(field for field, _ in self.links)}
+            object_view = REQUIRED_FIELDS_VIEW + ','.join(sorted(required_fields))
+        object.__setattr__(self, 'object_view', object_view)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('EmbeddedPlan is immutable')
+
+    @classmethod
+    def compile(cls, fields_to_embed):
+        """ The plan of a list of fields to embed, such as the `embedded` of an Item """
+        return cls(build_embedded_model(fields_to_embed))
+
+
 def add_default_embeds(item_type, types, embeds, schema=None):
     """
     Perform default processing on the embedded_list of an item_type.
@@ -929,8 +1093,8 @@ def process_aggregated_items(request):
         None
     """
     for agg_on, agg_body in request._aggregated_items.items():
-        covered_json_items = []  # compare agg items using json.dumps
-        item_idxs_to_remove = []  # remove these items after processing
+        covered_json_items = set()  # compare agg items using json.dumps
+        kept_items = []  # the first of each set of duplicate items, in order
         agg_fields = agg_body['_fields']
         # automatically aggregate on uuid if no fields provided
         # if you want to change this default, also change in create_mapping
@@ -939,17 +1103,18 @@ def process_aggregated_items(request):
         # handle badly formatted agg_fields here (?)
         if not isinstance(agg_fields, list):
             agg_fields = [agg_fields]
-        for agg_idx, agg_item in enumerate(agg_body['items']):
+        split_fields = [(field, field.strip().split('.')) for field in agg_fields]
+        for agg_item in agg_body['items']:
             # deduplicate aggregated items by comparing sorted json
             # use whole agg_item (w/ 'parent' and 'embedded_path') for dedup
-            if json.dumps(agg_item, sort_keys=True) in covered_json_items:
-                item_idxs_to_remove.append(agg_idx)
+            json_item = json.dumps(agg_item, sort_keys=True)
+            if json_item in covered_json_items:
                 continue
-            covered_json_items.append(json.dumps(agg_item, sort_keys=True))
+            covered_json_items.add(json_item)
+            kept_items.append(agg_item)
             proc_item = {}
-            for field in agg_fields:
+            for field, split_field in split_fields:
                 pointer = agg_item['item']
-                split_field = field.strip().split('.')
                 found_value = recursively_process_field(pointer, split_field)
                 # terminal dicts will create issues with the mapping. Print a warning and skip
                 if isinstance(found_value, dict):
@@ -966,10 +1131,9 @@ def process_aggregated_items(request):
                             proc_pointer[split] = {}
                         proc_pointer = proc_pointer[split]
             # replace the unprocessed item with the processed one
-            agg_body['items'][agg_idx]['item'] = proc_item
-        # remove deduplicated items by index in reverse order
-        for dedup_idx in reversed(item_idxs_to_remove):
-            del agg_body['items'][dedup_idx]
+            agg_item['item'] = proc_item
+        # drop the duplicates, keeping the list object (which may be referenced elsewhere)
+        agg_body['items'][:] = kept_items
 
 
 def recursively_process_field(item, split_fields):
@@ -1148,6 +1312,7 @@ class CachedField:
         self._update_function = update_function
         self.timeout = timeout
         self.value = update_function()
+        self.generation = 0  # bumped whenever the value is recomputed
         self.time_of_next_update = datetime.utcnow() + timedelta(seconds=timeout)
 
     def _update_timestamp(self):
@@ -1155,6 +1320,7 @@ class CachedField:
 
     def _update_value(self):
         self.value = self._update_function()
+        self.generation += 1
         self._update_timestamp()
 
     def get(self):
@@ -1167,6 +1333,7 @@ class CachedField:
     def get_updated(self, push_ttl=False):
         """ Intended to force an update to the value and potentially push back the timeout from now. """
         self.value = self._update_function()
+        self.generation += 1
         if push_ttl:
             self.time_of_next_update = datetime.utcnow() + timedelta(seconds=self.timeout)
         return self.value
@@ -1250,6 +1417,8 @@ def get_item_or_none(request, value, itype=None, frame='object'):
     return item
 
 
+NDJSON = 'application/x-ndjson'
+
 CONTENT_TYPE_SPECIAL_CASES = {
     'application/x-www-form-urlencoded': [
         # Single legacy special case to allow us to POST to metadata TSV requests via form submission.